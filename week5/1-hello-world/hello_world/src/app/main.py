@@ -4,6 +4,7 @@ import os
 import uvicorn
 from strands import Agent
 from pydantic import BaseModel
+from stream_encoder import StreamEncoder
 
 model_id = os.environ.get("MODEL_ID", "global.anthropic.claude-haiku-4-5-20251001-v1:0")
 
@@ -34,12 +35,19 @@ async def chat(request: ChatRequest):
     )
 
 async def generate(prompt: str):
+    # Coalesces token deltas into fewer chunks, see stream_encoder.py
+    stream = StreamEncoder()
     try:
-        async for event in agent.stream_async(prompt):
-            if "data" in event:
-                yield event["data"]
+        async for event in stream.paced(agent.stream_async(prompt)):
+            if "frame" in event:
+                yield event["frame"]
+            elif "data" in event:
+                if chunk := stream.data(event["data"]):
+                    yield chunk
+        if chunk := stream.flush():
+            yield chunk
     except Exception as e:
-        yield f"error: {str(e)}"
+        yield f"{stream.flush() or ''}error: {str(e)}"
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "8080")))
@@ -13,6 +13,8 @@ class Backend(Construct):
 
         state_bucket = s3.Bucket(self, 'StateBucket',
                                  removal_policy=RemovalPolicy.DESTROY,
+                                 # The forecasts the instances share are keyed by hour, see weather.py
+                                 lifecycle_rules=[s3.LifecycleRule(prefix='forecasts/', expiration=Duration.days(1))],
                                  )
 
         fn = _lambda.DockerImageFunction(self, 'WeatherBackend',
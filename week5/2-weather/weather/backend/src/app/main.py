@@ -4,13 +4,20 @@ from fastapi.middleware.cors import CORSMiddleware  # ADD THIS
 from pydantic import BaseModel
 from strands import Agent, tool  # ADD 'tool' HERE
 from strands.session.s3_session_manager import S3SessionManager
+from request_metrics import MetricsMiddleware, current_metrics, snapshot
+from stream_encoder import SSEEncoder
+from upstream import CircuitBreaker, UpstreamClient
+import asyncio
 import boto3
 import json
 import logging
 import os
 import uuid
 import uvicorn
-import requests
+from weather import (
+    FileForecastStore, S3ForecastStore, WeatherCache, fetch_forecast, format_3days, format_current, format_table,
+    normalize_city,
+)
 
 model_id = os.environ.get("MODEL_ID", "us.anthropic.claude-sonnet-4-0-20250514-v1:0")
 state_bucket = os.environ.get("STATE_BUCKET", "")
@@ -32,6 +39,36 @@ if state_prefix and not state_prefix.endswith("/"):
     state_prefix = f"{state_prefix}/"
 
 boto_session = boto3.Session()
+# wttr.in, on keep-alive connections, with timeouts, retries and a circuit breaker, see upstream.py
+wttr = UpstreamClient(
+    "Wttr",
+    connect_timeout=float(os.environ.get("WEATHER_CONNECT_TIMEOUT", "3")),
+    read_timeout=float(os.environ.get("WEATHER_READ_TIMEOUT", "8")),
+    retries=int(os.environ.get("WEATHER_RETRIES", "2")),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.environ.get("WEATHER_BREAKER_FAILURES", "5")),
+        reset_seconds=float(os.environ.get("WEATHER_BREAKER_RESET_SECONDS", "30")),
+    ),
+)
+# Most cities weather_for_cities fetches for one call
+MAX_CITIES = int(os.environ.get("WEATHER_MAX_CITIES", "10"))
+# Where the instances share the forecasts they fetch: "s3" (the state bucket), "file" or "none"
+weather_cache_store = os.environ.get("WEATHER_CACHE_STORE", "s3")
+if weather_cache_store == "s3":
+    forecast_store = S3ForecastStore(
+        boto_session.client("s3"), state_bucket, os.environ.get("FORECAST_PREFIX", "forecasts/")
+    )
+elif weather_cache_store == "file":
+    forecast_store = FileForecastStore(os.environ.get("WEATHER_CACHE_DIR", "/tmp/weather-cache"))
+else:
+    forecast_store = None
+# Forecasts shared by the agents of this instance, see weather.py
+weather_cache = WeatherCache(
+    ttl_minutes=int(os.environ.get("WEATHER_CACHE_TTL_MINUTES", "30")),
+    max_entries=int(os.environ.get("WEATHER_CACHE_MAX_ENTRIES", "500")),
+    stale_minutes=int(os.environ.get("WEATHER_CACHE_STALE_MINUTES", "10")),
+    store=forecast_store,
+)
 @tool
 def celsius_to_fahrenheit(celsius: float) -> str:
     """Convert Celsius to Fahrenheit
@@ -58,7 +95,7 @@ def fahrenheit_to_celsius(fahrenheit: float) -> str:
     celsius = round((fahrenheit - 32) * 5/9, 1)
     return f"{fahrenheit}°F = {celsius}°C"
 @tool
-def weather_per_city_3days(city: str) -> str:
+async def weather_per_city_3days(city: str) -> str:
     """Get 3-day weather forecast for a city.
     
     Args:
@@ -68,78 +105,81 @@ def weather_per_city_3days(city: str) -> str:
         3-day weather forecast
     """
     try:
-        # ✅ Create cache key
-        #cache_key = f"{city.lower()}_3days"
-        
-        # ✅ Check cache first
-        #cached_data = weather_cache.get(cache_key)
-        #if cached_data:
-           # logger.info(f"Returning cached 3-day forecast for {city}")
-           # return cached_data['formatted_result']
-        
-        # ✅ Fetch from API if not cached
-        logger.info(f"Fetching fresh 3-day forecast for {city}")
-        url = f"https://wttr.in/{city}?format=j1"
-        response = requests.get(url=url, timeout=10)
-        response.raise_for_status()
-        weather_data = response.json()
-        
-        # Start with current conditions
-        current_condition = weather_data['current_condition'][0]
-        result = f"🌤️ Weather Forecast for {city}:\n\n"
-        result += f"📍 Current: {current_condition['temp_C']}°C, {current_condition['weatherDesc'][0]['value']}\n"
-        result += f"💧 Humidity: {current_condition['humidity']}%\n\n"
-        
-        # Add 3-day forecast
-        result += "📅 3-Day Forecast:\n"
-        for i, day in enumerate(weather_data['weather'][:3], 1):
-            result += f"\n🗓️  Day {i} ({day['date']}):\n"
-            result += f"  🌡️  High: {day['maxtempC']}°C / Low: {day['mintempC']}°C\n"
-            result += f"  ☀️  UV Index: {day['uvIndex']}\n"
-            
-            # Get midday forecast
-            noon_forecast = day['hourly'][4] if len(day['hourly']) > 4 else day['hourly'][0]
-            result += f"  ☁️  Condition: {noon_forecast['weatherDesc'][0]['value']}\n"
-            result += f"  💧 Humidity: {noon_forecast['humidity']}%\n"
-        
-        # ✅ Store in cache
-        #weather_cache.set(cache_key, {
-         #   'raw_data': weather_data,
-         #   'formatted_result': result,
-          #  'city': city
-       # })
-        
-        return result
-        
+        return format_3days(city, await forecast(city))
     except Exception as e:
         logger.error(f"Error getting 3-day forecast for {city}: {str(e)}")
         return f"❌ Error getting weather for {city}: {str(e)}"
 
 
 @tool
-def weather_per_city(city: str) -> str:
+async def weather_per_city(city: str) -> str:
     """Get weather forecast for a city.
     Args:
         city: The name of the city
     """
     try:
-        url = f"https://wttr.in/{city}?format=j1"
-        response = requests.get(url=url)
-        response.raise_for_status()
-        weather_data = response.json()
-        current_condition = weather_data['current_condition'][0]
-        
-        result = f"Weather in {city}:\n"
-        result += f"Current: {current_condition['temp_C']}°C, {current_condition['weatherDesc'][0]['value']}\n"
-        result += f"Humidity: {current_condition['humidity']}%\n\n"
-        
-        return result
+        return format_current(city, await forecast(city))
     except Exception as e:
         return f"Error getting weather for {city}: {str(e)}"
 
+
+@tool
+async def weather_for_cities(cities: list[str]) -> str:
+    """Get current weather and the 3-day forecast for several cities at once, as one table.
+    Use this rather than a tool call per city when the question is about more than one city.
+
+    Args:
+        cities: The names of the cities
+    """
+    # Once each, however they were written
+    unique = {}
+    for city in cities:
+        if normalize_city(city):
+            unique.setdefault(normalize_city(city), city.strip())
+    cities = list(unique.values())
+    skipped = cities[MAX_CITIES:]
+    cities = cities[:MAX_CITIES]
+    # Fetched concurrently, those in the cache aren't fetched at all
+    forecasts = await asyncio.gather(*(forecast(city) for city in cities), return_exceptions=True)
+    rows = []
+    for city, data in zip(cities, forecasts):
+        if isinstance(data, Exception):
+            logger.error(f"Error getting weather for {city}: {str(data)}")
+            data = str(data)
+        rows.append((city, data))
+    result = format_table(rows)
+    if skipped:
+        result += f"Not looked up, at most {MAX_CITIES} cities at once: {', '.join(skipped)}\n"
+    return result
+
+
+async def forecast(city: str) -> dict:
+    """The city's wttr.in forecast, which has both the current conditions and the next 3 days, from the cache if it's there"""
+    key = normalize_city(city)
+    # wttr.in doesn't mind the case, so whichever way the city was written fetches the same forecast
+    return await weather_cache.get_or_fetch(key, lambda: fetch_forecast(key, wttr))
+
+
 class ChatRequest(BaseModel):
     prompt: str
 
+
+class TimedS3SessionManager(S3SessionManager):
+    """S3SessionManager whose reads and writes are timed as the request's SessionLoad and SessionSave."""
+
+    def list_messages(self, *args, **kwargs):
+        with current_metrics().phase("SessionLoad"):
+            return super().list_messages(*args, **kwargs)
+
+    def _read_s3_object(self, key):
+        with current_metrics().phase("SessionLoad"):
+            return super()._read_s3_object(key)
+
+    def _write_s3_object(self, key, data):
+        with current_metrics().phase("SessionSave"):
+            super()._write_s3_object(key, data)
+
+
 def create_agent(session_id: str) -> Agent:
     session_manager_kwargs = {
         "session_id": session_id,
@@ -149,8 +189,13 @@ def create_agent(session_id: str) -> Agent:
     if state_prefix:
         session_manager_kwargs["prefix"] = state_prefix
     
-    session_manager = S3SessionManager(**session_manager_kwargs)
-    agent = Agent(model=model_id, session_manager=session_manager, tools=[weather_per_city,fahrenheit_to_celsius,fahrenheit_to_celsius,weather_per_city_3days])
+    metrics = current_metrics()
+    metrics.properties["SessionId"] = session_id
+    with metrics.phase("SessionLoad"):
+        session_manager = TimedS3SessionManager(**session_manager_kwargs)
+    # Restoring the session happens in here, its reads are timed as SessionLoad
+    with metrics.phase("AgentConstruction"):
+        agent = Agent(model=model_id, session_manager=session_manager, tools=[weather_per_city,fahrenheit_to_celsius,fahrenheit_to_celsius,weather_per_city_3days,weather_for_cities])
     logger.info("Agent initialized for session %s", session_id)
     return agent
 
@@ -164,12 +209,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Times the phases of each request, see request_metrics.py
+app.add_middleware(MetricsMiddleware)
 
 # Called by the Lambda Adapter to check liveness
 @app.get("/")
 async def root():
     return {"message": "OK"}
 
+@app.get("/debug/metrics")
+async def debug_metrics():
+    """Returns the latency of each phase of the requests this instance has served, and its forecast cache's counters."""
+    return {**snapshot(), "WeatherCache": weather_cache.stats()}
+
 @app.get('/chat')
 def chat_history(request: Request):
     session_id = request.cookies.get("session_id", str(uuid.uuid4()))
@@ -208,19 +260,31 @@ async def chat(chat_request: ChatRequest, request: Request):
     return response
 
 async def generate(agent: Agent, session_id: str, prompt: str, request: Request):
+    # Coalesces token deltas into fewer frames, see stream_encoder.py
+    sse = SSEEncoder()
+    metrics = current_metrics()
+    metrics.stream_started(agent)
     try:
-        async for event in agent.stream_async(prompt):
+        async for event in sse.paced(agent.stream_async(prompt)):
+            if "frame" in event:
+                yield event["frame"]
+                continue
             if await request.is_disconnected():
                 logger.info("Client disconnected before completion for session %s", session_id)
-                break
+                return
             if "complete" in event:
                 logger.info("Response generation complete")
             if "data" in event:
-                yield f"data: {json.dumps(event['data'])}\n\n"
+                metrics.token()
+                if frame := sse.data(event["data"]):
+                    yield frame
+        if frame := sse.flush():
+            yield frame
  
     except Exception as e:
-        error_message = json.dumps({"error": str(e)})
-        yield f"event: error\ndata: {error_message}\n\n"
+        yield sse.error(str(e))
+    finally:
+        metrics.stream_finished(agent)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "8080")))
\ No newline at end of file
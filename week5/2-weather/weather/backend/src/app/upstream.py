@@ -0,0 +1,154 @@
+"""
+HTTP calls to an upstream API (wttr.in for the weather tools) that can't
+hold up the agent.
+
+`UpstreamClient` keeps one httpx `AsyncClient` for the instance, so calls
+reuse its keep-alive connections instead of opening a new TLS connection
+each time, and bounds every call:
+
+- connect and read timeouts, so a slow upstream fails the call within
+  seconds rather than holding the Lambda for its whole timeout;
+- a few retries of timeouts, connection errors, 429s and 5xx, after a
+  random wait (full jitter) that doubles with each attempt, so instances
+  retrying at once don't hit the upstream at the same moment;
+- a `CircuitBreaker`: after `failure_threshold` calls in a row failed, calls
+  fail at once with `CircuitOpenError` for `reset_seconds`, then one call is
+  let through to find out whether the upstream is back.
+
+Retries and calls the open circuit turned away are added to the request's
+metrics (see request_metrics.py).
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+from request_metrics import current_metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that has been failing."""
+
+
+class CircuitBreaker:
+    """Counts the failed calls in a row, and says whether to make the next one."""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raises `CircuitOpenError` if the call shouldn't be made."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            # Half-open: once the wait is over, one call at a time finds out if the upstream is back
+            if remaining > 0 or self._trial:
+                raise CircuitOpenError(f"upstream failing, not called for another {max(remaining, 0):.0f}s")
+            self._trial = True
+
+    def succeeded(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Circuit closed, upstream is back")
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Circuit opened after {self.failures} failed calls in a row")
+                self.opened_at = time.monotonic()
+
+
+class UpstreamClient:
+    """GETs JSON from one upstream, with timeouts, retries and a circuit breaker. `name` prefixes its metrics."""
+
+    def __init__(
+        self,
+        name: str,
+        connect_timeout: float = 3,
+        read_timeout: float = 8,
+        retries: int = 2,
+        backoff_seconds: float = 0.2,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.name = name
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.breaker = breaker or CircuitBreaker()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def client(self) -> httpx.AsyncClient:
+        """The shared client, made again if the event loop changed, as its connections belong to the old one."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+                follow_redirects=True,
+            )
+            self._loop = loop
+        return self._client
+
+    async def get_json(self, url: str):
+        """GETs `url`. Raises `CircuitOpenError`, the last `httpx.HTTPError`, or the error status of a non-retried one."""
+        metrics = current_metrics()
+        try:
+            self.breaker.check()
+        except CircuitOpenError:
+            metrics.add(f"{self.name}CircuitOpen", 1, count=True)
+            raise
+        # Whether the breaker heard how the call went. Any other way out, e.g. the
+        # request being cancelled or an error not handled below, counts as a failure,
+        # which also ends a half-open trial that would otherwise keep the circuit open
+        settled = False
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = await self.client().get(url)
+                    if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                        response.raise_for_status()
+                        data = response.json()
+                        self.breaker.succeeded()
+                        settled = True
+                        return data
+                    logger.info(f"{self.name} answered {response.status_code}, retrying")
+                except httpx.HTTPStatusError as e:
+                    # Our request was wrong (e.g. an unknown city), the upstream is fine
+                    if e.response.status_code not in RETRY_STATUSES:
+                        self.breaker.succeeded()
+                    else:
+                        self.breaker.failed()
+                    settled = True
+                    raise
+                except (httpx.TransportError, ValueError) as e:
+                    if attempt == self.retries:
+                        self.breaker.failed()
+                        settled = True
+                        raise
+                    logger.info(f"{self.name} call failed ({e!r}), retrying")
+                metrics.add(f"{self.name}Retries", 1, count=True)
+                await asyncio.sleep(random.uniform(0, self.backoff_seconds * 2 ** attempt))
+        finally:
+            if not settled:
+                self.breaker.failed()
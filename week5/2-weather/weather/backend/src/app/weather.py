@@ -1,40 +1,360 @@
 """
 Weather module with caching and multi-language support
 """
-import requests
+import asyncio
+import json
 import logging
-from datetime import datetime, timedelta
-from typing import Optional
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Optional
+from urllib.parse import quote
+
+from request_metrics import current_metrics
+from upstream import UpstreamClient
 logger = logging.getLogger(__name__)
 
 # ============================================
 # WEATHER CACHE
 # ============================================
 class WeatherCache:
-    """Simple cache for weather data with TTL (time-to-live)"""
-    def __init__(self, ttl_minutes: int = 30):
-        self.cache = {}
-        self.ttl = timedelta(minutes=ttl_minutes)
-    
+    """
+    Cache for weather data with TTL (time-to-live), bounded to the
+    `max_entries` most recently used keys.
+
+    `get_or_fetch` fetches a missing key once however many tool calls ask
+    for it at the same time: the first one fetches and the others wait for
+    its result (single-flight). For `stale_minutes` after an entry expires it
+    is still served, while one background task refreshes it
+    (stale-while-revalidate), so only a key nobody asked for in that time
+    makes its caller wait for the upstream.
+
+    Ages are measured on the monotonic clock, which clock changes don't
+    move. Entries past their stale time are swept out every `SWEEP_SECONDS`
+    rather than only when their key is asked for again.
+
+    With a `store`, a second tier shared by every instance (see
+    `ForecastStore`), a key missing here is looked for there before it is
+    fetched, and what is fetched is saved there too, so a forecast another
+    instance fetched is reused rather than fetched again.
+
+    Hits, misses, stale serves, evictions and expirations, and the hits and
+    misses of the store, are counted in `counters` and added to the
+    request's metrics (see request_metrics.py) instead of being logged.
+    """
+    SWEEP_SECONDS = 60
+
+    def __init__(
+        self,
+        ttl_minutes: int = 30,
+        max_entries: int = 500,
+        stale_minutes: int = 10,
+        store: Optional["ForecastStore"] = None,
+    ):
+        # Least recently used first
+        self.cache: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self.ttl = ttl_minutes * 60
+        self.stale = stale_minutes * 60
+        self.max_entries = max_entries
+        self.store = store
+        self.counters = {
+            name: 0 for name in ("Hits", "Misses", "StaleServes", "Evictions", "Expirations", "StoreHits", "StoreMisses")
+        }
+        self._lock = threading.Lock()
+        # The fetch in progress for each key, a thread-safe future so tool calls on any event loop can wait for it
+        self._in_flight: dict[str, Future] = {}
+        self._refreshes: set[asyncio.Task] = set()
+        self._next_sweep = time.monotonic() + self.SWEEP_SECONDS
+
     def get(self, key: str) -> Optional[dict]:
         """Get cached data if not expired"""
-        if key in self.cache:
-            data, timestamp = self.cache[key]
-            if datetime.now() - timestamp < self.ttl:
-                logger.info(f"Cache HIT for {key}")
+        with self._lock:
+            data, fresh = self._lookup(key, time.monotonic())
+        return data if fresh else None
+
+    def set(self, key: str, data: dict, age: float = 0):
+        """Store data in cache with timestamp, evicting the least recently used keys over `max_entries`"""
+        with self._lock:
+            # Data from the store expires as long after it was fetched as data fetched here
+            self.cache[key] = (data, time.monotonic() - age)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+                self._count("Evictions")
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[dict]]) -> dict:
+        """
+        Get cached data, or fetch and cache it, joining a fetch of the same key
+        in progress. Stale data is returned at once and refreshed in the background.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep(now)
+            data, fresh = self._lookup(key, now)
+            if fresh:
+                self._count("Hits")
                 return data
-            else:
-                logger.info(f"Cache EXPIRED for {key}")
-                del self.cache[key]
-        logger.info(f"Cache MISS for {key}")
-        return None
-    
-    def set(self, key: str, data: dict):
-        """Store data in cache with timestamp"""
-        self.cache[key] = (data, datetime.now())
-        logger.info(f"Cache SET for {key}")
-    
+            self._count("Misses" if data is None else "StaleServes")
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = Future()
+        if data is not None:
+            if leader:
+                refresh = asyncio.create_task(self._refresh(key, fetch, flight))
+                # The loop only keeps a weak reference to its tasks
+                self._refreshes.add(refresh)
+                refresh.add_done_callback(self._refreshes.discard)
+            return data
+        if not leader:
+            # Shielded, as a waiter being cancelled would cancel the fetch for everyone
+            return await asyncio.shield(asyncio.wrap_future(flight))
+        return await self._fetch(key, fetch, flight)
+
     def clear(self):
         """Clear all cached data"""
-        self.cache.clear()
-        logger.info("Cache CLEARED")
\ No newline at end of file
+        with self._lock:
+            self.cache.clear()
+        logger.info("Cache CLEARED")
+
+    def stats(self) -> dict:
+        """The counters since the cache was created, and how many entries it holds"""
+        with self._lock:
+            return {**self.counters, "Entries": len(self.cache)}
+
+    def _lookup(self, key: str, now: float) -> tuple[Optional[dict], bool]:
+        """The key's data, if it isn't past its stale time, and whether it is fresh"""
+        entry = self.cache.get(key)
+        if entry is None:
+            return None, False
+        data, stored = entry
+        if now - stored >= self.ttl + self.stale:
+            del self.cache[key]
+            self._count("Expirations")
+            return None, False
+        self.cache.move_to_end(key)
+        return data, now - stored < self.ttl
+
+    def _sweep(self, now: float):
+        expired = [key for key, (_, stored) in self.cache.items() if now - stored >= self.ttl + self.stale]
+        for key in expired:
+            del self.cache[key]
+            self._count("Expirations")
+        self._next_sweep = now + self.SWEEP_SECONDS
+
+    def _count(self, name: str):
+        self.counters[name] += 1
+        current_metrics().add(f"WeatherCache{name}", 1, count=True)
+
+    async def _fetch(self, key: str, fetch: Callable[[], Awaitable[dict]], flight: Future) -> dict:
+        try:
+            # The stores block, the event loop goes on with other tool calls meanwhile
+            data, age = await asyncio.to_thread(self._load, key)
+            if data is None:
+                data, age = await fetch(), 0
+                await asyncio.to_thread(self._save, key, data)
+            self.set(key, data, age)
+            flight.set_result(data)
+            return data
+        except BaseException as e:
+            # The waiting tool calls get the error too; nothing is cached, so the next ask fetches again
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def _refresh(self, key: str, fetch: Callable[[], Awaitable[dict]], flight: Future):
+        try:
+            await self._fetch(key, fetch, flight)
+        except Exception as e:
+            # The stale data stays until its stale time, the next ask after a failed refresh tries again
+            logger.warning(f"Refreshing {key} failed: {e}")
+
+    def _load(self, key: str) -> tuple[Optional[dict], float]:
+        if self.store is None:
+            return None, 0
+        try:
+            with current_metrics().phase("WeatherCacheStoreLoad"):
+                data, age = self.store.get(key, max_age=self.ttl)
+        except Exception as e:
+            # The store only saves fetches, it's never a reason not to answer
+            logger.warning(f"Loading {key} from the forecast store failed: {e}")
+            data, age = None, 0
+        with self._lock:
+            self._count("StoreMisses" if data is None else "StoreHits")
+        return data, age
+
+    def _save(self, key: str, data: dict):
+        if self.store is None:
+            return
+        try:
+            with current_metrics().phase("WeatherCacheStoreSave"):
+                self.store.put(key, data)
+        except Exception as e:
+            logger.warning(f"Saving {key} to the forecast store failed: {e}")
+
+
+# ============================================
+# SHARED FORECAST STORE
+# ============================================
+class ForecastStore:
+    """
+    Forecasts saved by city and by the UTC hour they were fetched in, for
+    the instances to share.
+
+    An instance that starts, or that no longer has a city cached, finds the
+    forecast another one fetched in the last `WeatherCache.ttl` instead of
+    fetching it again. Each hour's forecasts are saved under a key of their
+    own, so there is nothing to overwrite or clean up within an hour, and old
+    hours can be expired in bulk (see the state bucket's lifecycle rule in
+    infra.py).
+
+    Subclasses read and write the JSON records; `S3ForecastStore` is shared
+    by every instance and `FileForecastStore` works offline.
+    """
+
+    def get(self, key: str, max_age: float) -> tuple[Optional[dict], float]:
+        """The latest forecast of `key` fetched less than `max_age` seconds ago, and its age, or None"""
+        now = time.time()
+        # The hour before this one too, if it was less than `max_age` ago
+        for hour in dict.fromkeys((forecast_hour(now), forecast_hour(now - max_age))):
+            record = self._read(self.path(key, hour))
+            if record is not None and now - record["fetched_at"] < max_age:
+                return record["data"], max(now - record["fetched_at"], 0.0)
+        return None, 0
+
+    def put(self, key: str, data: dict):
+        now = time.time()
+        self._write(self.path(key, forecast_hour(now)), json.dumps({"fetched_at": now, "data": data}))
+
+    @staticmethod
+    def path(key: str, hour: str) -> str:
+        # Only a slash in a city's name needs quoting
+        return f"{quote(key, safe=' ')}/{hour}.json"
+
+    def _read(self, path: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def _write(self, path: str, body: str):
+        raise NotImplementedError
+
+
+class S3ForecastStore(ForecastStore):
+    """Forecasts in an S3 bucket, under `prefix`."""
+
+    def __init__(self, s3_client, bucket: str, prefix: str = "forecasts/"):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _read(self, path: str) -> Optional[dict]:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + path)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def _write(self, path: str, body: str):
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.prefix + path, Body=body.encode("utf-8"), ContentType="application/json"
+        )
+
+
+class FileForecastStore(ForecastStore):
+    """Forecasts in a local directory, for running and testing without AWS."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _read(self, path: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.directory, path), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path: str, body: str):
+        path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so a concurrent read never sees half of it
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(partial, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(partial, path)
+
+
+def forecast_hour(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%dT%H", time.gmtime(timestamp))
+
+
+# ============================================
+# FORECASTS
+# ============================================
+def normalize_city(city: str) -> str:
+    """Cache key of a city, the same however it is written ("Paris", " paris ", "PARIS.")"""
+    return re.sub(r"\s+", " ", city).strip(" .,;").casefold()
+
+
+async def fetch_forecast(city: str, client: UpstreamClient) -> dict:
+    """Fetch current conditions and the 3-day forecast of a city from wttr.in"""
+    logger.info(f"Fetching forecast for {city}")
+    return await client.get_json(f"https://wttr.in/{quote(city)}?format=j1")
+
+
+def format_current(city: str, weather_data: dict) -> str:
+    """Current conditions, from a wttr.in forecast"""
+    current_condition = weather_data['current_condition'][0]
+    result = f"Weather in {city}:\n"
+    result += f"Current: {current_condition['temp_C']}°C, {current_condition['weatherDesc'][0]['value']}\n"
+    result += f"Humidity: {current_condition['humidity']}%\n\n"
+    return result
+
+
+def format_3days(city: str, weather_data: dict) -> str:
+    """Current conditions and the next 3 days, from a wttr.in forecast"""
+    # Start with current conditions
+    current_condition = weather_data['current_condition'][0]
+    result = f"🌤️ Weather Forecast for {city}:\n\n"
+    result += f"📍 Current: {current_condition['temp_C']}°C, {current_condition['weatherDesc'][0]['value']}\n"
+    result += f"💧 Humidity: {current_condition['humidity']}%\n\n"
+
+    # Add 3-day forecast
+    result += "📅 3-Day Forecast:\n"
+    for i, day in enumerate(weather_data['weather'][:3], 1):
+        result += f"\n🗓️  Day {i} ({day['date']}):\n"
+        result += f"  🌡️  High: {day['maxtempC']}°C / Low: {day['mintempC']}°C\n"
+        result += f"  ☀️  UV Index: {day['uvIndex']}\n"
+
+        # Get midday forecast
+        noon_forecast = day['hourly'][4] if len(day['hourly']) > 4 else day['hourly'][0]
+        result += f"  ☁️  Condition: {noon_forecast['weatherDesc'][0]['value']}\n"
+        result += f"  💧 Humidity: {noon_forecast['humidity']}%\n"
+    return result
+
+
+def format_table(rows: list[tuple[str, dict | str]]) -> str:
+    """
+    One line per city, from (city, wttr.in forecast) pairs or (city, error)
+    pairs: the current conditions, then each day's low/high and midday
+    condition. Much shorter than `format_3days` for each city.
+    """
+    dates = next(([day['date'] for day in data['weather'][:3]] for _, data in rows if isinstance(data, dict)), [])
+    result = "City | Now | Humidity | " + " | ".join(f"{date} low/high" for date in dates) + "\n"
+    for city, data in rows:
+        if isinstance(data, str):
+            # Its first line, to keep the table one line per city
+            result += f"{city} | error: {data.splitlines()[0] if data else 'unknown'}\n"
+            continue
+        current_condition = data['current_condition'][0]
+        cells = [city, f"{current_condition['temp_C']}°C {current_condition['weatherDesc'][0]['value']}",
+                 f"{current_condition['humidity']}%"]
+        for day in data['weather'][:3]:
+            noon_forecast = day['hourly'][4] if len(day['hourly']) > 4 else day['hourly'][0]
+            cells.append(f"{day['mintempC']}/{day['maxtempC']}°C {noon_forecast['weatherDesc'][0]['value']}")
+        result += " | ".join(cells) + "\n"
+    return result
@@ -17,6 +17,8 @@ class Backend(Construct):
         dynamodb_table = dynamodb.TableV2(self, 'CSBackendTable',
                                           partition_key=dynamodb.Attribute(name='PK', type=dynamodb.AttributeType.STRING),
                                           sort_key=dynamodb.Attribute(name='SK', type=dynamodb.AttributeType.STRING),
+                                          # Expires the idempotency records of payment updates
+                                          time_to_live_attribute='ExpiresAt',
                                           removal_policy=RemovalPolicy.DESTROY,
                                         )
         state_bucket = s3.Bucket(self, 'StateBucket')
@@ -53,6 +55,8 @@ class Backend(Construct):
                                     "AWS_LWA_INVOKE_MODE": "response_stream",
                                     "STATE_BUCKET": state_bucket.bucket_name,
                                     "DDB_TABLE": dynamodb_table.table_name,
+                                    # "false" once scripts/backfill_flight_layout.py --delete-legacy has run
+                                    "READ_LEGACY_FLIGHTS": "true",
                                     "GUARDRAIL_ID": guardrails.airline_safety.attr_guardrail_id,
                                     "GUARDRAIL_VERSION": guardrails.airline_safety.attr_version,
                                 },
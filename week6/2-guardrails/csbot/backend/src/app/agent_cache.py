@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from session_store import SessionLog
+
+if TYPE_CHECKING:
+    from strands import Agent
+
+logger = logging.getLogger(__name__)
+
+
+class CachedAgent:
+    """A live agent together with the persisted session it was built from."""
+
+    def __init__(self, agent: "Agent", log: SessionLog, in_use: bool = False):
+        self.agent = agent
+        self.log = log
+        self.cached_at = time.monotonic()
+        # Whether a request is running a turn on the agent
+        self.in_use = in_use
+
+
+class AgentCache:
+    """
+    Bounded, per-container LRU of live agents keyed by session id.
+
+    Entries expire after `ttl_seconds`. A fresh entry is still revalidated
+    against S3 by the caller using its ETag, so a session written by another
+    container is never served stale.
+
+    A request takes the agent with `checkout` and gives it back with
+    `checkin` once its turn is over. While it is checked out, other requests
+    for the session don't get it and build an agent of their own, as two
+    turns streaming on one agent would interleave their messages.
+    """
+
+    def __init__(self, max_size: int = 64, ttl_seconds: float = 900):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, CachedAgent] = OrderedDict()
+        # The latest log of every agent still alive, cached or not, so an agent
+        # dropped from the cache mid-turn still saves on top of what it loaded
+        self._logs: weakref.WeakKeyDictionary["Agent", SessionLog] = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> CachedAgent | None:
+        """Returns the cached agent for a session, or None if absent or expired."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.cached_at >= self.ttl_seconds:
+                logger.info(f"Cached agent for session {session_id} expired")
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return entry
+
+    def checkout(self, session_id: str) -> CachedAgent | None:
+        """Like `get`, and marks the agent in use. Returns None if another request is using it."""
+        entry = self.get(session_id)
+        with self._lock:
+            if entry is None or entry.in_use or self._entries.get(session_id) is not entry:
+                return None
+            entry.in_use = True
+            return entry
+
+    def checkin(self, session_id: str, agent: "Agent"):
+        """Marks the session's agent free again, if it is still the cached one."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry.agent is agent:
+                entry.in_use = False
+
+    def put(self, session_id: str, agent: "Agent", log: SessionLog, in_use: bool | None = None):
+        """
+        Stores (or refreshes) the agent for a session, evicting the least recently used.
+        Unless `in_use` is given, a refreshed agent stays in use if it was.
+        """
+        with self._lock:
+            if in_use is None:
+                previous = self._entries.get(session_id)
+                in_use = previous is not None and previous.agent is agent and previous.in_use
+            self._entries[session_id] = CachedAgent(agent, log, in_use)
+            self._logs[agent] = log
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                logger.info(f"Evicted cached agent for session {evicted}")
+
+    def log_of(self, agent: "Agent") -> SessionLog | None:
+        """The session log the agent was last loaded or saved with, even if it is no longer cached."""
+        with self._lock:
+            return self._logs.get(agent)
+
+    def invalidate(self, session_id: str):
+        """Drops the cached agent for a session, if any."""
+        with self._lock:
+            self._entries.pop(session_id, None)
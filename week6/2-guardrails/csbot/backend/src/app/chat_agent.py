@@ -0,0 +1,183 @@
+"""
+The csbot agent: its model, tools and prompt, built once per container, and
+`new_agent`, which creates the agent of a request around them.
+
+This is the only module that needs strands, the heaviest import of the app,
+so main.py imports it on first use rather than at startup (see startup.py).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+from botocore.config import Config as BotocoreConfig
+from strands import Agent, tool
+from strands.handlers.tool_handler import AgentToolHandler
+from strands.models import BedrockModel
+from strands.tools.registry import ToolRegistry
+
+from conversation import FoldingConversationManager, move_summary_to_messages
+from dummy_trips import wait_for_dummy_trips
+from flight import Flight, PaymentStatus
+from prompt_cache import add_cache_points, record_usage
+from request_metrics import current_metrics
+from trip import FullTrip, Trip
+
+logger = logging.getLogger(__name__)
+
+model_id = os.environ.get("MODEL_ID", "")
+guardrail_id = os.environ.get("GUARDRAIL_ID", "")
+guardrail_version = os.environ.get("GUARDRAIL_VERSION", "DRAFT")
+
+
+class SharedToolPool(ThreadPoolExecutor):
+    """
+    Runs the tool calls of every agent. An agent shuts its pool down when it is
+    garbage collected (e.g. evicted from the agent cache), which must not stop
+    the pool the other agents are still using.
+    """
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        pass
+
+
+# The tools wait on DynamoDB rather than the CPU, so run the tool uses of one
+# model response concurrently however many CPUs the container reports
+tool_executor = SharedToolPool(max_workers=int(os.environ.get("TOOL_CONCURRENCY", "16")))
+# Keeps the latest turns within a token budget and folds older ones into a
+# summary, keeping the trip and flight ids they mentioned (see conversation.py)
+conversation_manager = FoldingConversationManager(
+    token_budget=int(os.environ.get("HISTORY_TOKEN_BUDGET", "2000")),
+    should_truncate_results=True, # Enable truncating the tool result when a message is too large for the model's context window 
+)
+system_prompt = """
+You are a customer service assistant for FlightAI. You should be polite, reserved and helpful.
+
+You can discuss customer's trips and explain our policies.
+You can also give more general flight related tips from your knowledge.
+
+A trip is made up of one or more flights. You can look up trips using `list_trips`, and find details
+for a specific trips using the `flights_for_trip` function.
+
+Refunds are only available on tickets labelled 'Economy fully refundable'. Refunds are not allowed on 'Basic Economy' tickets.
+If the customer asks for a refund on a basic economy ticket you must politely but firmly decline.
+If a ticket is 'Economy fully refundable' you should use the `cancel_flight` fuction to cancel it if requested.
+"""
+
+# The user is bound to each agent through its state, rather than a module-level
+# variable, so concurrent requests in one process can't see each other's data.
+# Strands passes the invoking agent to tools that declare an `agent` parameter.
+def user_id_for(agent: Agent) -> str:
+    user_id = agent.state.get("user_id")
+    # A new user's trips may still be being created
+    wait_for_dummy_trips(user_id)
+    return user_id
+
+@tool
+def t_list_trips(agent: Agent) -> list[dict]:
+    """List trips for the user
+    """
+    user_id = user_id_for(agent)
+    logger.info(f"Fetching trips for user {user_id}")
+    trips = Trip.list_for_user(user_id)
+    logger.info(f"Found {len(trips)} trips for user {user_id}")
+    return trips
+
+@tool
+def t_flights_for_trip(trip_id: str, agent: Agent) -> FullTrip:
+    """Get all flights for a given trip
+
+    Args:
+      trip_id: The ID of the trip to get flights for (starts T#)
+    """
+    user_id = user_id_for(agent)
+    logger.info(f"Fetching flights for trip {trip_id} for user {user_id}")
+    return Trip.get_full_trip(user_id, trip_id)
+
+@tool
+def t_refund_flight(trip_id: str, flight_id: str, agent: Agent) -> str:
+    """Cancel a flight and refund the customer
+
+    Args:
+      trip_id: The ID of the trip the flight is associated with (starts T#)
+      flight_id: The ID of the flight to refund (starts F#)
+    """
+    user_id = user_id_for(agent)
+    logger.info(f"Attempting to cancel flight {flight_id} for user {user_id}")
+    # A flight is refunded at most once, so every refund of it is the same update;
+    # a repeated tool call gets the first one's answer without writing again
+    update = Flight.update_payment_status(
+        user_id, trip_id, flight_id, payment_status=PaymentStatus.REFUNDED, idempotency_key=f"refund#{flight_id}"
+    )
+    if update.updated or update.replayed:
+        return f"Flight {flight_id} refunded"
+    if update.payment_status != PaymentStatus.PAID:
+        return f"Flight {flight_id} was not refunded, its payment is already {update.payment_status.value}"
+    return f"Flight {flight_id} was not refunded, '{update.ticket_type.value}' tickets are not refundable"
+
+class SharedToolRegistry(ToolRegistry):
+    """
+    The tool registry of every agent. The tools are registered, and their specs
+    normalised and validated, once per container instead of for each new agent
+    and each model call.
+    """
+
+    def __init__(self, tools: list):
+        super().__init__()
+        self.process_tools(tools)
+        self._tool_config = super().initialize_tool_config()
+
+    def initialize_tool_config(self):
+        return self._tool_config
+
+
+class CachingBedrockModel(BedrockModel):
+    """
+    Marks the tool specs, the system prompt and the conversation so far as
+    cacheable, and records the cache's use per request (see prompt_cache.py).
+    """
+
+    def format_request(self, messages, tool_specs=None, system_prompt=None):
+        request = super().format_request(messages, tool_specs, system_prompt)
+        return add_cache_points(request)
+
+    async def stream(self, request):
+        async for event in super().stream(request):
+            record_usage(event)
+            yield event
+
+
+tool_registry = SharedToolRegistry([t_list_trips, t_flights_for_trip, t_refund_flight])
+tool_handler = AgentToolHandler(tool_registry=tool_registry)
+# One Bedrock client for every agent; boto3 clients are thread-safe
+bedrock_model = CachingBedrockModel(
+    model_id=model_id,
+    guardrail_id=guardrail_id,
+    guardrail_version=guardrail_version,
+    guardrail_trace="enabled",
+    # Enough connections for concurrent streams not to queue for one
+    boto_client_config=BotocoreConfig(max_pool_connections=int(os.environ.get("BEDROCK_MAX_CONNECTIONS", "50"))),
+)
+
+
+def new_agent(user_id: str, messages: list | None = None, prompt: str | None = system_prompt) -> Agent:
+    """
+    Creates an agent for a request around the model, tools and tool pool built
+    once per container, so all it holds of its own is the conversation and state.
+    """
+    # Sessions folded before kept their summary in the system prompt
+    prompt, messages = move_summary_to_messages(prompt, messages or [])
+    with current_metrics().phase("AgentConstruction"):
+        agent = Agent(
+            model=bedrock_model,
+            messages=messages,
+            system_prompt=prompt,
+            conversation_manager=conversation_manager,
+            tools=[],  # the shared registry is set below
+            load_tools_from_directory=False,  # no scan or watcher of ./tools per agent
+            state={"user_id": user_id},
+            max_parallel_tools=1,  # don't create a pool per agent, the shared one is set below
+        )
+    agent.thread_pool = tool_executor
+    agent.tool_registry = tool_registry
+    agent.tool_handler = tool_handler
+    return agent
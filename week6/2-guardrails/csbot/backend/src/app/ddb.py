@@ -0,0 +1,39 @@
+"""
+The DynamoDB table trips and flights are stored in.
+
+Its boto3 resource is created on first use rather than at import, so it
+isn't on the path of requests that don't need it (see startup.py), and
+shared by trip.py and flight.py instead of one each.
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+DDB_TABLE = os.environ.get("DDB_TABLE")
+if not DDB_TABLE:
+    logger.error("DDB_TABLE environment variable not set.")
+    raise ValueError("DDB_TABLE environment variable not set.")
+
+_table = None
+# Tool calls run concurrently and boto3 sessions can't create resources from several threads
+_lock = threading.Lock()
+
+
+def table():
+    """Returns the table's boto3 resource; its `meta.client` is the low-level client."""
+    global _table
+    if _table is None:
+        with _lock:
+            if _table is None:
+                import boto3
+                from botocore.config import Config
+
+                dynamodb = boto3.resource(
+                    "dynamodb",
+                    # Tool calls run concurrently, give them enough connections to not wait on each other
+                    config=Config(max_pool_connections=int(os.environ.get("DDB_MAX_POOL_CONNECTIONS", "32"))),
+                )
+                _table = dynamodb.Table(DDB_TABLE)
+    return _table
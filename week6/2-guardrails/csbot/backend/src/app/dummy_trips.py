@@ -0,0 +1,147 @@
+"""
+Sample trips for new users, so there is something to chat about.
+
+They are written in the background while the first page loads; anything that
+reads a user's trips calls `wait_for_dummy_trips` first.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import logging
+import threading
+import time
+
+from flight import Flight, TicketType
+from trip import Trip
+
+logger = logging.getLogger(__name__)
+
+seeding_executor = ThreadPoolExecutor(max_workers=4)
+seeding: dict[str, Future] = {}
+seeding_lock = threading.Lock()
+# Times a new user's trips are written before giving up, and the wait between tries
+SEED_ATTEMPTS = 3
+SEED_RETRY_SECONDS = 0.2
+
+
+def create_dummy_trips(user_id: str):
+    """Creates some sample trips for a new user."""
+    logger.info(f"Creating dummy trips for new user {user_id}")
+    # Trip 1: Nana's 80th
+    nana_trip = Trip(user_id=user_id, name="Nana's 80th")
+    nana_trip_id = nana_trip.trip_id
+
+    # Flights for Nana's 80th
+    flight1_nana = Flight(
+        user_id=user_id,
+        trip_id=nana_trip_id,
+        from_airport="MUC",
+        to_airport="ICN",
+        departure_time=datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc),
+        arrival_time=datetime(2024, 6, 1, 23, 0, tzinfo=timezone.utc),
+        price=Decimal("800.00"),
+        ticket_type=TicketType.BASIC_ECONOMY,
+    )
+
+    flight2_nana = Flight(
+        user_id=user_id,
+        trip_id=nana_trip_id,
+        from_airport="ICN",
+        to_airport="MUC",
+        departure_time=datetime(2024, 6, 8, 12, 0, tzinfo=timezone.utc),
+        arrival_time=datetime(2024, 6, 8, 23, 0, tzinfo=timezone.utc),
+        price=Decimal("850.00"),
+        ticket_type=TicketType.BASIC_ECONOMY,
+    )
+
+    # Trip 2: Summer weekend
+    summer_trip = Trip(user_id=user_id, name="Summer weekend")
+    summer_trip_id = summer_trip.trip_id
+
+    # Dates for Summer weekend: Friday in two weeks from 2025-07-08 (a fixed date for predictability), and Monday after
+    base_date = datetime(2025, 7, 8, tzinfo=timezone.utc)
+    in_two_weeks = base_date + timedelta(weeks=2)
+    days_to_friday = (4 - in_two_weeks.weekday() + 7) % 7
+    friday_date = in_two_weeks + timedelta(days=days_to_friday)
+    monday_date = friday_date + timedelta(days=3)
+
+    # Flights for Summer weekend
+    flight1_summer = Flight(
+        user_id=user_id,
+        trip_id=summer_trip_id,
+        from_airport="MUC",
+        to_airport="NCE",
+        departure_time=friday_date.replace(
+            hour=18, minute=0, second=0, microsecond=0
+        ),
+        arrival_time=friday_date.replace(
+            hour=19, minute=30, second=0, microsecond=0
+        ),
+        price=Decimal("250.00"),
+        ticket_type=TicketType.BASIC_ECONOMY,
+    )
+
+    flight2_summer = Flight(
+        user_id=user_id,
+        trip_id=summer_trip_id,
+        from_airport="NCE",
+        to_airport="MUC",
+        departure_time=monday_date.replace(
+            hour=20, minute=0, second=0, microsecond=0
+        ),
+        arrival_time=monday_date.replace(
+            hour=21, minute=30, second=0, microsecond=0
+        ),
+        price=Decimal("275.00"),
+        ticket_type=TicketType.BASIC_ECONOMY,
+    )
+
+    # One transaction instead of a conditional put per trip and flight
+    Trip.save_with_flights(
+        [nana_trip, summer_trip],
+        [flight1_nana, flight2_nana, flight1_summer, flight2_summer],
+    )
+    logger.info(f"Created trips \"Nana's 80th\" and 'Summer weekend' for user {user_id}")
+
+
+def seed_dummy_trips(user_id: str):
+    """Creates the sample trips, trying again if writing them failed. Raises the last error."""
+    for attempt in range(1, SEED_ATTEMPTS + 1):
+        try:
+            create_dummy_trips(user_id)
+            return
+        except Exception as e:
+            # A failed transaction wrote none of the trips, so they can be written again
+            if attempt == SEED_ATTEMPTS:
+                logger.error(f"Failed to create dummy trips for user {user_id}: {e}")
+                raise
+            logger.warning(f"Creating dummy trips for user {user_id} failed ({e}), retrying")
+            time.sleep(SEED_RETRY_SECONDS * attempt)
+
+
+def start_dummy_trips(user_id: str):
+    """Creates the sample trips in the background, so a new session doesn't wait for them."""
+    seeding[user_id] = seeding_executor.submit(seed_dummy_trips, user_id)
+
+
+def wait_for_dummy_trips(user_id: str):
+    """
+    Blocks until the sample trips for a new user, if any are being created,
+    exist. Raises the error if they couldn't be created, and starts creating
+    them again, which the next call waits for.
+    """
+    future = seeding.get(user_id)
+    if future is None:
+        return
+    try:
+        future.result()
+    except Exception:
+        with seeding_lock:
+            # Only the first caller to see the failure retries, the others raise it too
+            if seeding.get(user_id) is future:
+                logger.warning(f"Creating dummy trips for user {user_id} again")
+                seeding[user_id] = seeding_executor.submit(seed_dummy_trips, user_id)
+        raise
+    with seeding_lock:
+        if seeding.get(user_id) is future:
+            del seeding[user_id]
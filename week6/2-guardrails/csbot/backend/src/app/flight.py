@@ -1,23 +1,30 @@
 import logging
 import os
+import random
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 from decimal import Decimal
 from enum import Enum
 
-import boto3
+from boto3.dynamodb.types import TypeDeserializer
 from botocore.exceptions import ClientError
 from pydantic import BaseModel, Field, constr
 
+from ddb import DDB_TABLE, table
+from trip_cache import trip_cache
+
 logger = logging.getLogger(__name__)
 
-DDB_TABLE = os.environ.get("DDB_TABLE")
-if not DDB_TABLE:
-    logger.error("DDB_TABLE environment variable not set.")
-    raise ValueError("DDB_TABLE environment variable not set.")
 
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(DDB_TABLE)
+
+# A new flight must not overwrite an existing one
+SAVE_CONDITION = "attribute_not_exists(SK)"
+
+
+def json_datetime(value: str) -> str:
+    """Turns a datetime stored with `isoformat()` into the form Pydantic serializes it to."""
+    return value[:-6] + "Z" if value.endswith("+00:00") else value
 
 
 class TicketType(str, Enum):
@@ -31,6 +38,42 @@ class PaymentStatus(str, Enum):
     REFUNDED = "refunded"
 
 
+# For each status a payment can be changed to, the status it must have and the ticket types it is allowed for
+PAYMENT_TRANSITIONS: dict[PaymentStatus, tuple[PaymentStatus, tuple[TicketType, ...]]] = {
+    PaymentStatus.REFUNDED: (PaymentStatus.PAID, (TicketType.ECONOMY_FULLY_REFUNDABLE,)),
+    PaymentStatus.CANCELLED: (PaymentStatus.PAID, tuple(TicketType)),
+}
+# How long the idempotency key of a payment update is remembered; DynamoDB's TTL deletes it after
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_DAYS", "7")) * 24 * 3600
+# Whether flights may still be under their legacy key. Set to "false" once
+# scripts/backfill_flight_layout.py --delete-legacy has removed them all, so a
+# trip and its flights are read with one query
+READ_LEGACY_FLIGHTS = os.environ.get("READ_LEGACY_FLIGHTS", "true").lower() == "true"
+# Seconds before retrying a transaction that conflicted with another, doubled on each retry
+TRANSACTION_RETRY_DELAY = 0.05
+# Errors aren't decoded like responses by the table resource's client
+deserializer = TypeDeserializer()
+
+
+class PaymentUpdate(BaseModel):
+    """
+    The outcome of a payment status update. `payment_status` is the flight's status
+    afterwards: the new one if this update changed it (`updated`) or an update with
+    the same idempotency key already did (`replayed`), otherwise the status it kept,
+    and then `ticket_type` is the flight's ticket type.
+    """
+    flight_id: str
+    payment_status: PaymentStatus
+    updated: bool = False
+    replayed: bool = False
+    ticket_type: TicketType | None = None
+
+
+def decode_item(item: dict | None) -> dict | None:
+    """Decodes an item returned with an error, which is left in DynamoDB's typed form."""
+    return {name: deserializer.deserialize(value) for name, value in item.items()} if item else None
+
+
 class Flight(BaseModel):
     trip_id: str
     from_airport: constr(min_length=3, max_length=3)
@@ -41,30 +84,99 @@ class Flight(BaseModel):
     ticket_type: TicketType
     payment_status: PaymentStatus = PaymentStatus.PAID
     flight_id: str = Field(default_factory=lambda: f"F#{uuid.uuid4()}")
+    # Flights are stored in their user's partition, but the user isn't part of
+    # what we return for a flight
+    user_id: str | None = Field(default=None, exclude=True)
 
-    def save(self) -> str:
-        """Saves a new flight to DynamoDB."""
+    @staticmethod
+    def key(user_id: str, trip_id: str, flight_id: str) -> dict:
+        """
+        Returns the DynamoDB key of a flight. Flights sort directly after their trip
+        in the user's partition, so one query returns a trip and all its flights.
+        """
+        return {"PK": f"U#{user_id}", "SK": f"{trip_id}#{flight_id}"}
+
+    @staticmethod
+    def legacy_key(trip_id: str, flight_id: str) -> dict:
+        """Returns the key flights had before they moved into the user's partition."""
+        return {"PK": trip_id, "SK": flight_id}
+
+    @staticmethod
+    def ids_from_item(item: dict) -> tuple[str | None, str, str]:
+        """Returns the user, trip and flight ids of an item in either the current or the legacy layout."""
+        if item["PK"].startswith("U#"):
+            trip_id, flight_id = item["SK"].split("#F#", 1)
+            return item["PK"][2:], trip_id, f"F#{flight_id}"
+        return None, item["PK"], item["SK"]
+
+    @staticmethod
+    def from_item(item: dict) -> "Flight":
+        """Builds a flight from a DynamoDB item in either the current or the legacy layout."""
+        user_id, trip_id, flight_id = Flight.ids_from_item(item)
+        return Flight(
+            user_id=user_id,
+            trip_id=trip_id,
+            flight_id=flight_id,
+            from_airport=item["FromAirport"],
+            to_airport=item["ToAirport"],
+            departure_time=item["DepartureTime"],
+            arrival_time=item["ArrivalTime"],
+            price=item["Price"],
+            ticket_type=item["TicketType"],
+            payment_status=item["PaymentStatus"],
+        )
+
+    @staticmethod
+    def json_from_item(item: dict) -> dict:
+        """
+        Decodes an item written by `to_item` straight into the JSON form of the
+        flight, the same as `model_dump(mode="json")`, without validating it again.
+        Only use it for items read back from our own table.
+        """
+        _, trip_id, flight_id = Flight.ids_from_item(item)
+        return {
+            "trip_id": trip_id,
+            "from_airport": item["FromAirport"],
+            "to_airport": item["ToAirport"],
+            "departure_time": json_datetime(item["DepartureTime"]),
+            "arrival_time": json_datetime(item["ArrivalTime"]),
+            "price": str(item["Price"]),
+            "ticket_type": item["TicketType"],
+            "payment_status": item["PaymentStatus"],
+            "flight_id": flight_id,
+        }
+
+    def to_item(self) -> dict:
+        """Returns the DynamoDB item for this flight."""
         if not self.trip_id.startswith("T#"):
             msg = f"trip_id '{self.trip_id}' must be prefixed with 'T#'"
             logger.error(msg)
             raise ValueError(msg)
+        if not self.user_id:
+            msg = f"Flight {self.flight_id} has no user_id"
+            logger.error(msg)
+            raise ValueError(msg)
 
+        return {
+            **Flight.key(self.user_id, self.trip_id, self.flight_id),
+            "Type": "Flight",
+            "FromAirport": self.from_airport,
+            "ToAirport": self.to_airport,
+            "DepartureTime": self.departure_time.isoformat(),
+            "ArrivalTime": self.arrival_time.isoformat(),
+            "Price": self.price,
+            "TicketType": self.ticket_type.value,
+            "PaymentStatus": self.payment_status.value,
+        }
+
+    def save(self) -> str:
+        """Saves a new flight to DynamoDB."""
+        item = self.to_item()
         logger.info(f"Saving flight {self.flight_id} for trip {self.trip_id}")
         try:
-            table.put_item(
-                Item={
-                    "PK": self.trip_id,
-                    "SK": self.flight_id,
-                    "Type": "Flight",
-                    "FromAirport": self.from_airport,
-                    "ToAirport": self.to_airport,
-                    "DepartureTime": self.departure_time.isoformat(),
-                    "ArrivalTime": self.arrival_time.isoformat(),
-                    "Price": self.price,
-                    "TicketType": self.ticket_type.value,
-                    "PaymentStatus": self.payment_status.value,
-                },
-                ConditionExpression="attribute_not_exists(SK)",
+            table().put_item(
+                Item=item,
+                ConditionExpression=SAVE_CONDITION,
             )
             logger.info(f"Successfully saved flight {self.flight_id}")
             return self.flight_id
@@ -78,24 +190,154 @@ class Flight(BaseModel):
             else:
                 logger.error(f"Error saving flight {self.flight_id}: {e}")
                 raise
+        finally:
+            trip_cache.invalidate(self.user_id, ("trip", self.trip_id))
 
     @staticmethod
-    def update_payment_status(trip_id: str, flight_id: str, payment_status: PaymentStatus):
-        """Updates the payment status of a flight."""
+    def update_payment_status(
+        user_id: str,
+        trip_id: str,
+        flight_id: str,
+        payment_status: PaymentStatus,
+        idempotency_key: str | None = None,
+    ) -> PaymentUpdate:
+        """
+        Changes the payment status of a flight, in one conditional write, if
+        `PAYMENT_TRANSITIONS` allows it from its current status and for its ticket
+        type. Otherwise, e.g. for a Basic Economy ticket or one that is already
+        refunded, nothing is written and the flight's current status is returned.
+
+        With an `idempotency_key`, a record of the key is written in the same
+        transaction. Updating with the key again, e.g. a retried or duplicated tool
+        call, only fails that record's condition and returns what the first did.
+        """
+        if payment_status not in PAYMENT_TRANSITIONS:
+            msg = f"Payment status can't be changed to {payment_status.value}."
+            logger.error(msg)
+            raise ValueError(msg)
         logger.info(f"Updating payment status for flight {flight_id} in trip {trip_id} to {payment_status.value}")
-        try:
-            table.update_item(
-                Key={"PK": trip_id, "SK": flight_id},
-                UpdateExpression="SET PaymentStatus = :s",
-                ExpressionAttributeValues={":s": payment_status.value},
-                ConditionExpression="attribute_exists(PK) and attribute_exists(SK)",
-            )
-            logger.info(f"Successfully updated payment status for flight {flight_id}")
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                msg = f"Flight {flight_id} not found for trip {trip_id}."
-                logger.warning(msg)
-                raise ValueError(msg) from e
-            else:
-                logger.error(f"Error updating payment status for flight {flight_id}: {e}")
+        from_status, ticket_types = PAYMENT_TRANSITIONS[payment_status]
+        update = {
+            "UpdateExpression": "SET PaymentStatus = :to",
+            "ConditionExpression": (
+                "attribute_exists(SK) AND PaymentStatus = :from AND TicketType IN ("
+                + ", ".join(f":t{i}" for i in range(len(ticket_types))) + ")"
+            ),
+            "ExpressionAttributeValues": {
+                ":to": payment_status.value,
+                ":from": from_status.value,
+                **{f":t{i}": ticket_type.value for i, ticket_type in enumerate(ticket_types)},
+            },
+            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+        }
+        keys = [Flight.key(user_id, trip_id, flight_id)]
+        if READ_LEGACY_FLIGHTS:
+            # Flights not yet moved by the backfill are still under their legacy key
+            keys.append(Flight.legacy_key(trip_id, flight_id))
+        for key in keys:
+            try:
+                if idempotency_key is None:
+                    table().update_item(Key=key, **update)
+                else:
+                    Flight.transact_write([
+                        {
+                            "Put": {
+                                "TableName": DDB_TABLE,
+                                "Item": Flight.idempotency_item(
+                                    user_id, trip_id, flight_id, payment_status, idempotency_key
+                                ),
+                                "ConditionExpression": "attribute_not_exists(SK)",
+                                "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+                            }
+                        },
+                        {"Update": {"TableName": DDB_TABLE, "Key": key, **update}},
+                    ])
+            except ClientError as e:
+                used, flight_item = Flight.failed_conditions(e)
+                if used is not None:
+                    if used["FlightId"] != flight_id or used["PaymentStatus"] != payment_status.value:
+                        msg = f"Idempotency key {idempotency_key} was already used for another update."
+                        logger.error(msg)
+                        raise ValueError(msg) from e
+                    logger.info(f"Payment status of flight {flight_id} was already updated with key {idempotency_key}")
+                    return PaymentUpdate(flight_id=flight_id, payment_status=payment_status, replayed=True)
+                if flight_item is None:
+                    continue
+                logger.warning(
+                    f"Not updating payment status of {flight_item['TicketType']} flight {flight_id} "
+                    f"from {flight_item['PaymentStatus']} to {payment_status.value}"
+                )
+                return PaymentUpdate(
+                    flight_id=flight_id,
+                    payment_status=flight_item["PaymentStatus"],
+                    ticket_type=flight_item["TicketType"],
+                )
+            except Exception:
+                # Whether the update happened is unknown
+                trip_cache.invalidate(user_id, ("trip", trip_id))
                 raise
+            trip_cache.invalidate(user_id, ("trip", trip_id))
+            logger.info(f"Successfully updated payment status for flight {flight_id}")
+            return PaymentUpdate(flight_id=flight_id, payment_status=payment_status, updated=True)
+        msg = f"Flight {flight_id} not found for trip {trip_id}."
+        logger.warning(msg)
+        raise ValueError(msg)
+
+    @staticmethod
+    def transact_write(items: list[dict], attempts: int = 3):
+        """
+        Writes a transaction, retrying with backoff when it conflicted with another
+        transaction on the same items, e.g. the same update made twice at once, which
+        the retry then finds already done.
+        """
+        for attempt in range(1, attempts + 1):
+            try:
+                # The resource's client accepts plain Python values, like table.update_item
+                return table().meta.client.transact_write_items(TransactItems=items)
+            except ClientError as e:
+                codes = {reason.get("Code") for reason in e.response.get("CancellationReasons", [])}
+                if attempt == attempts or "TransactionConflict" not in codes or "ConditionalCheckFailed" in codes:
+                    raise
+                time.sleep(TRANSACTION_RETRY_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    @staticmethod
+    def idempotency_item(
+        user_id: str, trip_id: str, flight_id: str, payment_status: PaymentStatus, idempotency_key: str
+    ) -> dict:
+        """
+        Returns the record of a payment update's idempotency key. It is kept in the
+        user's partition, out of the T# prefix trips and flights are read from, until
+        DynamoDB's TTL deletes it.
+        """
+        return {
+            "PK": f"U#{user_id}",
+            "SK": f"R#{idempotency_key}",
+            "Type": "Idempotency",
+            "TripId": trip_id,
+            "FlightId": flight_id,
+            "PaymentStatus": payment_status.value,
+            "CreatedAt": datetime.now(timezone.utc).isoformat(),
+            "ExpiresAt": int(time.time()) + IDEMPOTENCY_TTL_SECONDS,
+        }
+
+    @staticmethod
+    def failed_conditions(e: ClientError) -> tuple[dict | None, dict | None]:
+        """
+        For a payment update whose condition failed, returns the idempotency record
+        that already existed, if that was what failed, and the flight's item, or None
+        if there is none under the key. Raises any other error again.
+        """
+        code = e.response["Error"]["Code"]
+        if code == "ConditionalCheckFailedException":
+            return None, decode_item(e.response.get("Item"))
+        reasons = e.response.get("CancellationReasons", [])
+        if code == "TransactionCanceledException" and any(
+            reason.get("Code") == "ConditionalCheckFailed" for reason in reasons
+        ):
+            used, flight_item = (
+                decode_item(reason.get("Item")) if reason.get("Code") == "ConditionalCheckFailed" else None
+                for reason in reasons
+            )
+            return used, flight_item
+        logger.error(f"Error updating payment status: {e}")
+        raise e
@@ -1,26 +1,31 @@
 from botocore.exceptions import ClientError
 from fastapi import Cookie, FastAPI, Request, Response
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from strands import Agent, tool
-from strands.agent.conversation_manager import SlidingWindowConversationManager
-from strands.models import BedrockModel
-from trip import FullTrip, Trip
-from flight import Flight, PaymentStatus, TicketType
-from datetime import datetime, timedelta, timezone
-from decimal import Decimal
+from agent_cache import AgentCache
+from dummy_trips import start_dummy_trips, wait_for_dummy_trips
+from request_metrics import MetricsMiddleware, background, current_metrics, snapshot
+from session_codec import get_codec
+from session_store import SessionLog, SessionStore
+from session_writer import SessionWriter
+from stream_encoder import SSEEncoder
+from transcript import INTERRUPTED_REPLY, RESUME_PROMPT
+from trip import TRIPS_PAGE_SIZE, Trip
+from trip_cache import trip_cache
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
 import boto3
 import json
 import logging
 import os
-import requests
+import startup
 import uuid
-import uvicorn
 
-model_id = os.environ.get("MODEL_ID", "")
+if TYPE_CHECKING:
+    from strands import Agent
+
 state_bucket = os.environ.get("STATE_BUCKET", "")
-guardrail_id = os.environ.get("GUARDRAIL_ID", "")
-guardrail_version = os.environ.get("GUARDRAIL_VERSION", "DRAFT")
 logging.getLogger("strands").setLevel(logging.DEBUG)
 logging.basicConfig(
     format="%(levelname)s | %(name)s | %(message)s", 
@@ -30,57 +35,21 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logger.info("Logger initialized")
 s3_client = boto3.client("s3")
-conversation_manager = SlidingWindowConversationManager(
-    window_size=4,  # Maximum number of messages to keep
-    should_truncate_results=True, # Enable truncating the tool result when a message is too large for the model's context window 
+session_store = SessionStore(
+    s3_client,
+    state_bucket,
+    compact_every=int(os.environ.get("SESSION_COMPACT_EVERY", "16")),
+    codec=get_codec(os.environ.get("SESSION_CODEC", "msgpack+zstd")),
+)
+agent_cache = AgentCache(
+    max_size=int(os.environ.get("AGENT_CACHE_SIZE", "64")),
+    ttl_seconds=float(os.environ.get("AGENT_CACHE_TTL_SECONDS", "900")),
+)
+session_writer = SessionWriter(
+    # If a save keeps failing, the next load reads whatever made it to S3
+    on_failure=lambda session_id, error: agent_cache.invalidate(session_id),
+    max_attempts=int(os.environ.get("SESSION_SAVE_ATTEMPTS", "4")),
 )
-system_prompt = """
-You are a customer service assistant for FlightAI. You should be polite, reserved and helpful.
-
-You can discuss customer's trips and explain our policies.
-You can also give more general flight related tips from your knowledge.
-
-A trip is made up of one or more flights. You can look up trips using `list_trips`, and find details
-for a specific trips using the `flights_for_trip` function.
-
-Refunds are only available on tickets labelled 'Economy fully refundable'. Refunds are not allowed on 'Basic Economy' tickets.
-If the customer asks for a refund on a basic economy ticket you must politely but firmly decline.
-If a ticket is 'Economy fully refundable' you should use the `cancel_flight` fuction to cancel it if requested.
-"""
-current_user_id = ""
-
-@tool
-def t_list_trips() -> list[dict]:
-    """List trips for the user
-    """
-
-    logger.info(f"Fetching trips for user {current_user_id}")
-    trips = Trip.list_for_user(current_user_id)
-    logger.info(f"Found {len(trips)} trips for user {current_user_id}")
-    return trips
-
-@tool
-def t_flights_for_trip(trip_id: str) -> FullTrip:
-    """Get all flights for a given trip
-
-    Args:
-      trip_id: The ID of the trip to get flights for (starts T#)
-    """
-    logger.info(f"Fetching flights for trip {trip_id} for user {current_user_id}")
-    return Trip.get_full_trip(current_user_id, trip_id)
-
-@tool
-def t_refund_flight(trip_id: str, flight_id: str) -> str:
-    """Cancel a flight and refund the customer
-
-    Args:
-      trip_id: The ID of the trip the flight is associated with (starts T#)
-      flight_id: The ID of the flight to refund (starts F#)
-    """
-    logger.info(f"Attempting to cancel flight {flight_id} for user {current_user_id}")
-    Flight.update_payment_status(trip_id, flight_id, payment_status=PaymentStatus.REFUNDED)
-    return f"Flight {flight_id} refunded"
-
 class ChatRequest(BaseModel):
     prompt: str
 
@@ -89,197 +58,236 @@ class RenameTripRequest(BaseModel):
     name: str
 
 
-def SaveHistory(agent: Agent, session_id: str):
-    state = {
-        "messages": agent.messages,
-        "system_prompt": agent.system_prompt,
-    }
-    # Serialize the state to JSON
-    state_json = json.dumps(state, indent=2)
-    s3_key = f"sessions/{session_id}.json"
+def SaveHistory(agent: "Agent", session_id: str, messages: list | None = None, in_use: bool | None = None):
+    """
+    Saves the agent's session. A queued save passes the `messages` as they were
+    when the turn ended, as the agent may have moved on by the time it runs.
+    `in_use` marks the cached agent as checked out (see agent_cache.py).
+    """
+    snapshot = messages is not None
+    if messages is None:
+        messages = agent.messages
+    # Only the messages added since the agent's last load/save are uploaded,
+    # on top of the session as it was then (see session_store.py)
+    cached = agent_cache.get(session_id)
+    current = cached is not None and cached.agent is agent
+    log = agent_cache.log_of(agent)
     try:
-        # Upload to S3
-        s3_client.put_object(
-            Bucket=state_bucket,
-            Key=s3_key,
-            Body=state_json,
-            ContentType="application/json"
-        )
+        with current_metrics().phase("SessionSave"):
+            log = session_store.save(session_id, log, agent.system_prompt, messages)
+        if log.rebased:
+            # Another writer's messages were saved first, this agent doesn't have them
+            agent_cache.invalidate(session_id)
+        # An agent dropped from the cache since the snapshot (e.g. its next turn was
+        # cancelled) holds messages that were never saved, so it mustn't come back
+        elif current or not snapshot:
+            agent_cache.put(session_id, agent, log, in_use)
         logger.info(f"Successfully saved session {session_id} to S3")
     except Exception as e:
         logger.error(f"Failed to save session {session_id} to S3: {str(e)}")
         raise
 
 
-def create_dummy_trips(user_id: str):
-    """Creates some sample trips for a new user."""
-    logger.info(f"Creating dummy trips for new user {user_id}")
-    try:
-        # Trip 1: Nana's 80th
-        nana_trip = Trip(user_id=user_id, name="Nana's 80th")
-        nana_trip_id = nana_trip.save()
-
-        # Flights for Nana's 80th
-        flight1_nana = Flight(
-            trip_id=nana_trip_id,
-            from_airport="MUC",
-            to_airport="ICN",
-            departure_time=datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc),
-            arrival_time=datetime(2024, 6, 1, 23, 0, tzinfo=timezone.utc),
-            price=Decimal("800.00"),
-            ticket_type=TicketType.BASIC_ECONOMY,
-        )
-        flight1_nana.save()
-
-        flight2_nana = Flight(
-            trip_id=nana_trip_id,
-            from_airport="ICN",
-            to_airport="MUC",
-            departure_time=datetime(2024, 6, 8, 12, 0, tzinfo=timezone.utc),
-            arrival_time=datetime(2024, 6, 8, 23, 0, tzinfo=timezone.utc),
-            price=Decimal("850.00"),
-            ticket_type=TicketType.BASIC_ECONOMY,
-        )
-        flight2_nana.save()
-        logger.info(f"Created trip \"Nana's 80th\" for user {user_id}")
-
-        # Trip 2: Summer weekend
-        summer_trip = Trip(user_id=user_id, name="Summer weekend")
-        summer_trip_id = summer_trip.save()
-
-        # Dates for Summer weekend: Friday in two weeks from 2025-07-08 (a fixed date for predictability), and Monday after
-        base_date = datetime(2025, 7, 8, tzinfo=timezone.utc)
-        in_two_weeks = base_date + timedelta(weeks=2)
-        days_to_friday = (4 - in_two_weeks.weekday() + 7) % 7
-        friday_date = in_two_weeks + timedelta(days=days_to_friday)
-        monday_date = friday_date + timedelta(days=3)
-
-        # Flights for Summer weekend
-        flight1_summer = Flight(
-            trip_id=summer_trip_id,
-            from_airport="MUC",
-            to_airport="NCE",
-            departure_time=friday_date.replace(
-                hour=18, minute=0, second=0, microsecond=0
-            ),
-            arrival_time=friday_date.replace(
-                hour=19, minute=30, second=0, microsecond=0
-            ),
-            price=Decimal("250.00"),
-            ticket_type=TicketType.BASIC_ECONOMY,
-        )
-        flight1_summer.save()
-
-        flight2_summer = Flight(
-            trip_id=summer_trip_id,
-            from_airport="NCE",
-            to_airport="MUC",
-            departure_time=monday_date.replace(
-                hour=20, minute=0, second=0, microsecond=0
-            ),
-            arrival_time=monday_date.replace(
-                hour=21, minute=30, second=0, microsecond=0
-            ),
-            price=Decimal("275.00"),
-            ticket_type=TicketType.BASIC_ECONOMY,
-        )
-        flight2_summer.save()
-        logger.info(f"Created trip 'Summer weekend' for user {user_id}")
+def QueueSaveHistory(agent: "Agent", session_id: str):
+    """Queues a save of the agent's session, to run after the response has finished."""
+    messages = list(agent.messages)
 
-    except Exception as e:
-        # Log error but don't prevent user session from being created
-        logger.error(f"Failed to create dummy trips for user {user_id}: {e}")
+    def save():
+        with background("SessionSave", SessionId=session_id):
+            SaveHistory(agent, session_id, messages)
 
+    session_writer.submit(session_id, save, key=id(agent))
 
-def LoadHistory(session_id: str) -> Agent:
-    logger.info(f"Loading session {session_id} using guardrail_id {guardrail_id} {guardrail_version}")
-    bedrock_model = BedrockModel(
-        model_id=model_id,
-        guardrail_id=guardrail_id,
-        guardrail_version=guardrail_version,
-        guardrail_trace="enabled",
+
+def QueueCheckpoint(agent: "Agent", session_id: str, turn_start: int, partial_text: str):
+    """
+    Queues a checkpoint of an interrupted turn: the messages it completed (prompt,
+    tool uses and their results) and the text streamed since, so the turn can be
+    resumed without running those again.
+    """
+    turn = agent.messages[turn_start:]
+    if not turn or turn[0]["role"] != "user" or "text" not in turn[0]["content"][0]:
+        logger.warning(f"Lost track of the interrupted turn of session {session_id}, not checkpointing it")
+        return
+    if turn[-1]["role"] == "assistant":
+        # Tool uses that never ran; the model asks for them again when resumed
+        turn = turn[:-1]
+    if len(turn) == 1 and not partial_text:
+        return  # Nothing done yet besides the prompt
+    cached = agent_cache.get(session_id)
+    if cached is None or cached.agent is not agent:
+        return  # Without the session log the turn belongs to, it couldn't be resumed safely
+    log = cached.log
+    checkpoint = {"turn": turn, "partial_text": partial_text}
+
+    def save():
+        try:
+            with background("SessionCheckpoint", SessionId=session_id) as metrics, metrics.phase("SessionSave"):
+                session_store.save_checkpoint(session_id, log, checkpoint)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("PreconditionFailed", "412"):
+                raise
+            logger.warning(f"Session {session_id} changed since the interrupted turn, dropping its checkpoint")
+
+    session_writer.submit(session_id, save, key=id(agent))
+
+
+def turn_complete(agent: "Agent") -> bool:
+    """Whether the agent's last message is a final answer rather than a request to use tools."""
+    last = agent.messages[-1]
+    return last["role"] == "assistant" and not any("toolUse" in block for block in last["content"])
+
+
+def restore_checkpoint(agent: "Agent", checkpoint: dict) -> str:
+    """Adds an interrupted turn back to the agent's messages and returns the prompt that resumes it."""
+    agent.messages.extend(checkpoint["turn"])
+    # The turn ends with the user's prompt or a tool result; the model continues
+    # after the text it had streamed when the client left
+    agent.messages.append(
+        {"role": "assistant", "content": [{"text": checkpoint["partial_text"] or INTERRUPTED_REPLY}]}
     )
-    global current_user_id
-    current_user_id = session_id
-    s3_key = f"sessions/{session_id}.json"
+    return RESUME_PROMPT
+
+
+def LoadHistory(session_id: str) -> "Agent":
+    """
+    Returns the session's agent, checked out of the agent cache: give it back
+    with `agent_cache.checkin` once done with it.
+    """
+    import chat_agent  # imported on first use, see startup.py
+    logger.info(f"Loading session {session_id} using guardrail_id {chat_agent.guardrail_id} {chat_agent.guardrail_version}")
+    metrics = current_metrics()
+    metrics.properties["SessionId"] = session_id
+    with metrics.phase("SessionLoad"):
+        # A save of the previous turn may still be on its way to S3
+        session_writer.wait(session_id)
+    # None too if another request is running a turn on the cached agent, in
+    # which case this one gets an agent of its own, built from S3
+    cached = agent_cache.checkout(session_id)
     try:
-        response = s3_client.get_object(Bucket=state_bucket, Key=s3_key)
-        state_json = response['Body'].read().decode('utf-8')
-        state = json.loads(state_json)
+        with metrics.phase("SessionLoad"):
+            # Conditional GET: S3 answers 304 without a body if our copy is current
+            log = session_store.load(session_id, if_none_match=cached.log.etag if cached else None)
         logger.info(f"Successfully loaded session {session_id} from S3")
-        return Agent(
-            model=bedrock_model,
-            messages=state.get("messages"),
-            system_prompt=state.get("system_prompt"),
-            conversation_manager=conversation_manager,
-            tools=[t_list_trips, t_flights_for_trip, t_refund_flight],
-        )
+        agent = chat_agent.new_agent(session_id, log.messages, log.system_prompt)
+        agent_cache.put(session_id, agent, log, in_use=True)
+        return agent
     except ClientError as e:
+        if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+            logger.info(f"Session {session_id} unchanged, using cached agent")
+            return cached.agent
         if e.response['Error']['Code'] == 'NoSuchKey':
             logger.info(f"Session {session_id} does not exist, creating new agent")
-            create_dummy_trips(session_id)
-            agent = Agent(
-                model=bedrock_model,
-                system_prompt=system_prompt,
-                conversation_manager=conversation_manager,
-                tools=[t_list_trips, t_flights_for_trip, t_refund_flight],
-            )
-            SaveHistory(agent, session_id)
+            agent_cache.invalidate(session_id)
+            start_dummy_trips(session_id)
+            agent = chat_agent.new_agent(session_id)
+            SaveHistory(agent, session_id, in_use=True)
             return agent
         else:
             logger.error(f"Error loading session {session_id}: {e}")
+            if cached:
+                agent_cache.checkin(session_id, cached.agent)
             raise
     except Exception as e:
         logger.error(f"Unexpected error loading session {session_id}: {e}")
+        if cached:
+            agent_cache.checkin(session_id, cached.agent)
         raise
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Builds what chat needs now or in the background, see startup.py
+    startup.begin()
+    yield
+    # Lambda sends SIGTERM before shutting the container down, give queued saves a chance
+    timeout = float(os.environ.get("SESSION_FLUSH_TIMEOUT_SECONDS", "5"))
+    if not await run_in_threadpool(session_writer.flush, timeout):
+        logger.error("Shutting down with session saves still queued")
+
+
+app = FastAPI(lifespan=lifespan)
+# Times the phases of each request, see request_metrics.py
+app.add_middleware(MetricsMiddleware)
 
 # Called by the Lambda Adapter to check liveness
 @app.get("/")
 async def root():
     return {"message": "OK"}
 
+@app.get("/debug/metrics")
+async def debug_metrics():
+    """Returns the latency of each phase of the requests this instance has served."""
+    return snapshot()
+
 @app.get('/api/chat')
 def chat_history(request: Request):
+    """
+    Returns the chat history from the session's transcript, without loading
+    the session. Answers 304 if the client's copy (by its ETag) is current.
+    """
     session_id = request.cookies.get("session_id", str(uuid.uuid4()))
-    agent = LoadHistory(session_id)
-
-    # Filter messages to only include first text content
-    filtered_messages = []
-    for message in agent.messages:
-        if (message.get("content") and 
-            len(message["content"]) > 0 and 
-            "text" in message["content"][0]):
-            filtered_messages.append({
-                "role": message["role"],
-                "content": [{
-                    "text": message["content"][0]["text"]
-                }]
-            })
- 
+    if_none_match = request.headers.get("if-none-match")
+    metrics = current_metrics()
+    metrics.properties["SessionId"] = session_id
+    try:
+        with metrics.phase("SessionLoad"):
+            # A save of the previous turn may still be on its way to S3
+            session_writer.wait(session_id)
+            body, etag = session_store.load_transcript(session_id, if_none_match=if_none_match)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            response = Response(status_code=304, headers={"ETag": if_none_match, "Cache-Control": "no-cache"})
+            response.set_cookie(key="session_id", value=session_id)
+            return response
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            logger.error(f"Error loading transcript of session {session_id}: {e}")
+            raise
+        # A new session, or one last saved before transcripts were kept
+        agent = LoadHistory(session_id)
+        agent_cache.checkin(session_id, agent)
+        cached = agent_cache.get(session_id)
+        log = cached.log if cached and cached.agent is agent else SessionLog(agent.system_prompt, agent.messages)
+        body, etag = session_store.save_transcript(session_id, log)
+        # Don't let the container be frozen while a new user's trips are being written
+        wait_for_dummy_trips(session_id)
+
     response = Response(
-        content = json.dumps({
-            "messages": filtered_messages,
-        }),
+        content=body,
         media_type="application/json",
+        # Have the browser revalidate with If-None-Match rather than guess a lifetime
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
     )
     response.set_cookie(key="session_id", value=session_id)
     return response
 
 
 @app.get('/api/trips')
-def list_trips(request: Request):
-    """Lists all trips for a user."""
+def list_trips(request: Request, cursor: str | None = None, limit: int = TRIPS_PAGE_SIZE):
+    """
+    Lists one page of a user's trips. The cursor of the next page, if any, is
+    returned in the X-Next-Cursor header.
+    """
     session_id = request.cookies.get("session_id", str(uuid.uuid4()))
     user_id = session_id
 
     try:
-        trips = Trip.list_for_user(user_id)
+        wait_for_dummy_trips(user_id)
+        trips, next_cursor = Trip.list_page(user_id, limit=limit, cursor=cursor)
         response = Response(
             content=json.dumps(trips),
             media_type="application/json",
         )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        response.set_cookie(key="session_id", value=session_id)
+        return response
+    except ValueError as e:
+        logger.warning(f"Error listing trips for user {user_id}: {e}")
+        response = Response(
+            content=json.dumps({"error": str(e)}),
+            status_code=400,
+            media_type="application/json",
+        )
         response.set_cookie(key="session_id", value=session_id)
         return response
     except Exception as e:
@@ -300,6 +308,7 @@ def rename_trip(trip_id: str, rename_request: RenameTripRequest, request: Reques
     user_id = session_id
 
     try:
+        wait_for_dummy_trips(user_id)
         Trip.update_name(user_id, trip_id, rename_request.name)
         response = Response(
             content=json.dumps({"message": "Trip renamed successfully"}),
@@ -335,9 +344,9 @@ def get_trip_details(trip_id: str, request: Request):
     user_id = session_id
 
     try:
-        trip_details = Trip.get_full_trip(user_id, trip_id)
+        wait_for_dummy_trips(user_id)
         response = Response(
-            content=trip_details.model_dump_json(),
+            content=Trip.get_full_trip_json(user_id, trip_id),
             media_type="application/json",
         )
         response.set_cookie(key="session_id", value=session_id)
@@ -366,7 +375,8 @@ def get_trip_details(trip_id: str, request: Request):
 @app.post('/api/chat')
 async def chat(chat_request: ChatRequest, request: Request):
     session_id = request.cookies.get("session_id", str(uuid.uuid4()))
-    agent = LoadHistory(session_id)
+    # Loading may wait on S3, keep the event loop free for other streams
+    agent = await run_in_threadpool(LoadHistory, session_id)
     response = StreamingResponse(
         generate(agent, session_id, chat_request.prompt, request),
         media_type="text/event-stream"
@@ -374,28 +384,92 @@ async def chat(chat_request: ChatRequest, request: Request):
     response.set_cookie(key="session_id", value=session_id)
     return response
 
-async def generate(agent: Agent, session_id: str, prompt: str, request: Request):
+@app.post('/api/chat/resume')
+async def resume_chat(request: Request):
+    """Continues the turn that was interrupted when the client disconnected."""
+    session_id = request.cookies.get("session_id", str(uuid.uuid4()))
+    agent = await run_in_threadpool(LoadHistory, session_id)
+    cached = agent_cache.get(session_id)
+    checkpoint = cached.log.checkpoint if cached and cached.agent is agent else None
+    if not checkpoint:
+        agent_cache.checkin(session_id, agent)
+        response = Response(
+            content=json.dumps({"error": "Nothing to resume"}),
+            status_code=404,
+            media_type="application/json",
+        )
+        response.set_cookie(key="session_id", value=session_id)
+        return response
+
+    turn_start = len(agent.messages)
+    prompt = restore_checkpoint(agent, checkpoint)
+    response = StreamingResponse(
+        generate(agent, session_id, prompt, request, turn_start),
+        media_type="text/event-stream"
+    )
+    response.set_cookie(key="session_id", value=session_id)
+    return response
+
+async def generate(agent: "Agent", session_id: str, prompt: str, request: Request, turn_start: int | None = None):
     generation_cancelled = False
+    # Where this turn's messages start, earlier if it resumes an interrupted turn
+    turn_start = len(agent.messages) if turn_start is None else turn_start
+    # Text streamed for the assistant message in progress, which isn't in agent.messages yet
+    partial_text = []
+    # The messages added by the stream (the prompt first) that we have had the event of.
+    # `paced` reads ahead, so the agent may have added more by the time we stop.
+    stream_start = len(agent.messages)
+    messages_seen = 1
+    # Coalesces token deltas into fewer frames, see stream_encoder.py
+    sse = SSEEncoder()
+    metrics = current_metrics()
+    metrics.stream_started(agent)
+    trip_cache.take_counts(session_id)  # count this turn's reads only
     try:
-        async for event in agent.stream_async(prompt):
+        async for event in sse.paced(agent.stream_async(prompt)):
+            if "frame" in event:
+                yield event["frame"]
+                continue
             if await request.is_disconnected():
                 generation_cancelled = True
                 break
             if "complete" in event:
                 logger.info("Response generation complete")
             if "data" in event:
-                yield f"data: {json.dumps(event['data'])}\n\n"
-        # Save history after streaming is complete
-        if not generation_cancelled: # Don't save if the client disconnected before completion
-            try:
-                SaveHistory(agent, session_id)
-            except Exception as e:
-                logger.error(f"Failed to save history for session {session_id}: {str(e)}")
-                # Don't re-raise to avoid breaking the response
+                metrics.token()
+                partial_text.append(event["data"])
+                if frame := sse.data(event["data"]):
+                    yield frame
+            if "message" in event:
+                messages_seen += 1
+                partial_text = []
+        if not generation_cancelled and (frame := sse.flush()):
+            yield frame
+        # The save runs on the writer's thread, and the stream ends once it is in S3:
+        # Lambda may freeze or reap the container as soon as the invocation is over
+        if not generation_cancelled or turn_complete(agent):
+            # Also when the client left just after the final answer was complete
+            QueueSaveHistory(agent, session_id)
+        else:
+            if len(agent.messages) - stream_start > messages_seen:
+                # The message the text belongs to was added already, don't add its text twice
+                partial_text = []
+            QueueCheckpoint(agent, session_id, turn_start, "".join(partial_text))
+            # The cached agent holds a partial turn that was never saved
+            agent_cache.invalidate(session_id)
+        # Waiting blocks, keep the event loop free for other streams
+        await run_in_threadpool(session_writer.wait, session_id)
+        await run_in_threadpool(wait_for_dummy_trips, session_id)
  
     except Exception as e:
-        error_message = json.dumps({"error": str(e)})
-        yield f"event: error\ndata: {error_message}\n\n"
+        agent_cache.invalidate(session_id)
+        yield sse.error(str(e))
+    finally:
+        agent_cache.checkin(session_id, agent)
+        metrics.stream_finished(agent)
+        hits, misses = trip_cache.take_counts(session_id)
+        logger.info(f"Trip cache for session {session_id}: {hits} hits, {misses} misses this turn")
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "8080")))
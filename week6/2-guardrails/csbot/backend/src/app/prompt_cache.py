@@ -0,0 +1,74 @@
+"""
+Bedrock prompt caching for what every model call of a chat sends again.
+
+Each call sends the tool specs, the system prompt and the whole conversation
+so far, and the calls of a turn (one per tool use, then the answer) and of
+the next turns only add to the end of it. `add_cache_points` marks where
+the parts that repeat end, in the order Bedrock reads a request:
+
+- after the tool specs, which never change;
+- after the static start of the system prompt, before anything appended to
+  it per conversation, if the caller says where that starts;
+- after the last message, so the next call, which sends the same messages
+  and more, reads the conversation from the cache instead of processing it.
+
+Bedrock caches the request up to a cache point once it is long enough for
+the model (1,024 tokens for Claude Sonnet, 2,048 for Haiku) and keeps it for
+five minutes after its last use. Cached input tokens cost a tenth of
+uncached ones and are not processed again, which shortens the time to first
+token of long sessions; writing them to the cache costs a quarter more.
+
+`record_usage` adds what each call read from and wrote to the cache to the
+request's metrics (see request_metrics.py).
+
+PROMPT_CACHE=false turns cache points off, for models without prompt caching,
+which reject requests that have them.
+"""
+import os
+
+from request_metrics import current_metrics
+
+PROMPT_CACHE = os.environ.get("PROMPT_CACHE", "true").lower() == "true"
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def add_cache_points(request: dict, static_system: str | None = None) -> dict:
+    """
+    Adds cache points to a Converse request as formatted by strands' BedrockModel,
+    whose system and tool lists are built per request. The agent's messages are
+    copied rather than changed.
+
+    `static_system` is the part of the system prompt that is the same for every
+    conversation, if the system prompt starts with it and goes on.
+    """
+    if not PROMPT_CACHE:
+        return request
+    tools = request.get("toolConfig", {}).get("tools")
+    if tools:
+        tools.append(CACHE_POINT)
+    system = request.get("system")
+    if system and "text" in system[0]:
+        text = system[0]["text"]
+        if static_system and text.startswith(static_system) and len(text) > len(static_system):
+            system[:1] = [{"text": static_system}, CACHE_POINT, {"text": text[len(static_system):]}]
+        else:
+            system.insert(1, CACHE_POINT)
+    messages = request.get("messages")
+    if messages:
+        last = messages[-1]
+        request["messages"] = [*messages[:-1], {**last, "content": [*last["content"], CACHE_POINT]}]
+    return request
+
+
+def record_usage(event: dict):
+    """Adds a model call's cache reads and writes to the request's metrics, given its stream events."""
+    usage = event.get("metadata", {}).get("usage")
+    if usage is None:
+        return
+    read = usage.get("cacheReadInputTokens", 0)
+    metrics = current_metrics()
+    metrics.add("CacheReadInputTokens", read, count=True)
+    metrics.add("CacheWriteInputTokens", usage.get("cacheWriteInputTokens", 0), count=True)
+    # A model call that read the cache is a hit, whether or not it also wrote to it
+    metrics.add("CacheHits", 1 if read else 0, count=True)
+    metrics.add("CacheMisses", 0 if read else 1, count=True)
@@ -0,0 +1,258 @@
+"""
+Latency breakdown of each request, for finding the slow phases of a chat.
+
+`MetricsMiddleware` gives every request a `RequestMetrics`, which handlers
+reach with `current_metrics()` (it follows the request into threadpool
+calls and streamed responses; `background()` does the same for work queued
+to run after the response). Handlers time phases such as session load
+and agent construction with `phase()`, and `stream_started` / `token` /
+`stream_finished` record time to first token, the gaps between tokens,
+token usage and each tool's latency for an agent turn.
+
+Once the response has been sent, the request's metrics are written to
+stdout as one CloudWatch Embedded Metric Format (EMF) line, which
+CloudWatch Logs turns into metrics without any API call, and added to the
+in-process aggregates returned by `snapshot()` for GET /debug/metrics.
+"""
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any
+
+SERVICE = os.environ.get("METRICS_SERVICE", os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local"))
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "GenAIBootcamp")
+# How many recent values per metric /debug/metrics computes percentiles from
+RECENT_VALUES = int(os.environ.get("METRICS_RECENT_VALUES", "1000"))
+
+# EMF records must be whole log lines of JSON, without the usual log prefix
+emf_logger = logging.getLogger("emf")
+emf_logger.propagate = False
+emf_logger.setLevel(logging.INFO)
+if not emf_logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    emf_logger.addHandler(_handler)
+
+
+class MetricStats:
+    """Count, sum and maximum of a metric, plus its recent values."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: deque[float] = deque(maxlen=RECENT_VALUES)
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def summary(self) -> dict:
+        recent = sorted(self.recent)
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 2),
+            "p50": round(recent[len(recent) // 2], 2),
+            "p95": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 2),
+            "max": round(self.max, 2),
+        }
+
+
+_stats: dict[str, dict[str, MetricStats]] = {}
+_stats_lock = threading.Lock()
+
+
+def snapshot() -> dict:
+    """Returns a summary of every metric recorded in this process, by operation."""
+    with _stats_lock:
+        return {
+            operation: {name: stats.summary() for name, stats in sorted(metrics.items())}
+            for operation, metrics in sorted(_stats.items())
+        }
+
+
+class RequestMetrics:
+    """The metrics of one request (or of one background job, like a session save)."""
+
+    def __init__(self, operation: str, **properties: Any):
+        self.operation = operation
+        self.properties = properties
+        self.started = time.perf_counter()
+        self._stream_started = 0.0
+        # Milliseconds, except for the names in `counts`
+        self.values: dict[str, float] = {}
+        self.counts: set[str] = set()
+        self._last_token: float | None = None
+        self._gaps: list[float] = []
+        # Time spent in the phases nested in each open phase, innermost last
+        self._nested: list[float] = []
+        self._agent_before: tuple[dict, dict] | None = None
+        self._finished = False
+
+    def add(self, name: str, value: float, count: bool = False):
+        """Adds to a metric, in milliseconds unless it is a `count`."""
+        self.values[name] = self.values.get(name, 0.0) + value
+        if count:
+            self.counts.add(name)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Times the block as `name` (added up if it runs more than once). Time
+        spent in a phase nested in it only counts towards the inner one, so
+        e.g. an agent's construction doesn't include the session it restores.
+        """
+        started = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.add(name, (elapsed - nested) * 1000)
+
+    def stream_started(self, agent):
+        """Call before streaming an agent turn."""
+        self._stream_started = time.perf_counter()
+        self._agent_before = _agent_totals(agent)
+
+    def token(self):
+        """Call for each text delta of the turn."""
+        now = time.perf_counter()
+        if self._last_token is None:
+            self.add("TimeToFirstToken", (now - self._stream_started) * 1000)
+        else:
+            self._gaps.append((now - self._last_token) * 1000)
+        self._last_token = now
+        self.add("TextDeltas", 1, count=True)
+
+    def stream_finished(self, agent):
+        """Call once the turn is over, however it ended."""
+        if self._agent_before is None:
+            return
+        self.add("Stream", (time.perf_counter() - self._stream_started) * 1000)
+        if self._gaps:
+            self.add("InterTokenGapAvg", sum(self._gaps) / len(self._gaps))
+            self.add("InterTokenGapMax", max(self._gaps))
+        tools_before, usage_before = self._agent_before
+        tools, usage = _agent_totals(agent)
+        for name, (calls, seconds) in tools.items():
+            calls_before, seconds_before = tools_before.get(name, (0, 0.0))
+            if calls > calls_before:
+                self.add(f"Tool.{name}", (seconds - seconds_before) * 1000)
+                self.add(f"Tool.{name}.Calls", calls - calls_before, count=True)
+        for key in ("inputTokens", "outputTokens", "totalTokens"):
+            self.add(key[0].upper() + key[1:], usage.get(key, 0) - usage_before.get(key, 0), count=True)
+        self._agent_before = None
+
+    def finish(self, status: int | None = None):
+        """Records the metrics: one EMF log line, and the aggregates of `snapshot()`."""
+        if self._finished:
+            return
+        self._finished = True
+        self.add("Total", (time.perf_counter() - self.started) * 1000)
+        with _stats_lock:
+            stats = _stats.setdefault(self.operation, {})
+            for name, value in self.values.items():
+                stats.setdefault(name, MetricStats()).add(value)
+
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["Service", "Operation"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": "Count" if name in self.counts else "Milliseconds"}
+                        for name in self.values
+                    ],
+                }],
+            },
+            "Service": SERVICE,
+            "Operation": self.operation,
+            **self.properties,
+            **{name: round(value, 3) for name, value in self.values.items()},
+        }
+        if status is not None:
+            record["Status"] = status
+        emf_logger.info(json.dumps(record))
+
+
+def _agent_totals(agent) -> tuple[dict, dict]:
+    """Returns the agent's lifetime tool calls and times, by tool, and its token usage."""
+    metrics = agent.event_loop_metrics
+    tools = {name: (m.call_count, m.total_time) for name, m in metrics.tool_metrics.items()}
+    return tools, dict(metrics.accumulated_usage)
+
+
+_current: contextvars.ContextVar[RequestMetrics | None] = contextvars.ContextVar("request_metrics", default=None)
+
+
+def current_metrics() -> RequestMetrics:
+    """
+    Returns the metrics of the request being handled. Outside a request
+    (e.g. in benchmarks) this is a throwaway that is never recorded.
+    """
+    metrics = _current.get()
+    return metrics if metrics is not None else RequestMetrics("none")
+
+
+@contextmanager
+def background(operation: str, **properties: Any):
+    """Measures work done outside a request (e.g. a queued session save) as an operation of its own."""
+    metrics = RequestMetrics(operation, **properties)
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+        metrics.finish()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that gives each HTTP request a `RequestMetrics`, named
+    after its method and route, and records it once the response has been
+    sent. Paths in `exclude` (e.g. the Lambda Adapter's liveness check) are
+    not measured.
+    """
+
+    def __init__(self, app, exclude: tuple[str, ...] = ("/",)):
+        self.app = app
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        # Not the path until a route matched it: every 404 would be an operation of its own
+        metrics = RequestMetrics(f"{scope['method']} unmatched")
+        status = None
+
+        async def send_and_watch(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = _current.set(metrics)
+        try:
+            await self.app(scope, receive, send_and_watch)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                # The route's template, so /api/trip/{trip_id} is one operation
+                metrics.operation = f"{scope['method']} {route.path}"
+            metrics.finish(status if status is not None else 500)
@@ -0,0 +1,152 @@
+"""
+Encodings for session documents stored in S3.
+
+Plain JSON is written without a header so any JSON reader can still open it.
+Binary encodings start with a short header (magic bytes, format version and
+codec id), which lets `decode` pick the right codec without being told, and
+read legacy pretty-printed `.json` sessions transparently.
+"""
+import gzip
+import json
+import logging
+from typing import Any
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# JSON documents never start with a NUL byte
+MAGIC = b"\x00SC"
+FORMAT_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 2
+
+
+class SessionCodec:
+    """Base class for a session encoding."""
+
+    name = ""
+    codec_id = 0
+    content_type = "application/octet-stream"
+
+    def available(self) -> bool:
+        return True
+
+    def dumps(self, document: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(SessionCodec):
+    """Compact JSON, no header."""
+
+    name = "json"
+    codec_id = 0
+    content_type = "application/json"
+
+    def dumps(self, document: Any) -> bytes:
+        return json.dumps(document, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data.decode("utf-8"))
+
+
+class GzipJsonCodec(SessionCodec):
+    """Compact JSON compressed with gzip. Only needs the standard library."""
+
+    name = "json+gzip"
+    codec_id = 1
+
+    def dumps(self, document: Any) -> bytes:
+        return gzip.compress(JsonCodec().dumps(document), compresslevel=6)
+
+    def loads(self, data: bytes) -> Any:
+        return JsonCodec().loads(gzip.decompress(data))
+
+
+class GzipMsgpackCodec(SessionCodec):
+    """msgpack compressed with gzip."""
+
+    name = "msgpack+gzip"
+    codec_id = 2
+
+    def available(self) -> bool:
+        return msgpack is not None
+
+    def dumps(self, document: Any) -> bytes:
+        return gzip.compress(msgpack.packb(document, use_bin_type=True), compresslevel=6)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(gzip.decompress(data), raw=False)
+
+
+class ZstdMsgpackCodec(SessionCodec):
+    """msgpack compressed with zstd."""
+
+    name = "msgpack+zstd"
+    codec_id = 3
+
+    def available(self) -> bool:
+        return msgpack is not None and zstandard is not None
+
+    def dumps(self, document: Any) -> bytes:
+        return zstandard.ZstdCompressor(level=3).compress(msgpack.packb(document, use_bin_type=True))
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(data), raw=False)
+
+
+CODECS: dict[str, SessionCodec] = {
+    codec.name: codec
+    for codec in (JsonCodec(), GzipJsonCodec(), GzipMsgpackCodec(), ZstdMsgpackCodec())
+}
+CODECS_BY_ID: dict[int, SessionCodec] = {codec.codec_id: codec for codec in CODECS.values()}
+# Used when the requested codec's optional dependencies are not installed
+FALLBACKS = {
+    "msgpack+zstd": "msgpack+gzip",
+    "msgpack+gzip": "json+gzip",
+}
+
+
+def get_codec(name: str) -> SessionCodec:
+    """Returns the named codec, or the closest one whose dependencies are installed."""
+    if name not in CODECS:
+        raise ValueError(f"Unknown session codec '{name}', expected one of {', '.join(CODECS)}")
+    codec = CODECS[name]
+    while not codec.available():
+        fallback = CODECS[FALLBACKS[codec.name]]
+        logger.warning(f"Session codec '{codec.name}' is not installed, using '{fallback.name}'")
+        codec = fallback
+    return codec
+
+
+def encode(document: Any, codec: SessionCodec) -> bytes:
+    """Encodes a document, prefixing binary encodings with the codec header."""
+    body = codec.dumps(document)
+    if codec.codec_id == JsonCodec.codec_id:
+        return body
+    return MAGIC + bytes([FORMAT_VERSION, codec.codec_id]) + body
+
+
+def decode(data: bytes) -> Any:
+    """Decodes a document written by `encode`, or a plain JSON document."""
+    if not data.startswith(MAGIC):
+        return CODECS["json"].loads(data)
+    version, codec_id = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported session format version {version}")
+    codec = CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ValueError(f"Unknown session codec id {codec_id}")
+    if not codec.available():
+        raise ValueError(f"Session codec '{codec.name}' is not installed")
+    return codec.loads(data[HEADER_SIZE:])
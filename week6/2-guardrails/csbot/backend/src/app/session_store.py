@@ -0,0 +1,357 @@
+import hashlib
+import json
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from session_codec import JsonCodec, SessionCodec, decode, encode
+from transcript import display_message, transcript_document
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FORMAT = 2
+# How many times a save rereads a session that keeps being written elsewhere
+REBASE_ATTEMPTS = 3
+
+
+def precondition_failed(e: ClientError) -> bool:
+    return e.response["Error"]["Code"] in ("PreconditionFailed", "412")
+
+
+def fingerprint(message: dict) -> bytes:
+    """A digest of a message's content, which changes when the message is edited in place."""
+    body = json.dumps(message, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=repr)
+    return hashlib.blake2b(body.encode("utf-8"), digest_size=16).digest()
+
+
+class SessionLog:
+    """
+    What we know about a persisted session.
+
+    A session is stored as a small manifest plus an append-only list of
+    segments. Each segment records how many messages to drop from the front
+    of the conversation (the conversation manager trims old turns) and the
+    messages appended since the previous save.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str | None,
+        messages: list,
+        segments: list[dict] | None = None,
+        next_seq: int = 1,
+        etag: str | None = None,
+        checkpoint: dict | None = None,
+        saved: list[bytes] | None = None,
+    ):
+        self.system_prompt = system_prompt
+        self.messages = messages
+        self.segments = segments or []
+        self.next_seq = next_seq
+        # ETag of the manifest (or of the legacy single-file session)
+        self.etag = etag
+        # The progress of an interrupted turn, not part of `messages` (see `save_checkpoint`)
+        self.checkpoint = checkpoint
+        # The content of each message as it was persisted, used to find what changed.
+        # Digests rather than the message objects, which the agent may edit in place
+        # (e.g. the conversation manager truncating a tool result).
+        self.saved = saved if saved is not None else [fingerprint(message) for message in messages]
+        # The display form of each message (see transcript.py), worked out on the
+        # first save and then only for the messages each save appends
+        self.shown: list[dict | None] | None = None
+        # Whether a save put its messages on top of messages another writer saved
+        # meanwhile, which the agent that saved doesn't have (see `SessionStore.save`)
+        self.rebased = False
+
+    def manifest(self) -> dict:
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "system_prompt": self.system_prompt,
+            "next_seq": self.next_seq,
+            "segments": self.segments,
+        }
+        if self.checkpoint is not None:
+            manifest["checkpoint"] = self.checkpoint
+        return manifest
+
+
+class SessionStore:
+    """
+    Persists agent sessions in S3 as `{prefix}{session_id}/manifest.json`
+    plus numbered segment files, so a turn only uploads its new messages.
+    Every save also writes the session's chat transcript as plain JSON to
+    `{prefix}{session_id}/transcript.json`.
+
+    Legacy `{prefix}{session_id}.json` sessions are read transparently and
+    migrated on their next save. Documents are written with `codec`; reads
+    detect the encoding from the document itself.
+    """
+
+    def __init__(self, s3_client, bucket: str, prefix: str = "sessions/",
+                 compact_every: int = 16, max_workers: int = 8,
+                 codec: SessionCodec = JsonCodec()):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.codec = codec
+        self.compact_every = compact_every
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def legacy_key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}.json"
+
+    def manifest_key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}/manifest.json"
+
+    def segment_key(self, session_id: str, segment_id: str) -> str:
+        return f"{self.prefix}{session_id}/{segment_id}.json"
+
+    def transcript_key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}/transcript.json"
+
+    @staticmethod
+    def new_segment_id(seq: int) -> str:
+        # The random suffix keeps concurrent writers from overwriting each other's segments
+        return f"{seq:08d}-{uuid.uuid4().hex[:8]}"
+
+    def load(self, session_id: str, if_none_match: str | None = None) -> SessionLog:
+        """
+        Loads a session, fetching its segments in parallel.
+
+        Raises the S3 `ClientError` for `NoSuchKey` if the session does not
+        exist, and for `304` if `if_none_match` still matches the stored ETag.
+        """
+        try:
+            return self._load_segmented(session_id, if_none_match)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+        return self._load_legacy(session_id, if_none_match)
+
+    def load_transcript(self, session_id: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        Returns the JSON chat transcript of a session and its ETag, without
+        loading the session itself.
+
+        Raises the S3 `ClientError` for `NoSuchKey` if there is none (a new
+        session, or one last saved before transcripts were kept), and for `304`
+        if `if_none_match` still matches its ETag.
+        """
+        request_args = {"Bucket": self.bucket, "Key": self.transcript_key(session_id)}
+        if if_none_match:
+            request_args["IfNoneMatch"] = if_none_match
+        response = self.s3_client.get_object(**request_args)
+        return response["Body"].read(), response["ETag"]
+
+    def save_transcript(self, session_id: str, log: SessionLog) -> tuple[bytes, str]:
+        """Writes the chat transcript of a session as `log` has it. Returns its body and ETag."""
+        if log.shown is None:
+            log.shown = [display_message(message) for message in log.messages]
+        # Always JSON whatever the session codec, so it can be served as it is
+        body = JsonCodec().dumps(transcript_document(log.shown, log.checkpoint))
+        response = self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.transcript_key(session_id),
+            Body=body,
+            ContentType=JsonCodec.content_type,
+        )
+        return body, response["ETag"]
+
+    def save(self, session_id: str, log: SessionLog | None,
+             system_prompt: str | None, messages: list) -> SessionLog:
+        """
+        Persists the current messages of a session, appending only what changed
+        since `log` was loaded or saved. Returns the updated log, which no longer
+        has a checkpoint.
+
+        The manifest is only replaced if it is still the one `log` was read
+        from. If another writer (e.g. another container) saved the session
+        since, the messages added since `log` are put on top of what it saved
+        instead, and the returned log is `rebased`: its messages are no longer
+        the agent's, which must be rebuilt from S3.
+        """
+        try:
+            return self._save(session_id, log, system_prompt, messages)
+        except ClientError as e:
+            if log is None or not precondition_failed(e):
+                raise
+            logger.warning(f"Session {session_id} was written elsewhere, adding this turn on top of it")
+            return self._rebase(session_id, log, messages)
+
+    def _save(self, session_id: str, log: SessionLog | None,
+              system_prompt: str | None, messages: list) -> SessionLog:
+        if log is None or not log.segments or log.system_prompt != system_prompt:
+            # New or legacy session, or a different system prompt: write it in full
+            return self._compact(session_id, log, system_prompt, messages)
+
+        current = [fingerprint(message) for message in messages]
+        drop = self._dropped_count(log.saved, current)
+        if drop is None:
+            # Earlier messages were rewritten in place, the log can't express that
+            return self._compact(session_id, log, system_prompt, messages)
+        appended = messages[len(log.saved) - drop:]
+        if drop == 0 and not appended:
+            return log
+
+        live = len(messages)
+        dead = sum(segment["count"] for segment in log.segments) + len(appended) - live
+        if len(log.segments) + 1 >= self.compact_every or dead > live:
+            return self._compact(session_id, log, system_prompt, messages)
+
+        seq = log.next_seq
+        segment_id = self.new_segment_id(seq)
+        self._put(self.segment_key(session_id, segment_id), {"messages": appended})
+        segments = log.segments + [{"id": segment_id, "drop": drop, "count": len(appended)}]
+        updated = SessionLog(system_prompt, messages, segments, seq + 1, saved=current)
+        if log.shown is not None:
+            updated.shown = log.shown[drop:] + [display_message(message) for message in appended]
+        updated.etag = self._put(self.manifest_key(session_id), updated.manifest(), if_match=log.etag)
+        self.save_transcript(session_id, updated)
+        logger.info(f"Appended {len(appended)} messages to session {session_id}")
+        return updated
+
+    def _rebase(self, session_id: str, log: SessionLog, messages: list) -> SessionLog:
+        """
+        Writes the session as another writer left it plus the messages added
+        since `log`, with the other writer's system prompt, which goes with its
+        messages. Raises the S3 `ClientError` if the session keeps changing.
+        """
+        current = [fingerprint(message) for message in messages]
+        drop = self._dropped_count(log.saved, current)
+        if drop is not None:
+            appended = messages[len(log.saved) - drop:]
+        else:
+            saved = set(log.saved)
+            appended = [message for message, digest in zip(messages, current) if digest not in saved]
+        for attempt in range(1, REBASE_ATTEMPTS + 1):
+            remote = self.load(session_id)
+            try:
+                rebased = self._compact(session_id, remote, remote.system_prompt, remote.messages + appended)
+            except ClientError as e:
+                if not precondition_failed(e) or attempt == REBASE_ATTEMPTS:
+                    raise
+                continue
+            rebased.rebased = True
+            logger.info(f"Added {len(appended)} messages on top of session {session_id} as written elsewhere")
+            return rebased
+
+    def save_checkpoint(self, session_id: str, log: SessionLog, checkpoint: dict) -> SessionLog:
+        """
+        Records the progress of an interrupted turn next to the session as it was
+        before the turn, in the manifest. The next `save` drops it.
+
+        Raises the S3 `ClientError` for `PreconditionFailed` if the session was
+        written since `log` was loaded: the checkpoint no longer applies to it.
+        """
+        if not log.segments:
+            # Legacy session: it needs a manifest to hold the checkpoint
+            log = self._compact(session_id, log, log.system_prompt, log.messages)
+        updated = SessionLog(
+            log.system_prompt, log.messages, log.segments, log.next_seq,
+            checkpoint=checkpoint, saved=log.saved,
+        )
+        updated.shown = log.shown
+        updated.etag = self._put(self.manifest_key(session_id), updated.manifest(), if_match=log.etag)
+        self.save_transcript(session_id, updated)
+        logger.info(f"Saved a checkpoint for session {session_id}")
+        return updated
+
+    @staticmethod
+    def _dropped_count(saved: list[bytes], messages: list[bytes]) -> int | None:
+        """
+        Returns how many persisted messages were trimmed from the front, given that
+        the rest must still be present, in order and unchanged, at the start of
+        `messages`. Both are lists of message fingerprints. Returns None if that
+        isn't the case.
+        """
+        if not saved:
+            return 0
+        if not messages:
+            return len(saved)
+        for drop in range(len(saved)):
+            if saved[drop] == messages[0]:
+                kept = saved[drop:]
+                if len(kept) <= len(messages) and kept == messages[:len(kept)]:
+                    return drop
+                return None
+        return len(saved)
+
+    def _compact(self, session_id: str, log: SessionLog | None,
+                 system_prompt: str | None, messages: list) -> SessionLog:
+        """
+        Rewrites the session as a single segment and removes the old ones. Raises
+        the S3 `ClientError` for `PreconditionFailed` if the manifest isn't the
+        one `log` was read from any more.
+        """
+        seq = log.next_seq if log else 1
+        segment_id = self.new_segment_id(seq)
+        self._put(self.segment_key(session_id, segment_id), {"messages": messages})
+        compacted = SessionLog(
+            system_prompt, messages, [{"id": segment_id, "drop": 0, "count": len(messages)}], seq + 1
+        )
+        # A legacy session has no manifest yet to compare with
+        if_match = log.etag if log and log.segments else None
+        compacted.etag = self._put(self.manifest_key(session_id), compacted.manifest(), if_match=if_match)
+        self.save_transcript(session_id, compacted)
+
+        stale = [self.segment_key(session_id, s["id"]) for s in (log.segments if log else [])]
+        if log and log.etag is not None and not log.segments:
+            stale.append(self.legacy_key(session_id))
+        if stale:
+            try:
+                self.s3_client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={"Objects": [{"Key": key} for key in stale], "Quiet": True},
+                )
+            except ClientError as e:
+                # Unreferenced segments are harmless, just wasted bytes
+                logger.warning(f"Failed to delete old segments for session {session_id}: {e}")
+        logger.info(f"Compacted session {session_id} into {len(messages)} messages")
+        return compacted
+
+    def _load_segmented(self, session_id: str, if_none_match: str | None) -> SessionLog:
+        manifest, etag = self._get(self.manifest_key(session_id), if_none_match)
+        keys = [self.segment_key(session_id, s["id"]) for s in manifest["segments"]]
+        try:
+            bodies = list(self.executor.map(lambda key: self._get(key)[0], keys))
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            # A concurrent compaction removed a segment after we read the manifest
+            logger.info(f"Session {session_id} was compacted while loading, retrying")
+            manifest, etag = self._get(self.manifest_key(session_id))
+            keys = [self.segment_key(session_id, s["id"]) for s in manifest["segments"]]
+            bodies = list(self.executor.map(lambda key: self._get(key)[0], keys))
+
+        messages = []
+        for segment, body in zip(manifest["segments"], bodies):
+            messages = messages[segment["drop"]:] + body["messages"]
+        return SessionLog(
+            manifest.get("system_prompt"), messages, manifest["segments"],
+            manifest["next_seq"], etag, manifest.get("checkpoint"),
+        )
+
+    def _load_legacy(self, session_id: str, if_none_match: str | None) -> SessionLog:
+        state, etag = self._get(self.legacy_key(session_id), if_none_match)
+        # No segments: the next save migrates the session to the segmented layout
+        return SessionLog(state.get("system_prompt"), state.get("messages") or [], etag=etag)
+
+    def _get(self, key: str, if_none_match: str | None = None) -> tuple[dict, str]:
+        request_args = {"Bucket": self.bucket, "Key": key}
+        if if_none_match:
+            request_args["IfNoneMatch"] = if_none_match
+        response = self.s3_client.get_object(**request_args)
+        return decode(response["Body"].read()), response["ETag"]
+
+    def _put(self, key: str, document: dict, if_match: str | None = None) -> str:
+        request_args = {
+            "Bucket": self.bucket,
+            "Key": key,
+            "Body": encode(document, self.codec),
+            "ContentType": self.codec.content_type,
+        }
+        if if_match:
+            request_args["IfMatch"] = if_match
+        return self.s3_client.put_object(**request_args)["ETag"]
@@ -0,0 +1,105 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SessionQueue:
+    """The saves waiting to run for one session, by key, and whether one is running."""
+
+    def __init__(self):
+        self.waiting: deque[tuple[Hashable, Callable[[], None]]] = deque()
+        self.running = False
+
+
+class SessionWriter:
+    """
+    Write-behind queue for session saves, so a response can finish before its
+    session is in S3.
+
+    Saves of one session run one at a time and in order, on a small thread
+    pool shared by all sessions. A save queued while an earlier one with the
+    same key (e.g. of the same agent) is still waiting replaces it, since it
+    writes a later snapshot of the same messages. Saves with other keys, e.g.
+    of two agents that ran turns on the session at once, all run.
+    A failing save is retried with exponential backoff and jitter; once
+    `max_attempts` are used up `on_failure` is called with the session id and
+    the error.
+
+    Use `wait` before reading a session back from S3 and `flush` on shutdown.
+    """
+
+    def __init__(self, on_failure: Callable[[str, Exception], None], max_workers: int = 4,
+                 max_attempts: int = 4, base_delay: float = 0.2):
+        self.on_failure = on_failure
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="session-writer")
+        self._queues: dict[str, SessionQueue] = {}
+        self._changed = threading.Condition()
+
+    def submit(self, session_id: str, save: Callable[[], None], key: Hashable = None):
+        """Queues a save of a session."""
+        with self._changed:
+            queue = self._queues.setdefault(session_id, SessionQueue())
+            for i, (waiting_key, _) in enumerate(queue.waiting):
+                if waiting_key == key:
+                    logger.info(f"Replacing queued save of session {session_id} with a newer one")
+                    queue.waiting[i] = (key, save)
+                    break
+            else:
+                queue.waiting.append((key, save))
+            if not queue.running:
+                queue.running = True
+                self.executor.submit(self._drain, session_id)
+
+    def pending(self, session_id: str) -> bool:
+        with self._changed:
+            return session_id in self._queues
+
+    def wait(self, session_id: str, timeout: float | None = None) -> bool:
+        """Waits until no save of a session is queued or running. Returns False on timeout."""
+        with self._changed:
+            return self._changed.wait_for(lambda: session_id not in self._queues, timeout)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Waits until every queued save has run. Returns False on timeout."""
+        with self._changed:
+            if self._queues:
+                logger.info(f"Flushing saves of {len(self._queues)} sessions")
+            return self._changed.wait_for(lambda: not self._queues, timeout)
+
+    def _drain(self, session_id: str):
+        while True:
+            with self._changed:
+                queue = self._queues[session_id]
+                if not queue.waiting:
+                    del self._queues[session_id]
+                    self._changed.notify_all()
+                    return
+                _, save = queue.waiting.popleft()
+            self._run(session_id, save)
+
+    def _run(self, session_id: str, save: Callable[[], None]):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                save()
+                return
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logger.error(f"Giving up saving session {session_id} after {attempt} attempts: {e}")
+                    try:
+                        self.on_failure(session_id, e)
+                    except Exception:
+                        logger.exception(f"Failure handler for session {session_id} failed")
+                    return
+                delay = self.base_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                logger.warning(
+                    f"Saving session {session_id} failed (attempt {attempt}), retrying in {delay:.2f}s: {e}"
+                )
+                time.sleep(delay)
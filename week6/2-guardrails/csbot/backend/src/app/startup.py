@@ -0,0 +1,67 @@
+"""
+What the csbot Lambda does before it serves requests, in one of two modes.
+
+On demand (the default), startup only imports what every request needs.
+strands and the Bedrock client, which only chat needs (chat_agent.py), and
+the DynamoDB table (ddb.py) are imported or created on first use, so the
+Lambda Adapter's readiness check and a page's first requests (chat history,
+trips) don't wait for them. `begin` warms them up on a background thread
+meanwhile, mostly while those requests wait on S3 and DynamoDB.
+
+When init isn't on a user's path, that is with SnapStart (init runs once when
+a version is published and every new environment is restored from a snapshot
+of it) or provisioned concurrency, `begin` builds all of it before the app
+reports ready instead. Nothing built opens a connection, which a restored
+environment couldn't use, and `after_restore` reseeds `random` so restored
+environments don't all draw the same retry jitter and tool use ids.
+
+STARTUP_MODE=eager or lazy overrides the mode.
+"""
+import logging
+import os
+import random
+import threading
+
+from request_metrics import background
+
+logger = logging.getLogger(__name__)
+
+# "on-demand", "provisioned-concurrency" or "snap-start", set by Lambda
+INITIALIZATION_TYPE = os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE", "on-demand")
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "lazy" if INITIALIZATION_TYPE == "on-demand" else "eager")
+
+
+def preload():
+    """Imports and builds everything chat needs, without connecting to anything."""
+    with background("Startup", Mode=STARTUP_MODE) as metrics, metrics.phase("Preload"):
+        import ddb
+        ddb.table()
+        import chat_agent  # noqa: F401  (strands, the Bedrock client and the tool registry)
+
+
+def begin():
+    """Call once at startup: preloads now if eager, otherwise in the background."""
+    if STARTUP_MODE == "eager":
+        preload()
+    else:
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+
+def _warm_up():
+    try:
+        preload()
+    except Exception as e:
+        # Whatever failed is imported again, and fails properly, when a request needs it
+        logger.error(f"Failed to preload chat: {e}")
+
+
+def after_restore():
+    random.seed()
+
+
+try:
+    from snapshot_restore_py import register_after_restore
+except ImportError:
+    pass  # Only provided by the Lambda runtime
+else:
+    register_after_restore(after_restore)
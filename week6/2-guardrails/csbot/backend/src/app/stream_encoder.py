@@ -0,0 +1,182 @@
+"""
+Frames streamed model output for the chat endpoints.
+
+Sending each token delta as its own frame costs an encode, a write and a
+Lambda response-stream chunk per token. `StreamEncoder` coalesces deltas
+instead: a delta that arrives after a quiet spell is sent straight away, so
+the time to the first token is unchanged, while deltas arriving in a burst
+are held until `max_delay` has passed since the first of them or
+`max_chars` are buffered, and then sent as one frame.
+
+`paced` reads the agent's event stream alongside, so buffered text goes out
+on time even when no event follows (e.g. while a tool runs), and sends a
+heartbeat after `heartbeat` seconds without a frame so idle connections
+aren't closed by proxies.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator
+
+FLUSH_SECONDS = float(os.environ.get("STREAM_FLUSH_SECONDS", "0.02"))
+FLUSH_CHARS = int(os.environ.get("STREAM_FLUSH_CHARS", "512"))
+HEARTBEAT_SECONDS = float(os.environ.get("STREAM_HEARTBEAT_SECONDS", "15"))
+
+# What json.dumps does for a str, without the call overhead in between
+encode_string = json.encoder.encode_basestring_ascii
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class StreamEncoder:
+    """Coalesces text deltas into plain-text chunks. See the module docstring."""
+
+    heartbeat_frame: str | None = None
+
+    def __init__(self, max_delay: float = FLUSH_SECONDS, max_chars: int = FLUSH_CHARS,
+                 heartbeat: float = HEARTBEAT_SECONDS):
+        self.max_delay = max_delay
+        self.max_chars = max_chars
+        self.heartbeat = heartbeat
+        self.frames = 0
+        self._buffer: list[str] = []
+        self._buffered_chars = 0
+        self._buffered_at = 0.0
+        # When text was last sent, and when anything (text or heartbeat) was
+        self._sent_at = float("-inf")
+        self._alive_at = float("-inf")
+
+    def frame(self, text: str) -> str:
+        return text
+
+    def data(self, text: str) -> str | None:
+        """Adds a text delta. Returns a frame to send now, if one is due."""
+        now = time.monotonic()
+        if not self._buffer:
+            if now - self._sent_at >= self.max_delay:
+                return self._send(text, now)
+            self._buffered_at = now
+        self._buffer.append(text)
+        self._buffered_chars += len(text)
+        if self._buffered_chars >= self.max_chars or now - self._buffered_at >= self.max_delay:
+            return self.flush()
+        return None
+
+    def flush(self) -> str | None:
+        """Returns a frame of the buffered text, if there is any."""
+        if not self._buffer:
+            return None
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered_chars = 0
+        return self._send(text, time.monotonic())
+
+    async def paced(self, events: AsyncIterator[Any], max_ahead: int = 256) -> AsyncIterator[Any]:
+        """
+        Yields the events of `events`, plus `{"frame": ...}` events carrying
+        buffered text once it is due and heartbeats; the caller yields those
+        frames as they are.
+
+        `events` is read by a task of its own, at most `max_ahead` events ahead
+        of the caller, so that it stays in one context across its own yields
+        (strands holds tracing spans across them) and the caller only waits,
+        with a timer, once it has caught up.
+        """
+        loop = asyncio.get_running_loop()
+        self._alive_at = time.monotonic()
+        pending: deque = deque()
+        # Futures the caller waits on for an event, and the reader for room to add one
+        arrived: asyncio.Future | None = None
+        room: asyncio.Future | None = None
+
+        def wake(future: asyncio.Future | None):
+            if future is not None and not future.done():
+                future.set_result(None)
+
+        async def produce():
+            nonlocal room
+            try:
+                async for event in events:
+                    pending.append(event)
+                    wake(arrived)
+                    if len(pending) >= max_ahead:
+                        room = loop.create_future()
+                        await room
+                pending.append(_DONE)
+            except Exception as e:
+                pending.append(_Failure(e))
+            finally:
+                wake(arrived)
+                if hasattr(events, "aclose"):
+                    await events.aclose()
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                while not pending:
+                    arrived = loop.create_future()
+                    timeout = self._wait_time()
+                    timer = loop.call_later(timeout, wake, arrived) if timeout is not None else None
+                    try:
+                        await arrived
+                    finally:
+                        if timer is not None:
+                            timer.cancel()
+                    if not pending:
+                        frame = self._timed_frame()
+                        if frame is not None:
+                            yield {"frame": frame}
+                item = pending.popleft()
+                wake(room)
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+
+    def _wait_time(self) -> float | None:
+        now = time.monotonic()
+        if self._buffer:
+            return max(self._buffered_at + self.max_delay - now, 0)
+        if self.heartbeat_frame is not None and self.heartbeat > 0:
+            return max(self._alive_at + self.heartbeat - now, 0)
+        return None
+
+    def _timed_frame(self) -> str | None:
+        if self._buffer:
+            return self.flush()
+        self._alive_at = time.monotonic()
+        return self.heartbeat_frame
+
+    def _send(self, text: str, now: float) -> str:
+        self._sent_at = self._alive_at = now
+        self.frames += 1
+        return self.frame(text)
+
+
+class SSEEncoder(StreamEncoder):
+    """Coalesces text deltas into server-sent events, each carrying a JSON string."""
+
+    # A comment line, which EventSource and our clients skip
+    heartbeat_frame = ": keep-alive\n\n"
+
+    def frame(self, text: str) -> str:
+        return f"data: {encode_string(text)}\n\n"
+
+    def error(self, message: str) -> str:
+        """Returns the buffered text, if any, followed by an error event."""
+        pending = self.flush() or ""
+        return f"{pending}event: error\ndata: {json.dumps({'error': message})}\n\n"
@@ -0,0 +1,45 @@
+"""
+The chat history as shown to the user: the first text block of each message,
+and the turn that was interrupted, if any, so the client can offer to resume
+it.
+
+`SessionStore` keeps it next to each session as a small JSON document,
+updated on every save, so GET /api/chat can serve it without loading the
+session or creating an agent.
+"""
+
+# Messages added when resuming an interrupted turn, hidden from the chat history
+RESUME_PROMPT = "Please continue your previous answer from where it was cut off, without repeating it."
+INTERRUPTED_REPLY = "(My answer was interrupted here.)"
+
+
+def display_message(message: dict) -> dict | None:
+    """Returns a message as shown in the chat, or None if it isn't shown."""
+    content = message.get("content")
+    if not content or "text" not in content[0] or content[0]["text"] in (RESUME_PROMPT, INTERRUPTED_REPLY):
+        return None
+    return {"role": message["role"], "content": [{"text": content[0]["text"]}]}
+
+
+def checkpoint_text(checkpoint: dict) -> str:
+    """Returns the text the client was sent before the turn was interrupted."""
+    texts = [
+        block["text"]
+        for message in checkpoint["turn"] if message["role"] == "assistant"
+        for block in message["content"] if "text" in block
+    ]
+    return "".join(texts) + checkpoint["partial_text"]
+
+
+def transcript_document(shown: list[dict | None], checkpoint: dict | None) -> dict:
+    """
+    Returns the body of GET /api/chat, given the display form of each message
+    of the session (see `display_message`) and its checkpoint.
+    """
+    return {
+        "messages": [message for message in shown if message is not None],
+        "checkpoint": {
+            "prompt": checkpoint["turn"][0]["content"][0]["text"],
+            "text": checkpoint_text(checkpoint),
+        } if checkpoint else None,
+    }
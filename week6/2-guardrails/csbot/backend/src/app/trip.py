@@ -1,22 +1,58 @@
+import base64
+import json
 import logging
-import os
 import uuid
+from collections.abc import Iterator
 
-import boto3
 from botocore.exceptions import ClientError
 from pydantic import BaseModel, Field
 
-from flight import Flight
+from flight import SAVE_CONDITION as FLIGHT_SAVE_CONDITION
+from flight import READ_LEGACY_FLIGHTS, Flight
+from ddb import DDB_TABLE, table
+from trip_cache import trip_cache
 
 logger = logging.getLogger(__name__)
 
-DDB_TABLE = os.environ.get("DDB_TABLE")
-if not DDB_TABLE:
-    logger.error("DDB_TABLE environment variable not set.")
-    raise ValueError("DDB_TABLE environment variable not set.")
 
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(DDB_TABLE)
+# A new trip must not overwrite an existing one
+SAVE_CONDITION = "attribute_not_exists(PK) AND attribute_not_exists(SK)"
+# DynamoDB's limit on the number of items in one transaction
+MAX_TRANSACTION_ITEMS = 100
+# Default and largest number of trips returned per page
+TRIPS_PAGE_SIZE = 50
+MAX_TRIPS_PAGE_SIZE = 100
+
+
+def query_all(**kwargs) -> list[dict]:
+    """Runs a query on the table, following LastEvaluatedKey until all pages are read."""
+    items = []
+    while True:
+        response = table().query(**kwargs)
+        items.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return items
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def encode_cursor(key: dict) -> str:
+    """Turns a DynamoDB key into an opaque, URL-safe page cursor."""
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(user_id: str, cursor: str) -> dict:
+    """Turns a page cursor back into a DynamoDB key, checking it is one of the user's trips."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
+    if (
+        not isinstance(key, dict)
+        or key.get("PK") != f"U#{user_id}"
+        or not str(key.get("SK", "")).startswith("T#")
+    ):
+        raise ValueError("Invalid cursor")
+    return {"PK": key["PK"], "SK": key["SK"]}
 
 
 class FullTrip(BaseModel):
@@ -24,23 +60,58 @@ class FullTrip(BaseModel):
     flights: list[Flight]
 
 
+class TripDetails:
+    """
+    A trip and its flights as read from our own table, decoded once into their
+    JSON form. The JSON document and the validated `FullTrip` are only built
+    when first asked for, and then reused while the details are cached.
+    """
+
+    def __init__(self, name: str, flights: list[dict]):
+        self.name = name
+        self.flights = flights
+        self._json: str | None = None
+        self._model: FullTrip | None = None
+
+    @staticmethod
+    def from_items(trip_item: dict, flight_items: list[dict]) -> "TripDetails":
+        return TripDetails(trip_item.get("Name"), [Flight.json_from_item(item) for item in flight_items])
+
+    def to_json(self) -> str:
+        """Returns the details serialized the same way as `FullTrip.model_dump_json()`."""
+        if self._json is None:
+            self._json = json.dumps(
+                {"name": self.name, "flights": self.flights}, separators=(",", ":"), ensure_ascii=False
+            )
+        return self._json
+
+    def to_model(self) -> FullTrip:
+        if self._model is None:
+            self._model = FullTrip.model_validate_json(self.to_json())
+        return self._model
+
+
 class Trip(BaseModel):
     user_id: str
     name: str
     trip_id: str = Field(default_factory=lambda: f"T#{uuid.uuid4()}")
 
+    def to_item(self) -> dict:
+        """Returns the DynamoDB item for this trip."""
+        return {
+            "PK": f"U#{self.user_id}",
+            "SK": self.trip_id,
+            "Name": self.name,
+            "Type": "Trip",
+        }
+
     def save(self) -> str:
         """Saves a new trip to DynamoDB."""
         logger.info(f"Saving trip {self.trip_id} for user {self.user_id}")
         try:
-            table.put_item(
-                Item={
-                    "PK": f"U#{self.user_id}",
-                    "SK": self.trip_id,
-                    "Name": self.name,
-                    "Type": "Trip",
-                },
-                ConditionExpression="attribute_not_exists(PK) AND attribute_not_exists(SK)",
+            table().put_item(
+                Item=self.to_item(),
+                ConditionExpression=SAVE_CONDITION,
             )
             logger.info(f"Successfully saved trip {self.trip_id}")
             return self.trip_id
@@ -52,6 +123,62 @@ class Trip(BaseModel):
             else:
                 logger.error(f"Error saving trip {self.trip_id}: {e}")
                 raise
+        finally:
+            trip_cache.invalidate(self.user_id, ("trip", self.trip_id), prefix="trips")
+
+    @staticmethod
+    def save_with_flights(trips: list["Trip"], flights: list[Flight]) -> list[str]:
+        """
+        Saves new trips and their flights to DynamoDB in a single transaction,
+        with the same existence conditions as `save`. Either everything is
+        written or nothing is.
+        """
+        owners = {trip.trip_id: trip.user_id for trip in trips}
+        trip_ids = owners.keys()
+        for flight in flights:
+            if flight.trip_id not in owners:
+                msg = f"Flight {flight.flight_id} belongs to trip {flight.trip_id}, which is not being saved."
+                logger.error(msg)
+                raise ValueError(msg)
+            if flight.user_id != owners[flight.trip_id]:
+                msg = f"Flight {flight.flight_id} does not belong to the user of trip {flight.trip_id}."
+                logger.error(msg)
+                raise ValueError(msg)
+        if len(trips) + len(flights) > MAX_TRANSACTION_ITEMS:
+            msg = f"Cannot save more than {MAX_TRANSACTION_ITEMS} trips and flights at once."
+            logger.error(msg)
+            raise ValueError(msg)
+
+        logger.info(f"Saving {len(trips)} trips with {len(flights)} flights")
+        items = [(trip.to_item(), SAVE_CONDITION) for trip in trips]
+        items += [(flight.to_item(), FLIGHT_SAVE_CONDITION) for flight in flights]
+        try:
+            # The resource's client accepts plain Python values, like table.put_item
+            table().meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Put": {
+                            "TableName": DDB_TABLE,
+                            "Item": item,
+                            "ConditionExpression": condition,
+                        }
+                    }
+                    for item, condition in items
+                ]
+            )
+            logger.info(f"Successfully saved trips {', '.join(trip_ids)}")
+            return [trip.trip_id for trip in trips]
+        except ClientError as e:
+            reasons = e.response.get("CancellationReasons", [])
+            if any(reason.get("Code") == "ConditionalCheckFailed" for reason in reasons):
+                msg = f"A trip or flight in {', '.join(trip_ids)} already exists."
+                logger.warning(msg)
+                raise ValueError(msg) from e
+            logger.error(f"Error saving trips {', '.join(trip_ids)}: {e}")
+            raise
+        finally:
+            for trip in trips:
+                trip_cache.invalidate(trip.user_id, ("trip", trip.trip_id), prefix="trips")
 
     @staticmethod
     def update_name(user_id: str, trip_id: str, new_name: str):
@@ -65,7 +192,7 @@ class Trip(BaseModel):
             raise ValueError(msg)
 
         try:
-            table.update_item(
+            table().update_item(
                 Key={"PK": f"U#{user_id}", "SK": trip_id},
                 UpdateExpression="set #nm = :n",
                 ExpressionAttributeNames={"#nm": "Name"},
@@ -80,34 +207,96 @@ class Trip(BaseModel):
                 raise ValueError(msg) from e
             logger.error(f"Error updating trip {trip_id}: {e}")
             raise
+        finally:
+            trip_cache.invalidate(user_id, ("trip", trip_id), prefix="trips")
 
     @staticmethod
-    def list_for_user(user_id: str) -> list[dict]:
-        """Lists all trips for a given user."""
-        logger.info(f"Listing trips for user {user_id}")
-        try:
-            response = table.query(
-                KeyConditionExpression="PK = :pk AND begins_with(SK, :sk_prefix)",
-                ExpressionAttributeValues={
-                    ":pk": f"U#{user_id}",
-                    ":sk_prefix": "T#",
-                },
-            )
+    def list_page(
+        user_id: str, limit: int = TRIPS_PAGE_SIZE, cursor: str | None = None
+    ) -> tuple[list[dict], str | None]:
+        """
+        Lists one page of a user's trips, oldest cursor first. Returns the trips and
+        the cursor of the next page, or None if this was the last page.
+        """
+        if not 1 <= limit <= MAX_TRIPS_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_TRIPS_PAGE_SIZE}")
+        query_args = {
+            "KeyConditionExpression": "PK = :pk AND begins_with(SK, :sk_prefix)",
+            # Flights share the partition and the T# prefix, keep them out server-side
+            "FilterExpression": "#type = :type",
+            "ProjectionExpression": "SK, #name",
+            "ExpressionAttributeNames": {"#type": "Type", "#name": "Name"},
+            "ExpressionAttributeValues": {
+                ":pk": f"U#{user_id}",
+                ":sk_prefix": "T#",
+                ":type": "Trip",
+            },
+            # Limit counts items read before filtering, so a page may take a few queries.
+            # One more than a page tells whether there is a next one.
+            "Limit": limit + 1,
+        }
+        if cursor:
+            query_args["ExclusiveStartKey"] = decode_cursor(user_id, cursor)
+
+        def load() -> tuple[list[dict], str | None]:
             trips = []
-            for item in response.get("Items", []):
-                if item.get("Type") == "Trip":
-                    trips.append({"trip_id": item["SK"], "name": item["Name"]})
-            logger.info(f"Found {len(trips)} trips for user {user_id}")
-            return trips
+            while True:
+                response = table().query(**query_args)
+                trips.extend(
+                    {"trip_id": item["SK"], "name": item["Name"]}
+                    for item in response.get("Items", [])
+                )
+                last_key = response.get("LastEvaluatedKey")
+                if last_key is None or len(trips) > limit:
+                    break
+                query_args["ExclusiveStartKey"] = last_key
+
+            if len(trips) <= limit:
+                # A query can stop with a LastEvaluatedKey when only flights are left
+                return trips, None
+            # Continue right after the last trip we return
+            trips = trips[:limit]
+            return trips, encode_cursor({"PK": f"U#{user_id}", "SK": trips[-1]["trip_id"]})
+
+        try:
+            return trip_cache.get_or_load(user_id, ("trips", limit, cursor), load)
         except ClientError as e:
             logger.error(f"Error listing trips for user {user_id}: {e}")
             raise
 
+    @staticmethod
+    def iter_for_user(user_id: str, page_size: int = MAX_TRIPS_PAGE_SIZE) -> Iterator[dict]:
+        """Yields all of a user's trips, reading them a page at a time."""
+        cursor = None
+        while True:
+            trips, cursor = Trip.list_page(user_id, limit=page_size, cursor=cursor)
+            yield from trips
+            if cursor is None:
+                return
+
+    @staticmethod
+    def list_for_user(user_id: str) -> list[dict]:
+        """Lists all trips for a given user."""
+        logger.info(f"Listing trips for user {user_id}")
+        trips = list(Trip.iter_for_user(user_id))
+        logger.info(f"Found {len(trips)} trips for user {user_id}")
+        return trips
+
     @staticmethod
     def get_full_trip(user_id: str, trip_id: str) -> FullTrip:
         """
         Retrieves the full trip details including the trip name and all associated flights.
         """
+        return Trip.get_trip_details(user_id, trip_id).to_model()
+
+    @staticmethod
+    def get_full_trip_json(user_id: str, trip_id: str) -> str:
+        """Same as `get_full_trip(...).model_dump_json()`, without building the models."""
+        return Trip.get_trip_details(user_id, trip_id).to_json()
+
+    @staticmethod
+    def get_trip_details(user_id: str, trip_id: str) -> TripDetails:
+        """Reads a trip and its flights, through the per-user cache."""
         if not trip_id.startswith("T#"):
             msg = "trip_id must be prefixed with 'T#'"
             logger.error(msg)
@@ -116,39 +305,39 @@ class Trip(BaseModel):
         logger.info(
             f"Retrieving full trip details for trip {trip_id} for user {user_id}"
         )
-        try:
-            # Get trip name
-            trip_response = table.get_item(Key={"PK": f"U#{user_id}", "SK": trip_id})
-            trip_item = trip_response.get("Item")
+
+        def load() -> TripDetails:
+            # The trip and its flights share the user's partition, with the flights'
+            # sort keys starting with the trip id, so one query returns all of them
+            items = query_all(
+                KeyConditionExpression="PK = :pk AND begins_with(SK, :trip_id)",
+                ExpressionAttributeValues={":pk": f"U#{user_id}", ":trip_id": trip_id},
+                ConsistentRead=True,
+            )
+            trip_item = next((item for item in items if item["SK"] == trip_id), None)
             if not trip_item:
                 msg = f"Trip {trip_id} for user {user_id} not found."
                 logger.warning(msg)
                 raise ValueError(msg)
 
-            trip_name = trip_item.get("Name")
+            flight_items = [item for item in items if item.get("Type") == "Flight"]
+            if READ_LEGACY_FLIGHTS:
+                # Flights not yet moved by the backfill are still in the trip's partition, and
+                # while it runs a trip can have some flights in each. A flight in both is read
+                # from its current key, which payment updates are made to first.
+                legacy_items = query_all(
+                    KeyConditionExpression="PK = :pk AND begins_with(SK, :sk_prefix)",
+                    ExpressionAttributeValues={":pk": trip_id, ":sk_prefix": "F#"},
+                    ConsistentRead=True,
+                )
+                flights = {Flight.ids_from_item(item)[2]: item for item in legacy_items}
+                flights.update((Flight.ids_from_item(item)[2], item) for item in flight_items)
+                flight_items = [flights[flight_id] for flight_id in sorted(flights)]
 
-            # Get flights
-            flights_response = table.query(
-                KeyConditionExpression="PK = :pk AND begins_with(SK, :sk_prefix)",
-                ExpressionAttributeValues={":pk": trip_id, ":sk_prefix": "F#"},
-            )
+            return TripDetails.from_items(trip_item, flight_items)
 
-            flights = []
-            for item in flights_response.get("Items", []):
-                flight_data = {
-                    "trip_id": item["PK"],
-                    "flight_id": item["SK"],
-                    "from_airport": item["FromAirport"],
-                    "to_airport": item["ToAirport"],
-                    "departure_time": item["DepartureTime"],
-                    "arrival_time": item["ArrivalTime"],
-                    "price": item["Price"],
-                    "ticket_type": item["TicketType"],
-                    "payment_status": item["PaymentStatus"],
-                }
-                flights.append(Flight(**flight_data))
-
-            return FullTrip(name=trip_name, flights=flights)
+        try:
+            return trip_cache.get_or_load(user_id, ("trip", trip_id), load)
         except ClientError as e:
             logger.error(f"Error retrieving full trip details for trip {trip_id}: {e}")
             raise
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class UserEntries:
+    """The cached reads of one user, plus a generation bumped on every write."""
+
+    def __init__(self):
+        # Least recently used first
+        self.values: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.generation = 0
+
+
+class TripCache:
+    """
+    Bounded, per-container read-through cache of trip and flight reads.
+
+    Entries are grouped by user, and the least recently used users are evicted
+    once there are more than `max_users`. Each user keeps at most
+    `max_entries_per_user` reads, e.g. pages of trips for any cursor and limit,
+    dropping the least recently used. Each read expires after
+    `ttl_seconds`, which bounds how stale a read can be when another container
+    changes the data. Writes in this container invalidate the affected reads
+    straight away. Cached values are shared between callers and must not be
+    modified.
+    """
+
+    def __init__(self, max_users: int = 256, max_entries_per_user: int = 32, ttl_seconds: float = 60):
+        self.max_users = max_users
+        self.max_entries_per_user = max_entries_per_user
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._users: OrderedDict[str, UserEntries] = OrderedDict()
+        # Hits and misses per user since the last `take_counts`
+        self._counts: OrderedDict[str, list[int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, user_id: str, key: Hashable, load: Callable[[], Any]) -> Any:
+        """Returns the cached value for a user's read, calling `load` on a miss."""
+        with self._lock:
+            entries = self._entries_for(user_id)
+            cached = entries.values.get(key)
+            hit = cached is not None and time.monotonic() < cached[0]
+            self._count(user_id, hit)
+            if hit:
+                entries.values.move_to_end(key)
+                return cached[1]
+            generation = entries.generation
+
+        value = load()
+        with self._lock:
+            entries = self._entries_for(user_id)
+            # A write during the load may have made the value stale already
+            if entries.generation == generation:
+                entries.values[key] = (time.monotonic() + self.ttl_seconds, value)
+                entries.values.move_to_end(key)
+                while len(entries.values) > self.max_entries_per_user:
+                    entries.values.popitem(last=False)
+        return value
+
+    def invalidate(self, user_id: str, *keys: Hashable, prefix: str | None = None):
+        """
+        Drops cached reads of a user: the given keys, and every tuple key whose
+        first element is `prefix`.
+        """
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries is None:
+                return
+            entries.generation += 1
+            for key in keys:
+                entries.values.pop(key, None)
+            if prefix is not None:
+                for key in [k for k in entries.values if isinstance(k, tuple) and k[0] == prefix]:
+                    del entries.values[key]
+
+    def take_counts(self, user_id: str) -> tuple[int, int]:
+        """Returns and resets the hits and misses of a user."""
+        with self._lock:
+            hits, misses = self._counts.pop(user_id, (0, 0))
+            return hits, misses
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"users": len(self._users), "hits": self.hits, "misses": self.misses}
+
+    def _entries_for(self, user_id: str) -> UserEntries:
+        entries = self._users.get(user_id)
+        if entries is None:
+            entries = self._users[user_id] = UserEntries()
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_id)
+        return entries
+
+    def _count(self, user_id: str, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        counts = self._counts.setdefault(user_id, [0, 0])
+        counts[0 if hit else 1] += 1
+        self._counts.move_to_end(user_id)
+        while len(self._counts) > self.max_users:
+            self._counts.popitem(last=False)
+
+
+trip_cache = TripCache(
+    max_users=int(os.environ.get("TRIP_CACHE_SIZE", "256")),
+    max_entries_per_user=int(os.environ.get("TRIP_CACHE_ENTRIES_PER_USER", "32")),
+    ttl_seconds=float(os.environ.get("TRIP_CACHE_TTL_SECONDS", "60")),
+)
@@ -0,0 +1,112 @@
+"""
+Compares building csbot's agent per request the old way (a new BedrockModel
+and boto3 client, and the three tools registered, per agent) against
+`chat_agent.new_agent`, which reuses the model, tool registry and tool specs
+built once per container.
+
+Reports the time and memory allocated per agent, and the cost of the tool
+config the event loop asks the agent for on every model call. No AWS calls
+are made: creating a client doesn't connect.
+
+Run from csbot/backend/src:
+
+    uv run python bench/agent_factory_bench.py
+"""
+import argparse
+import gc
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("DDB_TABLE", "csbot-bench")
+os.environ.setdefault("STATE_BUCKET", "csbot-bench-state")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import chat_agent  # noqa: E402
+from strands import Agent  # noqa: E402
+from strands.models import BedrockModel  # noqa: E402
+
+MESSAGES = [
+    {"role": "user", "content": [{"text": "Which flights are on my Summer weekend trip?"}]},
+    {"role": "assistant", "content": [{"text": "You fly MUC to NCE on Friday and back on Monday."}]},
+]
+
+
+def per_request_agent(user_id: str) -> Agent:
+    """`new_agent` as it was: everything built for each agent."""
+    bedrock_model = BedrockModel(
+        model_id=chat_agent.model_id,
+        guardrail_id=chat_agent.guardrail_id,
+        guardrail_version=chat_agent.guardrail_version,
+        guardrail_trace="enabled",
+    )
+    agent = Agent(
+        model=bedrock_model,
+        messages=list(MESSAGES),
+        system_prompt=chat_agent.system_prompt,
+        conversation_manager=chat_agent.conversation_manager,
+        tools=[chat_agent.t_list_trips, chat_agent.t_flights_for_trip, chat_agent.t_refund_flight],
+        state={"user_id": user_id},
+        max_parallel_tools=1,
+    )
+    agent.thread_pool = chat_agent.tool_executor
+    return agent
+
+
+def shared_agent(user_id: str) -> Agent:
+    return chat_agent.new_agent(user_id, list(MESSAGES))
+
+
+def time_each(fn, runs: int) -> float:
+    """Median milliseconds per call."""
+    times = []
+    for i in range(runs):
+        started = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times) * 1000
+
+
+def allocated_per_agent(factory, runs: int) -> float:
+    """KiB allocated while building an agent, whether or not it is freed later."""
+    factory("warm-up")
+    gc.collect()
+    tracemalloc.start()
+    total = 0
+    for i in range(runs):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        agent = factory(f"user-{i}")
+        total += tracemalloc.get_traced_memory()[1] - before
+        del agent
+    tracemalloc.stop()
+    return total / runs / 1024
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--model-calls", type=int, default=3, help="model calls per turn (a tool-using turn has 3)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    print(f"{'':>12} {'build':>9} {'alloc':>10} {'tool config':>12} {'per turn':>9}")
+    for name, factory in (("per request", per_request_agent), ("shared", shared_agent)):
+        factory("warm-up")
+        build = time_each(lambda i: factory(f"user-{i}"), args.runs)
+        agent = factory("tool-config")
+        tool_config = time_each(lambda i: agent.tool_config, args.runs)
+        alloc = allocated_per_agent(factory, min(args.runs, 50))
+        turn = build + args.model_calls * tool_config
+        print(f"{name:>12} {build:>7.2f}ms {alloc:>7.0f}KiB {tool_config:>10.3f}ms {turn:>7.2f}ms")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,119 @@
+"""
+Measures csbot's cold start in a fresh interpreter per run, in both startup
+modes (see app/startup.py):
+
+- import: `import main`, everything the app imports and builds at import
+- ready: until the app's startup has run and it can answer the Lambda
+  Adapter's readiness check, which is where Lambda's init phase ends
+- chat ready: until strands, the Bedrock client and the DynamoDB table are
+  built, which the first chat turn waits for (in the background when lazy)
+
+Then breaks `import main`, and what lazy mode leaves for later, down by
+top-level package, from `python -X importtime`.
+
+Nothing connects to AWS; creating clients doesn't.
+
+Run from csbot/backend/src:
+
+    uv run python bench/cold_start_bench.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+ENV = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "DDB_TABLE": "csbot-bench",
+    "STATE_BUCKET": "csbot-bench-state",
+}
+
+
+def child():
+    """Runs in the fresh interpreter: starts the app and prints its timings as JSON."""
+    import asyncio
+    started = time.perf_counter()
+    sys.path.insert(0, APP)
+    import main
+    imported = time.perf_counter()
+
+    async def start():
+        async with main.lifespan(main.app):
+            ready = time.perf_counter()
+            # Waits for the warm-up thread if it is still importing these
+            import chat_agent  # noqa: F401
+            import ddb
+            ddb.table()
+            return ready, time.perf_counter()
+
+    ready, chat_ready = asyncio.run(start())
+    print(json.dumps({
+        "import": (imported - started) * 1000,
+        "ready": (ready - started) * 1000,
+        "chat ready": (chat_ready - started) * 1000,
+    }))
+
+
+def run_child(mode: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, "--child"],
+        env={**os.environ, **ENV, "STARTUP_MODE": mode},
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_times(code: str) -> dict[str, float]:
+    """Milliseconds spent importing each top-level package (its own code, not what it imports)."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {APP!r}); {code}"],
+        env={**os.environ, **ENV}, capture_output=True, text=True, check=True,
+    ).stderr
+    times: dict[str, float] = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip().split(".")[0]] += int(self_us) / 1000
+    return times
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    print(f"median of {args.runs} fresh interpreters")
+    print(f"{'':>6} {'import':>9} {'ready':>9} {'chat ready':>11}")
+    # Alternated, so both modes see the same machine load
+    results = {"lazy": [], "eager": []}
+    for _ in range(args.runs):
+        for mode, runs in results.items():
+            runs.append(run_child(mode))
+    for mode, runs in results.items():
+        print(f"{mode:>6}", *(f"{statistics.median(r[k] for r in runs):>{w}.0f}ms"
+                                for k, w in (("import", 7), ("ready", 7), ("chat ready", 9))))
+
+    at_startup = import_times("import main")
+    with_chat = import_times("import main, chat_agent, ddb; ddb.table()")
+    later = {package: with_chat[package] - at_startup.get(package, 0.0) for package in with_chat}
+    print(f"\nimport time by package (ms, {'at startup':>10} / {'deferred':>8} when lazy)")
+    for package in sorted(with_chat, key=with_chat.get, reverse=True)[:args.top]:
+        print(f"  {package:<22} {at_startup.get(package, 0.0):>10.0f} {max(later[package], 0.0):>10.0f}")
+    print(f"  {'total':<22} {sum(at_startup.values()):>10.0f} {sum(max(t, 0.0) for t in later.values()):>10.0f}")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,202 @@
+"""
+Fires interleaved chat sessions at the csbot API in one process and checks
+that no session sees another user's trips, then compares the wall time of
+running the same sessions one after another against running them concurrently.
+
+DynamoDB and S3 are served in-process by moto, with a fixed delay added to
+every AWS call to stand in for the network round trip. Bedrock is replaced by
+a scripted model that lists the user's trips, fetches the first trip's flights
+and then answers.
+
+Run from csbot/backend/src:
+
+    uv run --group dev python bench/concurrent_sessions_bench.py
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("DDB_TABLE", "csbot-bench")
+os.environ.setdefault("STATE_BUCKET", "csbot-bench-state")
+
+import boto3  # noqa: E402
+import httpx  # noqa: E402
+from moto import mock_aws  # noqa: E402
+from moto.dynamodb.models import DynamoDBBackend  # noqa: E402
+from strands.types.models import Model  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+TRIP_ID = re.compile(r"T#[0-9a-f-]{36}")
+AWS_LATENCY = 0.0
+MODEL_LATENCY = 0.0
+
+
+def simulate_aws_latency(**kwargs):
+    time.sleep(AWS_LATENCY)
+
+
+def serialize_moto_transactions():
+    """
+    moto's TransactWriteItems isn't thread-safe (it fails with "dictionary
+    changed size during iteration"), while new users' trips are written from
+    several threads. DynamoDB itself handles concurrent transactions.
+    """
+    lock = threading.Lock()
+    transact_write_items = DynamoDBBackend.transact_write_items
+
+    def locked(self, *args, **kwargs):
+        with lock:
+            return transact_write_items(self, *args, **kwargs)
+
+    DynamoDBBackend.transact_write_items = locked
+
+
+class ScriptedModel(Model):
+    """Plays the same tool-calling conversation for every prompt."""
+
+    def update_config(self, **model_config):
+        pass
+
+    def get_config(self):
+        return {}
+
+    def structured_output(self, output_model, prompt):
+        raise NotImplementedError
+
+    def format_request(self, messages, tool_specs=None, system_prompt=None):
+        return messages
+
+    def format_chunk(self, event):
+        return event
+
+    async def stream(self, request):
+        await asyncio.sleep(MODEL_LATENCY)
+        last = request[-1]["content"][0]
+        yield {"messageStart": {"role": "assistant"}}
+        if "toolResult" not in last:
+            events = tool_use_events("t_list_trips", {})
+        elif request[-2]["content"][-1]["toolUse"]["name"] == "t_list_trips":
+            text = last["toolResult"]["content"][0]["text"]
+            events = tool_use_events("t_flights_for_trip", {"trip_id": TRIP_ID.search(text).group(0)})
+        else:
+            yield {"contentBlockDelta": {"delta": {"text": "Here are your flights."}}}
+            yield {"contentBlockStop": {}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            return
+        for event in events:
+            yield event
+
+
+def tool_use_events(name: str, tool_input: dict) -> list[dict]:
+    tool_use_id = f"tooluse_{uuid.uuid4().hex}"
+    return [
+        {"contentBlockStart": {"start": {"toolUse": {"toolUseId": tool_use_id, "name": name}}}},
+        {"contentBlockDelta": {"delta": {"toolUse": {"input": json.dumps(tool_input)}}}},
+        {"contentBlockStop": {}},
+        {"messageStop": {"stopReason": "tool_use"}},
+    ]
+
+
+async def chat(client: httpx.AsyncClient, session_id: str) -> str:
+    response = await client.post(
+        "/api/chat", json={"prompt": "Show me my flights"}, cookies={"session_id": session_id}
+    )
+    response.raise_for_status()
+    return response.text
+
+
+async def run(main, sessions: list[str], concurrent: bool) -> float:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://csbot") as client:
+        started = time.perf_counter()
+        if concurrent:
+            await asyncio.gather(*(chat(client, session_id) for session_id in sessions))
+        else:
+            for session_id in sessions:
+                await chat(client, session_id)
+        return time.perf_counter() - started
+
+
+def check_isolation(main, sessions: list[str]) -> list[str]:
+    """Returns the sessions whose history mentions a trip that isn't theirs."""
+    leaked = []
+    for session_id in sessions:
+        own = {trip["trip_id"] for trip in main.Trip.list_for_user(session_id)}
+        main.agent_cache.invalidate(session_id)
+        agent = main.LoadHistory(session_id)
+        seen = set(TRIP_ID.findall(json.dumps(agent.messages)))
+        if not seen or not seen <= own:
+            leaked.append(session_id)
+    return leaked
+
+
+def main_bench():
+    global AWS_LATENCY, MODEL_LATENCY
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--aws-latency-ms", type=float, default=10)
+    parser.add_argument("--model-latency-ms", type=float, default=200)
+    args = parser.parse_args()
+
+    serialize_moto_transactions()
+    with mock_aws():
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-call", simulate_aws_latency)
+        boto3.client("s3").create_bucket(Bucket=os.environ["STATE_BUCKET"])
+        boto3.client("dynamodb").create_table(
+            TableName=os.environ["DDB_TABLE"],
+            KeySchema=[
+                {"AttributeName": "PK", "KeyType": "HASH"},
+                {"AttributeName": "SK", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "PK", "AttributeType": "S"},
+                {"AttributeName": "SK", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        import chat_agent
+        import main
+        chat_agent.bedrock_model = ScriptedModel()
+        logging.disable(logging.INFO)
+
+        serial = [str(uuid.uuid4()) for _ in range(args.sessions)]
+        concurrent = [str(uuid.uuid4()) for _ in range(args.sessions)]
+        for session_id in serial + concurrent:
+            main.LoadHistory(session_id)  # creates the session and its trips
+
+        AWS_LATENCY = args.aws_latency_ms / 1000
+        MODEL_LATENCY = args.model_latency_ms / 1000
+        # The agents' default callback handler prints every token
+        with contextlib.redirect_stdout(io.StringIO()):
+            serial_time = asyncio.run(run(main, serial, concurrent=False))
+            concurrent_time = asyncio.run(run(main, concurrent, concurrent=True))
+        AWS_LATENCY = 0
+
+        leaked = check_isolation(main, serial + concurrent)
+
+    print(f"sessions: {args.sessions}, aws latency: {args.aws_latency_ms} ms, "
+          f"model latency: {args.model_latency_ms} ms per call")
+    print(f"one at a time: {serial_time:7.2f} s  {args.sessions / serial_time:6.1f} chats/s")
+    print(f"concurrent:    {concurrent_time:7.2f} s  {args.sessions / concurrent_time:6.1f} chats/s")
+    print(f"speedup:       {serial_time / concurrent_time:7.2f}x")
+    print(f"isolation:     {'OK' if not leaked else 'FAILED for ' + ', '.join(leaked)}")
+    sys.exit(1 if leaked else 0)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,205 @@
+"""
+Replays the same long conversation through csbot's agent with the sliding
+window of 4 messages csbot used to keep, and with the token-budgeted
+`FoldingConversationManager` (app/conversation.py), and compares the prompt
+tokens sent to the model and the tool calls made per turn.
+
+The conversation keeps coming back to the same two trips. The model is
+scripted: it answers from what it is sent (system prompt and messages) and
+only calls a tool when an id it needs isn't there, that is `t_list_trips`
+for a trip it can't see the id of and `t_flights_for_trip` for a trip it
+can't see every flight id of. Tokens are estimated as in conversation.py,
+including the tool specs sent with every call.
+
+DynamoDB is served in-process by moto; nothing connects to AWS.
+
+Run from csbot/backend/src:
+
+    uv run --group dev python bench/conversation_replay_bench.py
+"""
+import argparse
+import contextlib
+import io
+import logging
+import os
+import statistics
+import sys
+import uuid
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("DDB_TABLE", "csbot-bench")
+os.environ.setdefault("STATE_BUCKET", "csbot-bench-state")
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+from strands.agent.conversation_manager import SlidingWindowConversationManager  # noqa: E402
+from strands.types.models import Model  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from concurrent_sessions_bench import tool_use_events  # noqa: E402
+from conversation import FoldingConversationManager, estimate_tokens, is_summary  # noqa: E402
+
+ALL_TRIPS = "all trips"
+# Each turn's prompt and the trips the model needs the details of to answer it
+SCRIPT = [
+    ("What trips do I have booked?", [ALL_TRIPS]),
+    ("Which flights are on my Summer weekend trip?", ["Summer weekend"]),
+    ("Any tips for getting through Munich airport quickly on a Friday evening?", []),
+    ("What about Nana's 80th, when do I fly out?", ["Nana's 80th"]),
+    ("Can I get a refund on my flight back from Nice?", ["Summer weekend"]),
+    ("What should I pack for a week in Seoul in June?", []),
+    ("Remind me what time the Summer weekend flights leave.", ["Summer weekend"]),
+    ("Is my flight to Seoul refundable?", ["Nana's 80th"]),
+]
+ANSWER = (
+    "Thank you for your question. Based on the details of your booking, here is what I can tell you. "
+    "Please note that our policies on changes and refunds depend on the ticket type of each flight, "
+    "and Basic Economy tickets cannot be refunded. Let me know if there is anything else I can help "
+    "you with regarding your trips or flights. "
+)
+
+
+class ReplayModel(Model):
+    """Calls the tools for the ids it can't see in its request, then answers. Records what it was sent."""
+
+    def __init__(self, trip_ids: dict[str, str], flight_ids: dict[str, list[str]]):
+        self.trip_ids = trip_ids
+        self.flight_ids = flight_ids
+        self.needs: list[str] = []
+        self.calls: list[int] = []  # estimated prompt tokens of each call
+        self.tool_calls = 0
+
+    def update_config(self, **model_config):
+        pass
+
+    def get_config(self):
+        return {}
+
+    def structured_output(self, output_model, prompt):
+        raise NotImplementedError
+
+    def format_request(self, messages, tool_specs=None, system_prompt=None):
+        return {"messages": messages, "tool_specs": tool_specs, "system_prompt": system_prompt}
+
+    def format_chunk(self, event):
+        return event
+
+    async def stream(self, request):
+        self.calls.append(estimate_tokens(request))
+        sent = (request["system_prompt"] or "") + str(request["messages"])
+        tool = self.next_tool(sent)
+        yield {"messageStart": {"role": "assistant"}}
+        if tool:
+            self.tool_calls += 1
+            for event in tool_use_events(*tool):
+                yield event
+            return
+        yield {"contentBlockDelta": {"delta": {"text": ANSWER}}}
+        yield {"contentBlockStop": {}}
+        yield {"messageStop": {"stopReason": "end_turn"}}
+
+    def next_tool(self, sent: str) -> tuple[str, dict] | None:
+        for need in self.needs:
+            trips = list(self.trip_ids) if need == ALL_TRIPS else [need]
+            if any(self.trip_ids[trip] not in sent for trip in trips):
+                return "t_list_trips", {}
+            for trip in trips:
+                if need != ALL_TRIPS and any(flight_id not in sent for flight_id in self.flight_ids[trip]):
+                    return "t_flights_for_trip", {"trip_id": self.trip_ids[trip]}
+        return None
+
+
+def summary_tokens(messages: list) -> int:
+    """Estimated tokens of the conversation summary the folding manager keeps in the first message."""
+    return sum(
+        estimate_tokens(content["text"]) for content in (messages[0]["content"] if messages else [])
+        if is_summary(content)
+    )
+
+
+def replay(chat_agent, model: ReplayModel, user_id: str, manager, turns: int) -> list[dict]:
+    """Plays `turns` turns of the script on one agent; returns the model calls, tokens and tool calls of each."""
+    chat_agent.bedrock_model = model
+    agent = chat_agent.new_agent(user_id, [])
+    agent.conversation_manager = manager
+    results = []
+    for turn in range(turns):
+        prompt, model.needs = SCRIPT[turn % len(SCRIPT)]
+        model.calls, model.tool_calls = [], 0
+        # The agents' default callback handler prints every token
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent(prompt)
+        results.append({
+            "calls": len(model.calls), "tokens": sum(model.calls),
+            "tool calls": model.tool_calls, "summary": summary_tokens(agent.messages),
+        })
+    return results
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--turns", type=int, default=48)
+    parser.add_argument("--budget", type=int, help="token budget of the folding manager (default: csbot's)")
+    parser.add_argument("--every", type=int, default=8, help="print every n-th turn")
+    args = parser.parse_args()
+
+    with mock_aws():
+        boto3.client("dynamodb").create_table(
+            TableName=os.environ["DDB_TABLE"],
+            KeySchema=[
+                {"AttributeName": "PK", "KeyType": "HASH"},
+                {"AttributeName": "SK", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "PK", "AttributeType": "S"},
+                {"AttributeName": "SK", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        import chat_agent
+        from dummy_trips import create_dummy_trips
+        from trip import Trip
+        logging.disable(logging.INFO)
+
+        budget = args.budget or chat_agent.conversation_manager.token_budget
+        managers = {
+            "window of 4": SlidingWindowConversationManager(window_size=4, should_truncate_results=True),
+            f"folding {budget}": FoldingConversationManager(token_budget=budget),
+        }
+        results = {}
+        for name, manager in managers.items():
+            user_id = str(uuid.uuid4())
+            create_dummy_trips(user_id)
+            trip_ids = {trip["name"]: trip["trip_id"] for trip in Trip.list_for_user(user_id)}
+            flight_ids = {
+                name: [flight.flight_id for flight in Trip.get_full_trip(user_id, trip_id).flights]
+                for name, trip_id in trip_ids.items()
+            }
+            results[name] = replay(chat_agent, ReplayModel(trip_ids, flight_ids), user_id, manager, args.turns)
+
+    print(f"{args.turns} turns, prompt tokens estimated at 4 characters per token")
+    print(f"{'':>14} {'calls/turn':>10} {'tools/turn':>10} {'tokens/call':>11} {'tokens/turn':>11} "
+          f"{'p95 turn':>9} {'tokens':>8}")
+    for name, turns in results.items():
+        calls = sum(turn["calls"] for turn in turns)
+        tokens = [turn["tokens"] for turn in turns]
+        print(f"{name:>14} {calls / len(turns):>10.2f} {sum(t['tool calls'] for t in turns) / len(turns):>10.2f} "
+              f"{sum(tokens) / calls:>11.0f} {statistics.mean(tokens):>11.0f} "
+              f"{statistics.quantiles(tokens, n=20)[-1]:>9.0f} {sum(tokens):>8}")
+
+    print("\nper turn (model calls, tool calls, prompt tokens; summary tokens)")
+    for turn in range(0, args.turns, args.every):
+        cells = [
+            f"{t['calls']} {t['tool calls']} {t['tokens']:>6}; {t['summary']:>4}"
+            for t in (turns[turn] for turns in results.values())
+        ]
+        print(f"  turn {turn + 1:>3}:  " + "   |   ".join(f"{name} {cell}" for name, cell in zip(results, cells)))
+
+
+if __name__ == "__main__":
+    main_bench()
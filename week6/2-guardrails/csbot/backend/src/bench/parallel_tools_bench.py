@@ -0,0 +1,153 @@
+"""
+Measures how long the csbot agent takes to run one model response that asks
+for the flights of several trips at once, with the tool calls run one after
+another versus on the shared tool pool.
+
+DynamoDB is served in-process by moto, with a fixed delay added to every call
+to stand in for the network round trip. Bedrock is replaced by a scripted
+model that answers instantly, so the time measured is the tools' time.
+
+Run from csbot/backend/src:
+
+    uv run --group dev python bench/parallel_tools_bench.py
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("DDB_TABLE", "csbot-bench")
+os.environ.setdefault("STATE_BUCKET", "csbot-bench-state")
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+from strands.types.models import Model  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+AWS_LATENCY = 0.0
+
+
+def simulate_aws_latency(**kwargs):
+    time.sleep(AWS_LATENCY)
+
+
+class ParallelToolsModel(Model):
+    """Asks for the flights of every given trip in one response, then answers."""
+
+    def __init__(self, trip_ids: list[str]):
+        self.trip_ids = trip_ids
+
+    def update_config(self, **model_config):
+        pass
+
+    def get_config(self):
+        return {}
+
+    def structured_output(self, output_model, prompt):
+        raise NotImplementedError
+
+    def format_request(self, messages, tool_specs=None, system_prompt=None):
+        return messages
+
+    def format_chunk(self, event):
+        return event
+
+    async def stream(self, request):
+        yield {"messageStart": {"role": "assistant"}}
+        if "toolResult" in request[-1]["content"][0]:
+            yield {"contentBlockDelta": {"delta": {"text": "Here are your flights."}}}
+            yield {"contentBlockStop": {}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            return
+        for trip_id in self.trip_ids:
+            tool_use = {"toolUseId": f"tooluse_{uuid.uuid4().hex}", "name": "t_flights_for_trip"}
+            yield {"contentBlockStart": {"start": {"toolUse": tool_use}}}
+            yield {"contentBlockDelta": {"delta": {"toolUse": {"input": json.dumps({"trip_id": trip_id})}}}}
+            yield {"contentBlockStop": {}}
+        yield {"messageStop": {"stopReason": "tool_use"}}
+
+
+def run(chat_agent, trips: int, workers: int, aws_latency: float) -> float:
+    """Returns the wall time of one chat turn that looks up `trips` trips at once."""
+    from flight import Flight, TicketType
+    from trip import Trip
+
+    user_id = str(uuid.uuid4())
+    trip_list = [Trip(user_id=user_id, name=f"Trip {i}") for i in range(trips)]
+    departure = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+    flights = [
+        Flight(
+            user_id=user_id,
+            trip_id=trip.trip_id,
+            from_airport="MUC",
+            to_airport="ICN",
+            departure_time=departure,
+            arrival_time=departure + timedelta(hours=11),
+            price=Decimal("800.00"),
+            ticket_type=TicketType.BASIC_ECONOMY,
+        )
+        for trip in trip_list
+    ]
+    Trip.save_with_flights(trip_list, flights)
+    trip_ids = [trip.trip_id for trip in trip_list]
+
+    chat_agent.bedrock_model = ParallelToolsModel(trip_ids)
+    chat_agent.tool_executor = chat_agent.SharedToolPool(max_workers=workers)
+    agent = chat_agent.new_agent(user_id, messages=[])
+
+    global AWS_LATENCY
+    AWS_LATENCY = aws_latency
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent("Show me the flights of all my trips")
+    elapsed = time.perf_counter() - started
+    AWS_LATENCY = 0
+
+    results = [c["toolResult"] for m in agent.messages for c in m["content"] if "toolResult" in c]
+    assert len(results) == trips and all(r["status"] == "success" for r in results), results
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--trips", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--aws-latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    with mock_aws():
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-call", simulate_aws_latency)
+        boto3.client("s3").create_bucket(Bucket=os.environ["STATE_BUCKET"])
+        boto3.client("dynamodb").create_table(
+            TableName=os.environ["DDB_TABLE"],
+            KeySchema=[
+                {"AttributeName": "PK", "KeyType": "HASH"},
+                {"AttributeName": "SK", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "PK", "AttributeType": "S"},
+                {"AttributeName": "SK", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+        import chat_agent
+        logging.disable(logging.INFO)
+
+        print(f"aws latency: {args.aws_latency_ms} ms per call")
+        print(f"{'trips':>6} {'one by one':>12} {'shared pool':>12} {'speedup':>8}")
+        for trips in args.trips:
+            serial = run(chat_agent, trips, 1, args.aws_latency_ms / 1000)
+            parallel = run(chat_agent, trips, max(trips, 2), args.aws_latency_ms / 1000)
+            print(f"{trips:>6} {serial * 1000:>10.0f}ms {parallel * 1000:>10.0f}ms {serial / parallel:>7.2f}x")
@@ -0,0 +1,90 @@
+"""
+Compares session encodings by stored size and encode/decode time.
+
+Run from csbot/backend/src:
+
+    uv run python bench/session_codec_bench.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from session_codec import CODECS, decode, encode  # noqa: E402
+
+TURN_COUNTS = [1, 5, 10, 25, 50, 100]
+
+
+def make_turn(i: int) -> list[dict]:
+    """One chat turn with a tool call, shaped like the messages strands stores."""
+    trip = {
+        "name": f"Trip {i}",
+        "flights": [
+            {
+                "trip_id": f"T#00000000-0000-0000-0000-{i:012d}",
+                "flight_id": f"F#00000000-0000-0000-0000-{i * 2 + leg:012d}",
+                "from_airport": "MUC",
+                "to_airport": "ICN",
+                "departure_time": "2024-06-01T12:00:00Z",
+                "arrival_time": "2024-06-01T23:00:00Z",
+                "price": "800.00",
+                "ticket_type": "Basic Economy",
+                "payment_status": "paid",
+            }
+            for leg in range(2)
+        ],
+    }
+    tool_use_id = f"tooluse_{i:020d}"
+    return [
+        {"role": "user", "content": [{"text": f"Can you show me the flights for trip {i}?"}]},
+        {"role": "assistant", "content": [
+            {"text": "Let me look up the flights for that trip."},
+            {"toolUse": {"toolUseId": tool_use_id, "name": "t_flights_for_trip",
+                         "input": {"trip_id": trip["flights"][0]["trip_id"]}}},
+        ]},
+        {"role": "user", "content": [
+            {"toolResult": {"toolUseId": tool_use_id, "status": "success",
+                            "content": [{"text": json.dumps(trip)}]}},
+        ]},
+        {"role": "assistant", "content": [
+            {"text": "Your trip has two flights between Munich and Seoul, both Basic Economy "
+                     "and paid. Basic Economy tickets are not refundable."},
+        ]},
+    ]
+
+
+def bench(document: dict, dumps, loads, number: int) -> tuple[int, float, float]:
+    data = dumps(document)
+    encode_us = timeit.timeit(lambda: dumps(document), number=number) / number * 1e6
+    decode_us = timeit.timeit(lambda: loads(data), number=number) / number * 1e6
+    return len(data), encode_us, decode_us
+
+
+def main():
+    variants = {"legacy (indent=2)": (
+        lambda d: json.dumps(d, indent=2).encode("utf-8"),
+        lambda b: json.loads(b.decode("utf-8")),
+    )}
+    for name, codec in CODECS.items():
+        if codec.available():
+            variants[name] = (lambda d, c=codec: encode(d, c), decode)
+        else:
+            print(f"skipping {name}: not installed")
+
+    print(f"{'turns':>5}  {'codec':<18} {'bytes':>9} {'ratio':>6} {'encode us':>10} {'decode us':>10}")
+    for turns in TURN_COUNTS:
+        messages = [m for i in range(turns) for m in make_turn(i)]
+        document = {"messages": messages, "system_prompt": "You are a customer service assistant."}
+        number = max(5, 2000 // turns)
+        baseline = None
+        for name, (dumps, loads) in variants.items():
+            size, encode_us, decode_us = bench(document, dumps, loads, number)
+            baseline = baseline or size
+            print(f"{turns:>5}  {name:<18} {size:>9} {size / baseline:>6.2f} {encode_us:>10.1f} {decode_us:>10.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
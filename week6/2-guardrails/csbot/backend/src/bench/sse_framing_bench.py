@@ -0,0 +1,152 @@
+"""
+Compares streaming a chat response with one SSE frame per token delta (the
+old `generate`) against the coalescing `SSEEncoder`.
+
+A synthetic agent stream stands in for Bedrock: it yields events shaped like
+strands' (a raw chunk event, then the text delta) in bursts separated by a
+pause, and each response is served through a FastAPI StreamingResponse
+driven directly over ASGI, so Starlette's per-frame cost is included.
+Reports frames per response and per second, CPU time per response and the
+time to the first frame.
+
+Run from csbot/backend/src:
+
+    uv run python bench/sse_framing_bench.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from stream_encoder import SSEEncoder  # noqa: E402
+
+TOKENS = ["The", " flight", " from", " Munich", " to", " Seoul", " departs", " at", " noon", "."]
+
+
+async def agent_events(tokens: int, burst: int, gap: float):
+    """Yields `tokens` text deltas, `burst` at a time with `gap` seconds between bursts."""
+    yield {"init_event_loop": True}
+    for i in range(tokens):
+        if i % burst == 0:
+            await asyncio.sleep(gap)
+        text = TOKENS[i % len(TOKENS)]
+        yield {"event": {"contentBlockDelta": {"delta": {"text": text}}}}
+        yield {"data": text, "delta": {"text": text}}
+    yield {"event": {"messageStop": {"stopReason": "end_turn"}}}
+
+
+async def per_token(events):
+    async for event in events:
+        if "data" in event:
+            yield f"data: {json.dumps(event['data'])}\n\n"
+
+
+async def batched(events):
+    sse = SSEEncoder()
+    async for event in sse.paced(events):
+        if "frame" in event:
+            yield event["frame"]
+            continue
+        if "data" in event:
+            if frame := sse.data(event["data"]):
+                yield frame
+    if frame := sse.flush():
+        yield frame
+
+
+def make_app(stream, args) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/api/chat")
+    async def chat():
+        return StreamingResponse(
+            stream(agent_events(args.tokens, args.burst, args.gap_ms / 1000)),
+            media_type="text/event-stream",
+        )
+
+    return app
+
+
+async def one_response(app: FastAPI) -> tuple[float, float, float, int, str]:
+    """Returns the wall time, CPU time, time to first frame, frames and text of one response."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/api/chat", "raw_path": b"/api/chat", "query_string": b"",
+        "root_path": "", "headers": [], "client": ("bench", 1), "server": ("bench", 80),
+    }
+    request_sent = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    chunks = []
+    first = None
+
+    async def send(message):
+        nonlocal first
+        if message["type"] == "http.response.body" and message.get("body"):
+            if first is None:
+                first = time.perf_counter()
+            chunks.append(message["body"])
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    await app(scope, receive, send)
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    disconnected.set()
+    body = b"".join(chunks).decode()
+    text = "".join(
+        json.loads(line[len("data: "):]) for line in body.split("\n") if line.startswith("data: ")
+    )
+    return elapsed, cpu, first - started, len(chunks), text
+
+
+async def measure(stream, args) -> dict:
+    app = make_app(stream, args)
+    runs = [await one_response(app) for _ in range(args.runs)]
+    frames = statistics.mean(r[3] for r in runs)
+    cpu = statistics.mean(r[1] for r in runs)
+    return {
+        "frames": frames,
+        "cpu_ms": cpu * 1000,
+        "frames_per_s": frames / statistics.mean(r[0] for r in runs),
+        "first_frame_ms": statistics.median(r[2] for r in runs) * 1000,
+        "wall_ms": statistics.mean(r[0] for r in runs) * 1000,
+        "text": runs[0][4],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=20, help="deltas per burst")
+    parser.add_argument("--gap-ms", type=float, default=5, help="pause between bursts")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    results = {name: asyncio.run(measure(stream, args)) for name, stream in
+               (("per token", per_token), ("batched", batched))}
+    assert results["per token"]["text"] == results["batched"]["text"]
+
+    print(f"{args.tokens} deltas, {args.burst} per burst, {args.gap_ms} ms between bursts")
+    print(f"{'':>10} {'frames':>8} {'frames/s':>9} {'cpu/resp':>10} {'1st frame':>10} {'wall':>9}")
+    for name, r in results.items():
+        print(f"{name:>10} {r['frames']:>8.0f} {r['frames_per_s']:>9.0f} {r['cpu_ms']:>8.1f}ms "
+              f"{r['first_frame_ms']:>8.2f}ms {r['wall_ms']:>7.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
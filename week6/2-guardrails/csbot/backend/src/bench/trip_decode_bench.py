@@ -0,0 +1,100 @@
+"""
+Compares the ways of turning a trip's DynamoDB items into the JSON returned
+by /api/trip/{trip_id}:
+
+  validate    Flight.from_item + FullTrip, then model_dump_json (the old path)
+  construct   Flight.model_construct with pre-parsed values, then model_dump_json
+  rows        TripDetails: Flight.json_from_item, then json.dumps
+  cached      TripDetails.to_json() again, as served while the trip is cached
+
+Run from csbot/backend/src:
+
+    uv run python bench/trip_decode_bench.py
+"""
+import argparse
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DDB_TABLE", "csbot-bench")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from flight import Flight, PaymentStatus, TicketType  # noqa: E402
+from trip import FullTrip, TripDetails  # noqa: E402
+
+TRIP_ID = f"T#{uuid.uuid4()}"
+
+
+def flight_items(count: int) -> list[dict]:
+    departure = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+    return [
+        Flight(
+            user_id="bench",
+            trip_id=TRIP_ID,
+            from_airport="MUC",
+            to_airport="ICN",
+            departure_time=departure + timedelta(days=i),
+            arrival_time=departure + timedelta(days=i, hours=11),
+            price=Decimal("800.00"),
+            ticket_type=TicketType.BASIC_ECONOMY,
+        ).to_item()
+        for i in range(count)
+    ]
+
+
+def validate(items: list[dict]) -> str:
+    return FullTrip(name="Bench", flights=[Flight.from_item(item) for item in items]).model_dump_json()
+
+
+def construct(items: list[dict]) -> str:
+    flights = []
+    for item in items:
+        user_id, trip_id, flight_id = Flight.ids_from_item(item)
+        flights.append(Flight.model_construct(
+            user_id=user_id,
+            trip_id=trip_id,
+            flight_id=flight_id,
+            from_airport=item["FromAirport"],
+            to_airport=item["ToAirport"],
+            departure_time=datetime.fromisoformat(item["DepartureTime"]),
+            arrival_time=datetime.fromisoformat(item["ArrivalTime"]),
+            price=item["Price"],
+            ticket_type=TicketType(item["TicketType"]),
+            payment_status=PaymentStatus(item["PaymentStatus"]),
+        ))
+    return FullTrip.model_construct(name="Bench", flights=flights).model_dump_json()
+
+
+def rows(items: list[dict]) -> str:
+    return TripDetails.from_items({"Name": "Bench"}, items).to_json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--flights", type=int, nargs="+", default=[2, 20, 200])
+    parser.add_argument("--number", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'flights':>8} {'validate':>10} {'construct':>10} {'rows':>10} {'cached':>10}   (µs per trip)")
+    for count in args.flights:
+        items = flight_items(count)
+        expected = validate(items)
+        assert construct(items) == expected and rows(items) == expected
+        cached_details = TripDetails.from_items({"Name": "Bench"}, items)
+        cached_details.to_json()
+
+        timings = [
+            timeit.timeit(lambda: path(items), number=args.number) / args.number * 1e6
+            for path in (validate, construct, rows)
+        ]
+        timings.append(timeit.timeit(cached_details.to_json, number=args.number) / args.number * 1e6)
+        print(f"{count:>8} " + " ".join(f"{t:>10.1f}" for t in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Moves flights stored under their trip (PK = trip id, SK = flight id) into
+their user's partition (PK = U#user, SK = trip id#flight id), next to the trip
+they belong to, so a trip and its flights can be read with a single query.
+
+Copying is idempotent: a flight already present under its new key is left
+alone, so the backfill can be re-run. The app reads both layouts, merged by
+flight id, until it is deployed with READ_LEGACY_FLIGHTS=false. Do that once a
+run with `--delete-legacy` reports nothing orphaned or conflicting, and trips
+are read with a single query again.
+
+Each copy is written only if the legacy item still has the payment status it
+was read with; if a refund or cancellation got there first, the flight is read
+again and copied with its new status. A payment update can still reach the
+legacy item just after its copy was written, as the app updates the legacy
+key when it found no flight under the new one. `--delete-legacy` therefore
+only deletes legacy items whose payment status matches their copy, and reports
+the others as conflicting. Run it while payment updates are paused to avoid
+them.
+
+Run from csbot/backend/src:
+
+    DDB_TABLE=<table> uv run python scripts/backfill_flight_layout.py [--dry-run] [--delete-legacy]
+"""
+import argparse
+import logging
+import os
+import sys
+from collections.abc import Iterator
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from ddb import DDB_TABLE, table  # noqa: E402
+from flight import SAVE_CONDITION, Flight  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def scan_pages(**kwargs) -> Iterator[list[dict]]:
+    """Scans the table a page at a time, following LastEvaluatedKey."""
+    while True:
+        response = table().scan(**kwargs)
+        yield response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            return
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def trip_owners() -> dict[str, str]:
+    """Returns the user id of every trip, by trip id."""
+    owners = {}
+    for page in scan_pages(
+        FilterExpression="#type = :type",
+        ProjectionExpression="PK, SK",
+        ExpressionAttributeNames={"#type": "Type"},
+        ExpressionAttributeValues={":type": "Trip"},
+    ):
+        owners.update((item["SK"], item["PK"][2:]) for item in page)
+    return owners
+
+
+def legacy_flights() -> Iterator[dict]:
+    """Yields the flight items still stored under their trip."""
+    for page in scan_pages(
+        FilterExpression="#type = :type AND NOT begins_with(PK, :user)",
+        ExpressionAttributeNames={"#type": "Type"},
+        ExpressionAttributeValues={":type": "Flight", ":user": "U#"},
+    ):
+        yield from page
+
+
+def copy_flight(item: dict, user_id: str, attempts: int = 3) -> bool:
+    """
+    Writes a legacy flight item under its new key, unless one is there already,
+    in a transaction that checks the legacy item's payment status hasn't changed
+    since it was read. Returns whether it was copied.
+    """
+    trip_id, flight_id = item["PK"], item["SK"]
+    for attempt in range(1, attempts + 1):
+        try:
+            table().meta.client.transact_write_items(TransactItems=[
+                {
+                    "Put": {
+                        "TableName": DDB_TABLE,
+                        "Item": {**item, **Flight.key(user_id, trip_id, flight_id)},
+                        "ConditionExpression": SAVE_CONDITION,
+                    }
+                },
+                {
+                    "ConditionCheck": {
+                        "TableName": DDB_TABLE,
+                        "Key": Flight.legacy_key(trip_id, flight_id),
+                        "ConditionExpression": "PaymentStatus = :status",
+                        "ExpressionAttributeValues": {":status": item["PaymentStatus"]},
+                    }
+                },
+            ])
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+            # One reason per item: the put, then the check of the legacy item
+            reasons = [reason.get("Code") for reason in e.response.get("CancellationReasons", [])]
+            if reasons[0] == "ConditionalCheckFailed":
+                return False
+            if attempt == attempts:
+                raise
+            if reasons[1] == "ConditionalCheckFailed":
+                logger.info(f"Flight {flight_id} of trip {trip_id} changed while copying it, reading it again")
+                item = table().get_item(Key=Flight.legacy_key(trip_id, flight_id), ConsistentRead=True).get("Item")
+                if item is None:
+                    return False
+    return False
+
+
+def delete_legacy_flight(item: dict, user_id: str) -> bool:
+    """Deletes a legacy flight item if its copy has the same payment status. Returns whether it did."""
+    trip_id, flight_id = item["PK"], item["SK"]
+    copy = table().get_item(Key=Flight.key(user_id, trip_id, flight_id), ConsistentRead=True).get("Item")
+    if copy is None:
+        return False
+    try:
+        table().delete_item(
+            Key=Flight.legacy_key(trip_id, flight_id),
+            ConditionExpression="PaymentStatus = :status",
+            ExpressionAttributeValues={":status": copy["PaymentStatus"]},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+
+
+def backfill(dry_run: bool = False, delete_legacy: bool = False) -> dict[str, int]:
+    """Copies legacy flight items to the current layout and returns what was done."""
+    owners = trip_owners()
+    counts = {"copied": 0, "existing": 0, "orphaned": 0, "deleted": 0, "conflicting": 0}
+
+    for item in legacy_flights():
+        trip_id, flight_id = item["PK"], item["SK"]
+        user_id = owners.get(trip_id)
+        if user_id is None:
+            logger.warning(f"Flight {flight_id} belongs to unknown trip {trip_id}, skipping")
+            counts["orphaned"] += 1
+            continue
+
+        if dry_run:
+            logger.info(f"Would move flight {flight_id} of trip {trip_id} to user {user_id}")
+            counts["copied"] += 1
+            continue
+        if copy_flight(item, user_id):
+            counts["copied"] += 1
+        else:
+            counts["existing"] += 1
+        if delete_legacy:
+            if delete_legacy_flight(item, user_id):
+                counts["deleted"] += 1
+            else:
+                logger.warning(f"Flight {flight_id} of trip {trip_id} differs from its copy, not deleting it")
+                counts["conflicting"] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be moved")
+    parser.add_argument(
+        "--delete-legacy", action="store_true",
+        help="delete each legacy flight item once it exists under its new key with the same payment status",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    counts = backfill(dry_run=args.dry_run, delete_legacy=args.delete_legacy)
+    print(", ".join(f"{name}: {count}" for name, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,28 @@
-import type { ChatHistory, Message, Trip, FullTrip } from './types';
+import type { ChatHistory, Trip, FullTrip } from './types';
 
-export async function loadChatHistory(): Promise<Message[]> {
+export async function loadChatHistory(): Promise<ChatHistory> {
 	const response = await fetch('/api/chat');
 	if (!response.ok) {
 		throw new Error('Failed to fetch chat history');
 	}
 	const data: ChatHistory = await response.json();
-	return data.messages;
+	return data;
 }
 
 export async function loadTrips(): Promise<Trip[]> {
-	const response = await fetch('/api/trips');
-	if (!response.ok) {
-		throw new Error('Failed to fetch trips');
-	}
-	const data: Trip[] = await response.json();
-	return data;
+	const trips: Trip[] = [];
+	let cursor: string | null = null;
+	do {
+		const url: string = cursor ? `/api/trips?cursor=${encodeURIComponent(cursor)}` : '/api/trips';
+		const response = await fetch(url);
+		if (!response.ok) {
+			throw new Error('Failed to fetch trips');
+		}
+		const page: Trip[] = await response.json();
+		trips.push(...page);
+		cursor = response.headers.get('X-Next-Cursor');
+	} while (cursor);
+	return trips;
 }
 
 export async function loadTripDetails(tripId: string): Promise<FullTrip> {
@@ -7,8 +7,15 @@ export interface Message {
 	content: MessageContent[];
 }
 
+export interface ChatCheckpoint {
+	prompt: string;
+	text: string;
+}
+
 export interface ChatHistory {
 	messages: Message[];
+	// A reply that was interrupted and can be resumed
+	checkpoint: ChatCheckpoint | null;
 }
 
 export interface Trip {
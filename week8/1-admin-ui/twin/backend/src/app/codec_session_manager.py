@@ -0,0 +1,182 @@
+import logging
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+from strands.hooks import AfterInvocationEvent, HookRegistry
+from strands.session.s3_session_manager import AGENT_PREFIX, SESSION_PREFIX, S3SessionManager
+from strands.types.exceptions import SessionException
+from strands.types.session import SessionAgent, SessionMessage
+
+from request_metrics import current_metrics
+from session_codec import JsonCodec, SessionCodec, decode, encode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AGENT_ID = "default"
+
+
+def transcript_key(session_id: str, agent_id: str = DEFAULT_AGENT_ID, prefix: str = "") -> str:
+    """Key of an agent's chat transcript, next to its `agent.json`."""
+    return f"{prefix}/{SESSION_PREFIX}{session_id}/agents/{AGENT_PREFIX}{agent_id}/transcript.json"
+
+
+def display_message(message: dict) -> dict | None:
+    """Returns a message as shown in the chat (its first text block), or None if it isn't shown."""
+    content = message.get("content")
+    if not content or "text" not in content[0]:
+        return None
+    return {"role": message["role"], "content": [{"text": content[0]["text"]}]}
+
+
+def load_transcript(client, bucket: str, session_id: str,
+                    if_none_match: str | None = None) -> tuple[bytes, str]:
+    """
+    Returns the JSON chat transcript of a session and its ETag, without
+    loading the session.
+
+    Raises the S3 `ClientError` for `NoSuchKey` if there is none (a new
+    session, or one last written before transcripts were kept), and for `304`
+    if `if_none_match` still matches its ETag.
+    """
+    request_args = {"Bucket": bucket, "Key": transcript_key(session_id)}
+    if if_none_match:
+        request_args["IfNoneMatch"] = if_none_match
+    response = client.get_object(**request_args)
+    return response["Body"].read(), response["ETag"]
+
+
+class CodecS3SessionManager(S3SessionManager):
+    """
+    S3SessionManager that writes session objects with a `SessionCodec`
+    instead of pretty-printed JSON.
+
+    Object keys are unchanged, and objects written by the stock manager are
+    still read, since `decode` recognises plain JSON.
+
+    It also keeps each agent's chat transcript, the messages the conversation
+    manager hasn't removed as shown in the chat, as plain JSON next to the
+    agent (see `transcript_key`). The transcript is updated from the messages
+    this manager reads and writes, and uploaded once at the end of each
+    invocation if it changed, rather than on every added message.
+
+    Its S3 reads and writes are timed as the request's SessionLoad and
+    SessionSave (see request_metrics.py).
+    """
+
+    def __init__(self, codec: SessionCodec, **kwargs: Any):
+        self.codec = codec
+        # Per agent: the display form of each message by message id, how many
+        # messages the conversation manager removed, and whether it changed
+        self._shown: Dict[str, Dict[int, Optional[dict]]] = {}
+        self._removed: Dict[str, int] = {}
+        self._transcript_changed: set[str] = set()
+        super().__init__(**kwargs)
+
+    def register_hooks(self, registry: HookRegistry, **kwargs: Any) -> None:
+        # AfterInvocationEvent callbacks run in reverse, so registering first
+        # makes this run after the final sync of the agent
+        registry.add_callback(AfterInvocationEvent, lambda event: self._save_changed_transcript(event.agent.agent_id))
+        super().register_hooks(registry, **kwargs)
+
+    def list_messages(
+        self, session_id: str, agent_id: str, limit: Optional[int] = None, offset: int = 0, **kwargs: Any
+    ) -> List[SessionMessage]:
+        with current_metrics().phase("SessionLoad"):
+            session_messages = super().list_messages(session_id, agent_id, limit, offset, **kwargs)
+        if limit is None:
+            # Every message the agent is restored with
+            self._shown[agent_id] = {
+                m.message_id: display_message(m.to_message()) for m in session_messages
+            }
+            self._removed[agent_id] = offset
+        return session_messages
+
+    def create_message(self, session_id: str, agent_id: str, session_message: SessionMessage, **kwargs: Any) -> None:
+        super().create_message(session_id, agent_id, session_message, **kwargs)
+        self._show(agent_id, session_message)
+
+    def update_message(self, session_id: str, agent_id: str, session_message: SessionMessage, **kwargs: Any) -> None:
+        super().update_message(session_id, agent_id, session_message, **kwargs)
+        self._show(agent_id, session_message)
+
+    def update_agent(self, session_id: str, session_agent: SessionAgent, **kwargs: Any) -> None:
+        super().update_agent(session_id, session_agent, **kwargs)
+        agent_id = session_agent.agent_id
+        removed = session_agent.conversation_manager_state.get("removed_message_count", 0)
+        if removed != self._removed.get(agent_id, 0):
+            self._removed[agent_id] = removed
+            shown = self._shown.get(agent_id, {})
+            self._shown[agent_id] = {i: message for i, message in shown.items() if i >= removed}
+            self._transcript_changed.add(agent_id)
+
+    def rebuild_transcript(self, agent_id: str = DEFAULT_AGENT_ID) -> tuple[bytes, str]:
+        """
+        Writes an agent's transcript from the messages in the session, for
+        sessions that don't have one yet. Returns its body and ETag.
+        """
+        session_agent = self.read_agent(self.session_id, agent_id)
+        if session_agent is None:
+            self._shown[agent_id] = {}
+        else:
+            removed = session_agent.conversation_manager_state.get("removed_message_count", 0)
+            self.list_messages(self.session_id, agent_id, offset=removed)
+        return self.save_transcript(agent_id)
+
+    def save_transcript(self, agent_id: str = DEFAULT_AGENT_ID) -> tuple[bytes, str]:
+        """Writes an agent's transcript as this manager has it. Returns its body and ETag."""
+        shown = self._shown.get(agent_id, {})
+        document = {
+            "messages": [shown[i] for i in sorted(shown) if shown[i] is not None],
+        }
+        # Always JSON whatever the session codec, so it can be served as it is
+        body = JsonCodec().dumps(document)
+        key = transcript_key(self.session_id, agent_id, self.prefix)
+        try:
+            with current_metrics().phase("SessionSave"):
+                response = self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=body,
+                    ContentType=JsonCodec.content_type,
+                )
+        except ClientError as e:
+            raise SessionException(f"Failed to write S3 object {key}: {e}") from e
+        self._transcript_changed.discard(agent_id)
+        return body, response["ETag"]
+
+    def _save_changed_transcript(self, agent_id: str):
+        if agent_id in self._transcript_changed:
+            self.save_transcript(agent_id)
+
+    def _show(self, agent_id: str, session_message: SessionMessage):
+        shown = display_message(session_message.to_message())
+        previous = self._shown.setdefault(agent_id, {}).get(session_message.message_id)
+        self._shown[agent_id][session_message.message_id] = shown
+        if shown is not None or previous is not None:
+            self._transcript_changed.add(agent_id)
+
+    def _read_s3_object(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with current_metrics().phase("SessionLoad"):
+                response = self.client.get_object(Bucket=self.bucket, Key=key)
+                body = response["Body"].read()
+            return decode(body)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise SessionException(f"S3 error reading {key}: {e}") from e
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError too
+            raise SessionException(f"Invalid session object {key}: {e}") from e
+
+    def _write_s3_object(self, key: str, data: Dict[str, Any]) -> None:
+        try:
+            with current_metrics().phase("SessionSave"):
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=encode(data, self.codec),
+                    ContentType=self.codec.content_type,
+                )
+        except ClientError as e:
+            raise SessionException(f"Failed to write S3 object {key}: {e}") from e
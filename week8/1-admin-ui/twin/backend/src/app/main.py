@@ -1,10 +1,10 @@
+from botocore.exceptions import ClientError
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from strands.agent.conversation_manager import SlidingWindowConversationManager
 from strands import Agent, tool
 from strands.models import BedrockModel
-from strands.session.s3_session_manager import S3SessionManager
 from strands_tools import retrieve
 import boto3
 import json
@@ -13,10 +13,16 @@ import os
 import uuid
 import uvicorn
 from questions import Question, QuestionManager
+from codec_session_manager import CodecS3SessionManager, load_transcript
+from prompt_cache import add_cache_points, record_usage
+from request_metrics import MetricsMiddleware, current_metrics, snapshot
+from session_codec import get_codec
+from stream_encoder import SSEEncoder
 
 
 # Re-use boto session across invocations
 boto_session = boto3.Session()
+s3_client = boto_session.client("s3")
 state_bucket_name = os.environ.get("STATE_BUCKET", "")
 if state_bucket_name == "":
     raise ValueError("BUCKET_NAME environment variable is not set.")
@@ -27,8 +33,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+session_codec = get_codec(os.environ.get("SESSION_CODEC", "msgpack+zstd"))
 model_id = os.environ.get("MODEL_ID", "global.anthropic.claude-haiku-4-5-20251001-v1:0")
-bedrock_model = BedrockModel(
+
+
+class CachingBedrockModel(BedrockModel):
+    """
+    Marks the tool specs, the system prompt and the conversation so far as
+    cacheable, and records the cache's use per request (see prompt_cache.py).
+    """
+
+    def format_request(self, messages, tool_specs=None, system_prompt=None):
+        return add_cache_points(super().format_request(messages, tool_specs, system_prompt))
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        async for event in super().stream(messages, tool_specs, system_prompt, **kwargs):
+            record_usage(event)
+            yield event
+
+
+bedrock_model = CachingBedrockModel(
     model_id=model_id,
     # Add Guardrails here
 )
@@ -43,6 +67,8 @@ You are a digital twin of Salma Wahwah. You should answer questions about their
 When searching for information via a tool, tell the user you are "trying to remember" the information, and then use the tool to retrieve it.
 """
 app = FastAPI()
+# Times the phases of each request, see request_metrics.py
+app.add_middleware(MetricsMiddleware)
 question_manager = QuestionManager()
 
 @tool
@@ -67,20 +93,29 @@ def submit_unanswered_question(user_question: str) -> str:
         # Let the model see that something went wrong
         return f"Failed to save question: {e}"
 
-def session(id: str) -> Agent:
-    tools = [retrieve,submit_unanswered_question]
-    session_manager = S3SessionManager(
+def session_manager_for(id: str) -> CodecS3SessionManager:
+    return CodecS3SessionManager(
+        codec=session_codec,
         boto_session=boto_session,
         bucket=state_bucket_name,
         session_id=id,
     )
-    return Agent(
-        conversation_manager=conversation_manager,
-        model=bedrock_model,
-        session_manager=session_manager,
-        system_prompt=SYSTEM_PROMPT,
-        tools=tools,
-    )
+
+def session(id: str) -> Agent:
+    tools = [retrieve,submit_unanswered_question]
+    metrics = current_metrics()
+    metrics.properties["SessionId"] = id
+    with metrics.phase("SessionLoad"):
+        session_manager = session_manager_for(id)
+    # Restoring the session happens in here, its reads are timed as SessionLoad
+    with metrics.phase("AgentConstruction"):
+        return Agent(
+            conversation_manager=conversation_manager,
+            model=bedrock_model,
+            session_manager=session_manager,
+            system_prompt=SYSTEM_PROMPT,
+            tools=tools,
+        )
 
 class ChatRequest(BaseModel):
     prompt: str
@@ -99,39 +134,56 @@ async def chat(chat_request: ChatRequest, request: Request):
     return response
 
 async def generate(agent: Agent, session_id: str, prompt: str, request: Request):
+    # Coalesces token deltas into fewer frames, see stream_encoder.py
+    sse = SSEEncoder()
+    metrics = current_metrics()
+    metrics.stream_started(agent)
     try:
-        async for event in agent.stream_async(prompt):
+        async for event in sse.paced(agent.stream_async(prompt)):
+            if "frame" in event:
+                yield event["frame"]
+                continue
             if "complete" in event:
                 logger.info("Response generation complete")
             if "data" in event:
-                yield f"data: {json.dumps(event['data'])}\n\n"
+                metrics.token()
+                if frame := sse.data(event["data"]):
+                    yield frame
+        if frame := sse.flush():
+            yield frame
     except Exception as e:
-        error_message = json.dumps({"error": str(e)})
-        yield f"event: error\ndata: {error_message}\n\n"
+        yield sse.error(str(e))
+    finally:
+        metrics.stream_finished(agent)
 
 @app.get('/api/chat')
 def chat_get(request: Request):
+    """
+    Returns the chat history from the session's transcript, without loading
+    the session. Answers 304 if the client's copy (by its ETag) is current.
+    """
     session_id = request.cookies.get("session_id", str(uuid.uuid4()))
-    agent = session(session_id)
+    if_none_match = request.headers.get("if-none-match")
+    metrics = current_metrics()
+    metrics.properties["SessionId"] = session_id
+    try:
+        with metrics.phase("SessionLoad"):
+            body, etag = load_transcript(s3_client, state_bucket_name, session_id, if_none_match)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("304", "NotModified"):
+            response = Response(status_code=304, headers={"ETag": if_none_match, "Cache-Control": "no-cache"})
+            response.set_cookie(key="session_id", value=session_id)
+            return response
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        # A new session, or one last written before transcripts were kept
+        body, etag = session_manager_for(session_id).rebuild_transcript()
 
-    # Filter messages to only include first text content
-    filtered_messages = []
-    for message in agent.messages:
-        if (message.get("content") and 
-            len(message["content"]) > 0 and 
-            "text" in message["content"][0]):
-            filtered_messages.append({
-                "role": message["role"],
-                "content": [{
-                    "text": message["content"][0]["text"]
-                }]
-            })
- 
     response = Response(
-        content=json.dumps({
-            "messages": filtered_messages,
-        }),
+        content=body,
         media_type="application/json",
+        # Have the browser revalidate with If-None-Match rather than guess a lifetime
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
     )
     response.set_cookie(key="session_id", value=session_id)
     return response
@@ -145,5 +197,10 @@ async def root():
         media_type="application/json",
     )
 
+@app.get("/debug/metrics")
+async def debug_metrics():
+    """Returns the latency of each phase of the requests this instance has served."""
+    return snapshot()
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "8080")))